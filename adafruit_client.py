@@ -0,0 +1,288 @@
+"""
+Adafruit IO REST client with a keep-alive session, timeouts and a circuit breaker
+
+The Adafruit_IO library sends every request through requests.get/post with
+no timeout, so each one opens a new TLS connection and a hung server holds a
+cycle for as long as the OS lets it. PooledClient sends the same requests
+through one requests.Session instead: connections are kept alive and reused
+across requests and cycles, and every request has a connect and a read
+timeout.
+
+CircuitBreaker stops hammering an Adafruit IO that's down. After `failures`
+connection errors, timeouts or 5xx responses in a row the circuit opens and
+requests fail straight away with CircuitOpenError. Once `reset_seconds` have
+passed one request is let through as a probe (half-open): success closes the
+circuit, failure opens it again for twice as long, up to `max_reset_seconds`.
+4xx responses, 429 included, mean the server is answering and count as
+successes. With a state file the circuit is shared by every process on the
+account, so cron runs during an outage fail fast too.
+
+The scripts that talk to Adafruit IO from several threads (reset_feed.py,
+export_history.py, aggregator.py) share the helpers at the end: a client
+per thread, the account's rate limiter and requests made within it.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from Adafruit_IO import Client
+from rate_limiter import TokenBucket, limited_request
+
+DEFAULT_BASE_URL = 'https://io.adafruit.com'
+CIRCUIT_STATE_FILENAME = '.adafruit_circuit.json'
+RATE_LIMIT_FILENAME = '.adafruit_rate_limit.json'
+
+# How many times to retry a request Adafruit IO throttled
+MAX_THROTTLE_RETRIES = 5
+
+# One breaker per state file, shared by every client in the process
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+_local = threading.local()
+
+
+class CircuitOpenError(Exception):
+    """Adafruit IO has been failing; the request wasn't sent"""
+
+
+class CircuitBreaker:
+    """Fail fast after `failures` consecutive failures, probing now and then"""
+
+    def __init__(self, failures=3, reset_seconds=60, max_reset_seconds=600, state_file=None):
+        if failures < 1:
+            raise ValueError("failures must be at least 1")
+        self.threshold = int(failures)
+        self.reset_seconds = float(reset_seconds)
+        self.max_reset_seconds = max(float(max_reset_seconds), self.reset_seconds)
+        self.state_file = state_file
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._cooldown = self.reset_seconds
+
+    def _load(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            self._failures = int(state['failures'])
+            self._open_until = float(state['open_until'])
+            self._cooldown = float(state['cooldown'])
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or corrupt state just means a closed circuit
+            pass
+
+    def _save(self):
+        if not self.state_file:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'failures': self._failures, 'open_until': self._open_until,
+                           'cooldown': self._cooldown}, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            logging.warning(f"Could not save circuit breaker state: {e}")
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half-open' (a probe may go out now)"""
+        with self._lock:
+            self._load()
+            if self._failures < self.threshold:
+                return 'closed'
+            return 'open' if time.time() < self._open_until else 'half-open'
+
+    def before_request(self):
+        """Raise CircuitOpenError unless a request may go out now
+
+        In the half-open state the caller becomes the probe, and everyone
+        else keeps failing fast for another cooldown (which also covers a
+        probe whose process dies before reporting back).
+        """
+        with self._lock:
+            self._load()
+            if self._failures < self.threshold:
+                return
+            now = time.time()
+            if now < self._open_until:
+                raise CircuitOpenError(f"Adafruit IO is unavailable - not trying again for "
+                                       f"{self._open_until - now:.0f}s")
+            self._open_until = now + self._cooldown
+            self._save()
+        logging.info("Adafruit IO circuit half-open - sending one request as a probe")
+
+    def record_success(self):
+        with self._lock:
+            self._load()
+            if self._failures == 0:
+                return
+            recovered = self._failures >= self.threshold
+            self._failures = 0
+            self._open_until = 0.0
+            self._cooldown = self.reset_seconds
+            self._save()
+        if recovered:
+            logging.info("Adafruit IO is answering again - circuit closed")
+
+    def record_failure(self):
+        with self._lock:
+            self._load()
+            self._failures += 1
+            if self._failures < self.threshold:
+                self._save()
+                return
+            if self._failures > self.threshold:
+                # A failed probe: back off further
+                self._cooldown = min(self._cooldown * 2, self.max_reset_seconds)
+            self._open_until = time.time() + self._cooldown
+            failures, cooldown = self._failures, self._cooldown
+            self._save()
+        logging.warning(f"Adafruit IO failed {failures} time(s) in a row - circuit open, "
+                        f"failing fast for {cooldown:g}s")
+
+
+def new_session(pool_size=4):
+    """Keep-alive session holding up to `pool_size` connections to the server"""
+    session = requests.Session()
+    # No transport retries: the offline queue and rate limiter handle failures
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class PooledClient(Client):
+    """Adafruit_IO.Client over a keep-alive session with timeouts and an optional CircuitBreaker
+
+    `timeout` is (connect, read) seconds, as for requests.
+    """
+
+    def __init__(self, username, key, base_url=DEFAULT_BASE_URL, timeout=(5, 15), breaker=None,
+                 pool_size=4, proxies=None):
+        super().__init__(username, key, proxies=proxies, base_url=base_url or DEFAULT_BASE_URL)
+        self.timeout = timeout
+        self.breaker = breaker
+        self.session = new_session(pool_size)
+        self.session.headers.update(self._headers({'X-AIO-Key': key}))
+
+    def _request(self, method, path, **kwargs):
+        if self.breaker is not None:
+            self.breaker.before_request()
+        try:
+            response = self.session.request(method, self._compose_url(path), timeout=self.timeout,
+                                            proxies=self.proxies, **kwargs)
+        except requests.RequestException:
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        self._last_response = response
+        if self.breaker is not None:
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        self._handle_error(response)
+        return response
+
+    def _get(self, path, params=None):
+        return self._request('GET', path, params=params).json()
+
+    def _post(self, path, data):
+        return self._request('POST', path, data=json.dumps(data),
+                             headers={'Content-Type': 'application/json'}).json()
+
+    def _delete(self, path):
+        self._request('DELETE', path, headers={'Content-Type': 'application/json'})
+
+    def close(self):
+        self.session.close()
+
+
+def shared_breaker(state_file, **options):
+    """The process's breaker for `state_file`, created on first use"""
+    with _breakers_lock:
+        breaker = _breakers.get(str(state_file))
+        if breaker is None:
+            breaker = _breakers[str(state_file)] = CircuitBreaker(state_file=state_file, **options)
+        return breaker
+
+
+def open_client(username, key, base_url='', state_dir=None, pool_size=4):
+    """A PooledClient configured from the environment (.env already loaded)
+
+    ADAFRUIT_IO_CONNECT_TIMEOUT / ADAFRUIT_IO_READ_TIMEOUT are the request
+    timeouts in seconds. The circuit opens after ADAFRUIT_IO_BREAKER_FAILURES
+    failures in a row (0 = no circuit breaker) for ADAFRUIT_IO_BREAKER_SECONDS,
+    doubling after each failed probe up to ADAFRUIT_IO_BREAKER_MAX_SECONDS.
+    Its state is kept in STATE_DIR (`state_dir`) and shared with every
+    other client using the same directory.
+    """
+    timeout = (float(os.getenv('ADAFRUIT_IO_CONNECT_TIMEOUT', '5')),
+               float(os.getenv('ADAFRUIT_IO_READ_TIMEOUT', '15')))
+    failures = int(os.getenv('ADAFRUIT_IO_BREAKER_FAILURES', '3'))
+    breaker = None
+    if failures > 0:
+        state_dir = state_dir or os.getenv('STATE_DIR', str(Path(__file__).parent.absolute()))
+        breaker = shared_breaker(Path(state_dir) / CIRCUIT_STATE_FILENAME, failures=failures,
+                                 reset_seconds=float(os.getenv('ADAFRUIT_IO_BREAKER_SECONDS', '60')),
+                                 max_reset_seconds=float(os.getenv('ADAFRUIT_IO_BREAKER_MAX_SECONDS', '600')))
+    return PooledClient(username, key, base_url=base_url, timeout=timeout, breaker=breaker, pool_size=pool_size)
+
+
+def state_dir():
+    """STATE_DIR, or the directory of the scripts"""
+    return Path(os.getenv('STATE_DIR', str(Path(__file__).parent.absolute())))
+
+
+def credentials():
+    """(ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY); either is None when it isn't set"""
+    return os.getenv('ADAFRUIT_IO_USERNAME'), os.getenv('ADAFRUIT_IO_KEY')
+
+
+def open_rate_limiter():
+    """The account's TokenBucket (ADAFRUIT_IO_RATE_LIMIT / ADAFRUIT_IO_BURST), shared
+    through its state file with every other script"""
+    return TokenBucket(float(os.getenv('ADAFRUIT_IO_RATE_LIMIT', '30')),
+                       burst=float(os.getenv('ADAFRUIT_IO_BURST', '8')),
+                       state_file=state_dir() / RATE_LIMIT_FILENAME)
+
+
+def worker_client():
+    """One client (and keep-alive connection) per thread, so each sees its own
+    last response; they share the circuit breaker"""
+    client = getattr(_local, 'client', None)
+    if client is None:
+        username, key = credentials()
+        client = _local.client = open_client(username, key, os.getenv('ADAFRUIT_IO_BASE_URL', ''), state_dir())
+    return client
+
+
+def limited(limiter, request, *args, **kwargs):
+    """`request` (a method of worker_client()) within the rate limit, waiting out 429s"""
+    return limited_request(limiter, worker_client(), request, *args, retries=MAX_THROTTLE_RETRIES, **kwargs)
+
+
+def select_feeds(patterns, feeds):
+    """Feed keys matching any of `patterns` (names or glob patterns), and the
+    patterns that matched nothing"""
+    selected = []
+    unmatched = []
+    for pattern in patterns:
+        matches = [key for key in feeds if fnmatchcase(key, pattern)]
+        if not matches:
+            unmatched.append(pattern)
+        for key in matches:
+            if key not in selected:
+                selected.append(key)
+    return selected, unmatched
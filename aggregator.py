@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+"""
+Forward readings from a fleet of Enviro+ units to Adafruit IO and the other sinks
+Usage:
+  ./aggregator.py            # Run until SIGTERM/Ctrl+C
+
+Each unit runs publish_to_adafruit.py with its own DEVICE_ID and
+ENABLE_AGGREGATOR=true, which sends every reading over MQTT to
+<AGGREGATOR_TOPIC>/<device>/reading. This process subscribes to all of them.
+
+Every reading goes into a durable queue per device (aggregator_queue.db in
+STATE_DIR). Every AGGREGATOR_FLUSH_SECONDS the queues are sent to Adafruit IO,
+devices taking turns, several readings per request (one batch request per
+feed). One token bucket, in the same state file the publisher, reset_feed.py
+and export_history.py use, paces every unit's data points, so the account
+stays under its limit however many units there are, and only this process
+talks to Adafruit IO, over one keep-alive connection. A reading leaves the
+queue once Adafruit IO has it; while Adafruit IO is down the circuit breaker
+(see adafruit_client.py) skips flushes until a probe gets through.
+
+Each reading also goes straight to the CSV, NDJSON and InfluxDB sinks, set up
+with the same settings as for the publisher and tagged with the device.
+Home Assistant isn't involved: units publish their own entities, which
+DEVICE_ID keeps apart.
+
+The MQTT session outlives the connection (AGGREGATOR_SESSION_HOURS), so the
+broker holds readings sent while the aggregator restarts.
+"""
+
+import sys
+import os
+import time
+import signal
+import logging
+import argparse
+import threading
+from pathlib import Path
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from Adafruit_IO import Data, Feed, Group, RequestError, ThrottlingError
+from fleet import (SENSOR_KEYS, READING_TOPIC_FILTER, feed_prefix, feed_mapping, bare_feed_key, topic_device,
+                   decode_reading)
+from rate_limiter import retry_after_seconds
+from adafruit_client import CircuitOpenError, credentials, state_dir, open_rate_limiter, worker_client, limited
+from reading_queue import ReadingQueue
+from sinks import (Reading, FanOut, CsvSink, NdjsonSink, InfluxHttpSink, InfluxUdpSink, udp_address,
+                   format_timestamp)
+from log_setup import setup_logging, log_detail
+
+script_dir = Path(__file__).parent.absolute()
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=script_dir / '.env')
+except ImportError:
+    pass
+
+# Logs rotate and buffer the same way as the publisher's (see log_setup.py)
+setup_logging(
+    Path(os.getenv('AGGREGATOR_LOG_FILE', str(script_dir / 'aggregator_log.txt'))),
+    json_lines=os.getenv('LOG_FORMAT', 'text').lower() == 'json',
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', '1048576')),
+    backups=int(os.getenv('LOG_BACKUPS', '5')),
+    when=os.getenv('LOG_ROTATE_WHEN', ''),
+    compress=os.getenv('LOG_COMPRESS', 'true').lower() == 'true',
+    buffer_lines=int(os.getenv('LOG_BUFFER_LINES', '100')),
+    buffer_seconds=float(os.getenv('LOG_BUFFER_SECONDS', '60')),
+    console=os.getenv('LOG_CONSOLE', 'true').lower() == 'true',
+    summary=os.getenv('LOG_SUMMARY', 'false').lower() == 'true'
+)
+
+# ============================================
+# CONFIGURATION - Load from environment variables
+# ============================================
+
+ENABLE_ADAFRUIT_IO = os.getenv('ENABLE_ADAFRUIT_IO', 'true').lower() == 'true'
+ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY = credentials()
+STATE_DIR = state_dir()
+
+MQTT_BROKER = os.getenv('MQTT_BROKER', 'homeassistant.local')
+MQTT_PORT = int(os.getenv('MQTT_PORT', '1883'))
+MQTT_USERNAME = os.getenv('MQTT_USERNAME')
+MQTT_PASSWORD = os.getenv('MQTT_PASSWORD')
+MQTT_TIMEOUT = float(os.getenv('MQTT_TIMEOUT', '10'))
+
+# Units publish to <AGGREGATOR_TOPIC>/<device>/reading
+AGGREGATOR_TOPIC = os.getenv('AGGREGATOR_TOPIC', 'enviroplus/fleet')
+# Seconds between sends to Adafruit IO, and most readings per device per request
+AGGREGATOR_FLUSH_SECONDS = float(os.getenv('AGGREGATOR_FLUSH_SECONDS', '10'))
+AGGREGATOR_BATCH_READINGS = int(os.getenv('AGGREGATOR_BATCH_READINGS', '100'))
+# How long the broker keeps readings for the aggregator while it's disconnected
+AGGREGATOR_SESSION_HOURS = float(os.getenv('AGGREGATOR_SESSION_HOURS', '24'))
+# Readings kept per device while Adafruit IO is unreachable (oldest dropped first)
+QUEUE_MAX_READINGS = int(os.getenv('QUEUE_MAX_READINGS', '10000'))
+
+# The other sinks, as for the publisher (leave empty to disable)
+CSV_FILE = os.getenv('CSV_FILE', '')
+NDJSON_FILE = os.getenv('NDJSON_FILE', '')
+INFLUXDB_URL = os.getenv('INFLUXDB_URL', '')
+INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN', '')
+INFLUXDB_UDP = os.getenv('INFLUXDB_UDP', '')
+INFLUXDB_MEASUREMENT = os.getenv('INFLUXDB_MEASUREMENT', 'enviroplus')
+SINK_TIMEOUT = float(os.getenv('SINK_TIMEOUT', '30'))
+SINK_QUEUE_SIZE = int(os.getenv('SINK_QUEUE_SIZE', '100'))
+SINK_OVERLOAD_POLICY = os.getenv('SINK_OVERLOAD_POLICY', 'drop_oldest')
+
+# Readings waiting for Adafruit IO, one backlog per device (None when it's disabled)
+_queue = None
+_pipeline = None
+_limiter = None
+# Devices whose feed group has been checked this run
+_devices_ready = set()
+# Devices heard from this run
+_devices_seen = set()
+_mqtt_connected = threading.Event()
+_shutdown = threading.Event()
+
+
+def build_pipeline():
+    """A worker for every file/database sink enabled in the configuration"""
+    pipeline = FanOut()
+
+    def add(sink):
+        pipeline.add(sink, queue_size=SINK_QUEUE_SIZE, policy=SINK_OVERLOAD_POLICY, timeout=SINK_TIMEOUT)
+
+    if CSV_FILE:
+        add(CsvSink(CSV_FILE, ['device'] + SENSOR_KEYS))
+    if NDJSON_FILE:
+        add(NdjsonSink(NDJSON_FILE))
+    if INFLUXDB_URL:
+        add(InfluxHttpSink(INFLUXDB_URL, token=INFLUXDB_TOKEN, measurement=INFLUXDB_MEASUREMENT))
+    if INFLUXDB_UDP:
+        host, port = udp_address(INFLUXDB_UDP)
+        add(InfluxUdpSink(host, port, measurement=INFLUXDB_MEASUREMENT))
+    return pipeline
+
+
+def on_mqtt_connect(client, userdata, flags, reason_code, properties=None):
+    if reason_code != 0:
+        logging.error(f"MQTT broker refused the connection: {reason_code}")
+        return
+    _mqtt_connected.set()
+    # The session usually still has the subscription; this covers a fresh one
+    client.subscribe(READING_TOPIC_FILTER.format(base=AGGREGATOR_TOPIC), qos=1)
+
+
+def on_mqtt_disconnect(client, userdata, *args):
+    _mqtt_connected.clear()
+
+
+def on_reading(client, userdata, message):
+    """Queue a unit's reading for Adafruit IO and hand it to the other sinks"""
+    device = topic_device(AGGREGATOR_TOPIC, message.topic)
+    if device is None:
+        return
+    try:
+        sensors, created_at, stats = decode_reading(message.payload)
+    except ValueError as e:
+        logging.warning(f"Ignoring message from {device}: {e}")
+        return
+
+    if device not in _devices_seen:
+        _devices_seen.add(device)
+        logging.info(f"Receiving readings from {device} ({len(_devices_seen)} device(s))")
+
+    if _queue is not None:
+        try:
+            evicted = _queue.push(device, sensors, created_at)
+            if evicted:
+                logging.warning(f"{device} queue full - dropped {evicted} oldest reading(s)")
+        except Exception as e:
+            logging.error(f"Failed to queue reading from {device}: {e}")
+    if _pipeline:
+        _pipeline.submit(Reading(sensors, created_at, stats, device))
+
+
+def connect_mqtt():
+    """Connect with a session the broker keeps (and fills) while we're away"""
+    client = mqtt.Client(client_id='enviroplus-aggregator', protocol=mqtt.MQTTv5)
+    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.on_connect = on_mqtt_connect
+    client.on_disconnect = on_mqtt_disconnect
+    client.on_message = on_reading
+
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = int(AGGREGATOR_SESSION_HOURS * 3600)
+
+    logging.info(f"Connecting to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}")
+    client.connect(MQTT_BROKER, MQTT_PORT, 60, clean_start=False, properties=properties)
+    client.loop_start()
+    if not _mqtt_connected.wait(MQTT_TIMEOUT):
+        client.loop_stop()
+        raise TimeoutError(f"No answer from MQTT broker within {MQTT_TIMEOUT:g} seconds")
+    return client
+
+
+def is_not_found(error):
+    return "404" in str(error) or "not found" in str(error).lower()
+
+
+def ensure_device_feeds(device):
+    """Create the device's feed group and put its feeds in it (checked once per run)"""
+    if device in _devices_ready:
+        return
+
+    aio = worker_client()
+    group_key = feed_prefix(device)
+    try:
+        group = limited(_limiter, aio.groups, group_key)
+    except RequestError as e:
+        if not is_not_found(e):
+            raise
+        group = limited(_limiter, aio.create_group, Group(name=group_key, key=group_key))
+        logging.info(f"Created group {group_key}")
+
+    grouped_feeds = {bare_feed_key(feed.key) for feed in group.feeds or ()}
+    missing = [name for name in feed_mapping(device).values() if name not in grouped_feeds]
+    if missing:
+        existing_feeds = {feed.key for feed in limited(_limiter, aio.feeds)}
+        for feed_name in missing:
+            if feed_name in existing_feeds:
+                # The client library has no wrapper for this endpoint
+                limited(_limiter, aio._post, f"groups/{group_key}/add", {'feed_key': feed_name})
+                logging.info(f"Added feed {feed_name} to group {group_key}")
+            else:
+                limited(_limiter, aio.create_feed, Feed(name=feed_name, key=feed_name), group_key=group_key)
+                logging.info(f"Created feed {feed_name} in group {group_key}")
+
+    _devices_ready.add(device)
+
+
+def send_device_chunk(aio, device, chunk):
+    """Send queued readings from one device: a single reading as one group
+    request, several as one batch request per feed"""
+    if len(chunk) == 1:
+        _, created_at, sensors = chunk[0]
+        feeds = feed_mapping(device)
+        aio._post(f"groups/{feed_prefix(device)}/data", {
+            'feeds': [{'key': feeds[sensor], 'value': value} for sensor, value in sensors.items()],
+            'created_at': format_timestamp(created_at),
+        })
+        return
+
+    for sensor, feed_name in feed_mapping(device).items():
+        data = [
+            Data(value=sensors[sensor], created_at=format_timestamp(created_at))
+            for _, created_at, sensors in chunk
+            if sensor in sensors
+        ]
+        if data:
+            # A failure part-way through re-sends the earlier feeds next time;
+            # a duplicate point is better than a lost one
+            aio.send_batch_data(feed_name, data)
+
+
+def flush_to_adafruit(max_seconds):
+    """Send queued readings, one chunk per device in turn, until the queues are
+    empty or the rate limit would hold us past `max_seconds`"""
+    aio = worker_client()
+    deadline = time.monotonic() + max_seconds
+    pending = set(_queue.sinks())
+    sent = {}
+
+    while pending:
+        for device in sorted(pending):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                pending.clear()
+                break
+
+            # At most a minute's budget of readings, paced by the limiter;
+            # devices take turns so one backlog can't hold up the rest
+            chunk_size = max(1, min(AGGREGATOR_BATCH_READINGS, int(_limiter.limit) // len(SENSOR_KEYS)))
+            chunk = _queue.peek(device, chunk_size)
+            if len(chunk) < chunk_size:
+                pending.discard(device)
+            if not chunk:
+                continue
+
+            try:
+                ensure_device_feeds(device)
+                if not _limiter.acquire(sum(len(sensors) for _, _, sensors in chunk), max_wait=remaining):
+                    pending.clear()
+                    break
+                send_device_chunk(aio, device, chunk)
+            except ThrottlingError:
+                _limiter.throttled(retry_after_seconds(aio))
+                pending.clear()
+                break
+            except CircuitOpenError as e:
+                log_detail(f"Not forwarding to Adafruit IO: {e}")
+                pending.clear()
+                break
+            except RequestError as e:
+                if is_not_found(e):
+                    # Group or feeds were deleted (e.g. by reset_feed.py); recreate them next time
+                    _devices_ready.discard(device)
+                logging.error(f"Error sending {device} readings to Adafruit IO: {e}")
+                pending.discard(device)
+                continue
+            except Exception as e:
+                logging.error(f"Unexpected error sending {device} readings to Adafruit IO: {e}")
+                pending.discard(device)
+                continue
+
+            _queue.ack([row_id for row_id, _, _ in chunk])
+            sent[device] = sent.get(device, 0) + len(chunk)
+            log_detail(f"Sent {len(chunk)} reading(s) from {device} to Adafruit IO")
+
+    if sent:
+        waiting = sum(_queue.count(device) for device in _queue.sinks())
+        logging.info(f"Forwarded {sum(sent.values())} reading(s) from {len(sent)} device(s) to Adafruit IO"
+                     + (f" ({waiting} still waiting)" if waiting else ""))
+
+
+def main():
+    global _queue, _pipeline, _limiter
+
+    parser = argparse.ArgumentParser(description="Forward readings from many Enviro+ units to Adafruit IO and other sinks")
+    parser.add_argument('--flush-interval', type=float, default=AGGREGATOR_FLUSH_SECONDS,
+                        help=f"seconds between sends to Adafruit IO (default: {AGGREGATOR_FLUSH_SECONDS:g})")
+    args = parser.parse_args()
+    if args.flush_interval <= 0:
+        parser.error("--flush-interval must be greater than 0")
+
+    try:
+        _pipeline = build_pipeline()
+    except Exception as e:
+        logging.error(f"Invalid sink configuration: {e}")
+        sys.exit(1)
+
+    if ENABLE_ADAFRUIT_IO:
+        if not ADAFRUIT_IO_USERNAME or not ADAFRUIT_IO_KEY:
+            logging.error("Adafruit IO credentials not configured! Set them in .env or ENABLE_ADAFRUIT_IO=false")
+            sys.exit(1)
+        _queue = ReadingQueue(STATE_DIR / 'aggregator_queue.db', max_readings=QUEUE_MAX_READINGS)
+        # Shared with every unit's publisher and the other scripts
+        _limiter = open_rate_limiter()
+
+    names = (['Adafruit IO'] if _queue is not None else []) + _pipeline.names()
+    if not names:
+        logging.error("Nothing to forward to! Enable Adafruit IO or set CSV_FILE, NDJSON_FILE or INFLUXDB_*")
+        sys.exit(1)
+    logging.info(f"Forwarding readings from {AGGREGATOR_TOPIC}/+/reading to: {', '.join(names)}")
+
+    def request_shutdown(signum, frame):
+        logging.info(f"Received signal {signum}, shutting down")
+        _shutdown.set()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    try:
+        client = connect_mqtt()
+    except Exception as e:
+        logging.error(f"Could not connect to MQTT broker: {e}")
+        sys.exit(1)
+
+    next_flush = time.monotonic()
+    while not _shutdown.wait(max(0.0, next_flush - time.monotonic())):
+        if _queue is not None:
+            try:
+                flush_to_adafruit(args.flush_interval)
+            except Exception as e:
+                # Never let one bad flush kill the service
+                logging.error(f"Unexpected error forwarding to Adafruit IO: {e}")
+        next_flush = max(next_flush + args.flush_interval, time.monotonic())
+
+    client.disconnect()
+    client.loop_stop()
+    _pipeline.close()
+    if _queue is not None:
+        _queue.close()
+    logging.info("Aggregator stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the sensor read and publish path without a Pi or network
+
+Runs publish_to_adafruit.py against simulated sensors (ENVIRO_BACKEND=fake),
+a mock Adafruit IO HTTP server and a minimal MQTT broker stand-in, all on
+localhost, and reports read latency (direct and through the sensor broker),
+per-service publish latency and end-to-end cycle throughput. Cold start is
+measured by running the script once as cron would, with -X importtime to
+show which imports it pays for.
+
+Usage:
+  ./benchmark.py                        # Run and print results
+  ./benchmark.py --save-baseline        # Record the results as the baseline
+  ./benchmark.py --check                # Exit 1 if slower than the baseline (skipped if there is none)
+  ./benchmark.py --sensor-latency 0.005 --service-latency 0.05
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import logging
+import argparse
+import tempfile
+import importlib
+import subprocess
+import threading
+import socketserver
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from instrumentation import percentile
+
+script_dir = Path(__file__).parent.absolute()
+DEFAULT_BASELINE = script_dir / 'benchmark_baseline.json'
+
+
+def summarize(samples, failures=0):
+    """Latency summary in milliseconds"""
+    return {
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+        'samples': len(samples),
+        'failures': failures,
+    }
+
+
+# ============================================
+# Mock Adafruit IO
+# ============================================
+
+class MockAdafruitIO:
+    """Just enough of the Adafruit IO v2 REST API for the publisher and reset_feed.py"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.groups = {}
+        self.feeds = set()
+        self.requests = 0
+        self.points = 0
+        self._lock = threading.Lock()
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real server (without Nagle's algorithm the
+            # headers and body don't wait on the client's delayed ACK)
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                mock.handle(self, 'GET')
+
+            def do_POST(self):
+                mock.handle(self, 'POST')
+
+            def do_DELETE(self):
+                mock.handle(self, 'DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name='mock-adafruit-io', daemon=True).start()
+
+    def _group(self, key):
+        # Feeds outside the default group are listed as <group>.<feed>
+        return {'key': key, 'name': key,
+                'feeds': [{'key': f"{key}.{feed}", 'name': feed} for feed in sorted(self.groups[key])]}
+
+    def handle(self, request, method):
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length) or b'null') if length else None
+        # /api/v2/<username>/<path...> (the client sometimes doubles the slash)
+        parts = [part for part in request.path.split('?')[0].split('/') if part][3:]
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.requests += 1
+            status, response = self._route(method, parts, body)
+
+        data = json.dumps(response).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def _route(self, method, parts, body):
+        not_found = (404, {'error': 'not found'})
+
+        if parts[:1] == ['groups']:
+            if len(parts) == 1 and method == 'POST':
+                self.groups.setdefault(body['key'], set())
+                return 200, self._group(body['key'])
+            if len(parts) == 1:
+                return 200, [self._group(key) for key in sorted(self.groups)]
+            key = parts[1] if len(parts) > 1 else None
+            if key not in self.groups:
+                return not_found
+            if len(parts) == 2:
+                return 200, self._group(key)
+            if parts[2] == 'feeds' and method == 'POST':
+                feed = body['feed']['key']
+                self.feeds.add(feed)
+                self.groups[key].add(feed)
+                return 200, {'key': feed, 'name': feed}
+            if parts[2] == 'add':
+                self.groups[key].add(body['feed_key'])
+                return 200, self._group(key)
+            if parts[2] == 'data':
+                if any(feed['key'] not in self.groups[key] for feed in body['feeds']):
+                    return not_found
+                self.points += len(body['feeds'])
+                return 200, [{'key': feed['key'], 'value': feed['value']} for feed in body['feeds']]
+
+        if parts[:1] == ['feeds']:
+            if len(parts) == 1:
+                if method == 'POST':
+                    feed = body['feed']['key']
+                    self.feeds.add(feed)
+                    return 200, {'key': feed, 'name': feed}
+                return 200, [{'key': feed, 'name': feed} for feed in sorted(self.feeds)]
+            if method == 'DELETE' and len(parts) == 2:
+                if parts[1] not in self.feeds:
+                    return not_found
+                self.feeds.discard(parts[1])
+                for feeds in self.groups.values():
+                    feeds.discard(parts[1])
+                return 200, {}
+            self.feeds.add(parts[1])
+            if parts[2:] == ['data']:
+                self.points += 1
+                return 200, dict(body, id='0', feed_key=parts[1])
+            if parts[2:] == ['data', 'batch']:
+                self.points += len(body['data'])
+                return 200, [dict(item, id='0', feed_key=parts[1]) for item in body['data']]
+
+        return not_found
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ============================================
+# Minimal MQTT broker stand-in
+# ============================================
+
+def _read_varint(read):
+    multiplier, value = 1, 0
+    while True:
+        byte = read(1)[0]
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value
+        multiplier *= 128
+
+
+def _split_varint(data, offset):
+    multiplier, value = 1, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, offset
+        multiplier *= 128
+
+
+class MockMQTTBroker:
+    """Accepts connections, acknowledges QoS 1 publishes and subscriptions
+
+    Messages are counted and thrown away; nothing is ever delivered to
+    subscribers. Handles MQTT 3.1.1 and 5.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = 0
+        self._lock = threading.Lock()
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    broker.serve(self.request)
+                except (ConnectionError, IndexError, OSError):
+                    pass
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='mock-mqtt', daemon=True).start()
+
+    def serve(self, sock):
+        stream = sock.makefile('rb')
+
+        def read(n):
+            data = stream.read(n)
+            if len(data) < n:
+                raise ConnectionError("client went away")
+            return data
+
+        version = 4
+        while True:
+            header = read(1)[0]
+            packet = read(_read_varint(read))
+            kind = header >> 4
+
+            if kind == 1:  # CONNECT: protocol name, then the level
+                name_length = struct.unpack_from('>H', packet)[0]
+                version = packet[2 + name_length]
+                sock.sendall(b'\x20\x03\x00\x00\x00' if version == 5 else b'\x20\x02\x00\x00')
+            elif kind == 3:  # PUBLISH
+                with self._lock:
+                    self.messages += 1
+                qos = (header >> 1) & 0x03
+                if qos:
+                    topic_length = struct.unpack_from('>H', packet)[0]
+                    packet_id = packet[2 + topic_length:4 + topic_length]
+                    if self.latency:
+                        time.sleep(self.latency)
+                    sock.sendall((b'\x40\x02' if qos == 1 else b'\x50\x02') + packet_id)
+            elif kind == 6:  # PUBREL (QoS 2)
+                sock.sendall(b'\x70\x02' + packet[:2])
+            elif kind == 8:  # SUBSCRIBE: grant every filter at QoS 1
+                offset = 2
+                if version == 5:
+                    properties, offset = _split_varint(packet, offset)
+                    offset += properties
+                filters = 0
+                while offset < len(packet):
+                    offset += 2 + struct.unpack_from('>H', packet, offset)[0] + 1
+                    filters += 1
+                body = packet[:2] + (b'\x00' if version == 5 else b'') + b'\x01' * filters
+                sock.sendall(bytes([0x90, len(body)]) + body)
+            elif kind == 12:  # PINGREQ
+                sock.sendall(b'\xd0\x00')
+            elif kind == 14:  # DISCONNECT
+                return
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ============================================
+# Benchmark
+# ============================================
+
+def timed(function, iterations):
+    """Call `function` repeatedly; returns (durations, calls that returned a falsy value)"""
+    samples = []
+    failures = 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        if not function():
+            failures += 1
+        samples.append(time.perf_counter() - started)
+    return samples, failures
+
+
+def parse_importtime(stderr):
+    """Top-level imports from -X importtime output as {module: cumulative seconds}"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2]
+        # Nested imports are indented by two spaces per level
+        if name.startswith(' ') and not name.startswith('   '):
+            modules[name.strip()] = int(fields[1]) / 1e6
+    return modules
+
+
+def measure_cold_start(runs):
+    """Run publish_to_adafruit.py once per run, like cron does, timing the whole process"""
+    durations = []
+    failures = 0
+    imports = {}
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', str(script_dir / 'publish_to_adafruit.py')],
+                                capture_output=True, text=True)
+        durations.append(time.perf_counter() - started)
+        if result.returncode != 0:
+            failures += 1
+        for module, seconds in parse_importtime(result.stderr).items():
+            imports.setdefault(module, []).append(seconds)
+
+    summary = summarize(durations, failures)
+    import_total = sum(percentile(times, 50) for times in imports.values())
+    summary['imports_ms'] = round(import_total * 1000, 3)
+    heaviest = sorted(imports.items(), key=lambda item: percentile(item[1], 50), reverse=True)[:10]
+    summary['heaviest_imports_ms'] = {module: round(percentile(times, 50) * 1000, 3) for module, times in heaviest}
+    return summary
+
+
+def measure_broker_reads(state_dir, iterations):
+    """Latency of reading the latest values from a running sensor broker"""
+    from hardware import get_backend
+    from sensor_scheduler import SensorScheduler
+    from sensor_broker import SensorBroker, BrokerClient
+
+    broker = SensorBroker(SensorScheduler(get_backend()), os.path.join(state_dir, 'sensors.sock'))
+    broker.sample()
+    broker.start()
+    try:
+        return summarize(*timed(BrokerClient(broker.socket_path).read, iterations))
+    finally:
+        broker.close()
+
+
+def run_benchmark(args):
+    adafruit = MockAdafruitIO(latency=args.service_latency)
+    broker = MockMQTTBroker(latency=args.service_latency)
+    state_dir = tempfile.mkdtemp(prefix='enviro-benchmark-')
+
+    # Set before the import so these win over anything in .env
+    os.environ.update({
+        'ENVIRO_BACKEND': 'fake',
+        'FAKE_SENSOR_LATENCY': str(args.sensor_latency),
+        'FAKE_SENSOR_FAULT_RATE': '0',
+        'STATE_DIR': state_dir,
+        'LOG_FILE': os.path.join(state_dir, 'sensor_log.txt'),
+        'HISTORY_DIR': os.path.join(state_dir, 'history'),
+        'TIMINGS_FILE': os.path.join(state_dir, 'timings.json'),
+        # Read the simulated sensors directly even if a broker is running here
+        'SENSOR_SOCKET': '',
+        'ENABLE_ADAFRUIT_IO': 'true',
+        'ENABLE_HOMEASSISTANT': 'true',
+        'ADAFRUIT_IO_USERNAME': 'benchmark',
+        'ADAFRUIT_IO_KEY': 'benchmark',
+        'ADAFRUIT_IO_BASE_URL': adafruit.url,
+        # Measure the publish path, not the free-tier rate limit
+        'ADAFRUIT_IO_RATE_LIMIT': '1000000',
+        'ADAFRUIT_IO_BURST': '1000',
+        'MQTT_BROKER': '127.0.0.1',
+        'MQTT_PORT': str(broker.port),
+        'MQTT_USERNAME': 'benchmark',
+        'MQTT_PASSWORD': 'benchmark',
+        'CSV_FILE': '',
+        'NDJSON_FILE': '',
+        'INFLUXDB_URL': '',
+        'INFLUXDB_UDP': '',
+        'METRICS_PORT': '0',
+    })
+
+    cold_start = measure_cold_start(args.startup_runs) if args.startup_runs else None
+
+    started = time.perf_counter()
+    publisher = importlib.import_module('publish_to_adafruit')
+    import_seconds = time.perf_counter() - started
+    # The publisher logs every step at INFO; only problems matter here
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sensors = publisher.read_sensors(quiet=True)
+    if not sensors:
+        raise RuntimeError("Reading the simulated sensors failed")
+
+    # Warm up: connections, feed group creation, discovery configs
+    publisher.publish_to_adafruit(sensors)
+    publisher.publish_to_homeassistant(sensors)
+
+    results = {
+        'import': {'seconds': round(import_seconds, 4)},
+        'read_sensors': summarize(*timed(lambda: publisher.read_sensors(quiet=True), args.iterations)),
+        'read_broker': measure_broker_reads(state_dir, args.iterations),
+        'publish_adafruit_io': summarize(*timed(lambda: publisher.publish_to_adafruit(sensors), args.iterations)),
+        'publish_homeassistant': summarize(*timed(lambda: publisher.publish_to_homeassistant(sensors), args.iterations)),
+    }
+
+    cycles, failures = timed(publisher.run_cycle, args.iterations)
+    results['cycle'] = summarize(cycles, failures)
+    results['cycle']['per_second'] = round(len(cycles) / sum(cycles), 2)
+    if cold_start:
+        results['cold_start'] = cold_start
+
+    publisher.close_pipeline()
+    publisher.close_mqtt_client()
+    publisher.close_history()
+
+    # The publisher's own per-stage breakdown of everything above
+    results['stages'] = publisher._timings.snapshot()
+    results['mock_services'] = {
+        'adafruit_io_requests': adafruit.requests,
+        'adafruit_io_points': adafruit.points,
+        'mqtt_messages': broker.messages,
+    }
+    adafruit.close()
+    broker.close()
+    return results
+
+
+def find_regressions(results, baseline, tolerance, slack_ms):
+    """Compare p50 latencies and throughput with the baseline
+
+    A latency regresses when it is more than `tolerance` (a fraction) and
+    `slack_ms` slower than the baseline; throughput when it drops by more
+    than `tolerance`. Any failed call is a regression too.
+    """
+    regressions = []
+    for name, stats in results.items():
+        if stats.get('failures'):
+            regressions.append(f"{name}: {stats['failures']} of {stats['samples']} calls failed")
+        before = baseline.get(name)
+        if not before:
+            continue
+        if 'p50_ms' in stats and 'p50_ms' in before:
+            limit = max(before['p50_ms'] * (1 + tolerance), before['p50_ms'] + slack_ms)
+            if stats['p50_ms'] > limit:
+                regressions.append(f"{name}: p50 {stats['p50_ms']:.2f} ms (baseline {before['p50_ms']:.2f} ms)")
+        if 'per_second' in stats and 'per_second' in before:
+            if stats['per_second'] < before['per_second'] * (1 - tolerance):
+                regressions.append(f"{name}: {stats['per_second']:.2f}/s (baseline {before['per_second']:.2f}/s)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Enviro+ read and publish path against local mocks")
+    parser.add_argument('--iterations', type=int, default=50, help="runs of each measurement (default: 50)")
+    parser.add_argument('--sensor-latency', type=float, default=0.0,
+                        help="simulated seconds per sensor call (default: 0)")
+    parser.add_argument('--service-latency', type=float, default=0.0,
+                        help="simulated seconds per Adafruit IO request / MQTT ack (default: 0)")
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help="cold-start runs of the whole script (default: 5, 0 to skip)")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    parser.add_argument('--baseline', default=str(DEFAULT_BASELINE),
+                        help="baseline file for --check and --save-baseline (default: ./benchmark_baseline.json)")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--check', action='store_true', help="exit 1 if any result regressed against the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown as a fraction of the baseline (default: 0.25)")
+    parser.add_argument('--slack-ms', type=float, default=2.0,
+                        help="latency differences below this are never a regression (default: 2)")
+    args = parser.parse_args()
+
+    if args.iterations < 1:
+        parser.error("--iterations must be at least 1")
+
+    results = run_benchmark(args)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + '\n')
+
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=2) + '\n')
+        print(f"Saved baseline to {args.baseline}")
+
+    if args.check:
+        if not Path(args.baseline).exists():
+            print(f"No baseline at {args.baseline} - skipping the check (record one with --save-baseline)")
+            return
+        try:
+            baseline = json.loads(Path(args.baseline).read_text())
+        except (OSError, ValueError) as e:
+            print(f"Can't read baseline {args.baseline}: {e}")
+            sys.exit(2)
+        regressions = find_regressions(results, baseline, args.tolerance, args.slack_ms)
+        if regressions:
+            print("Performance regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""
+Fit the temperature compensation from recorded samples
+Usage:
+  ./calibrate.py record                          # Log raw samples every 60 seconds
+  ./calibrate.py record --reference 21.4 --count 1   # One sample with a thermometer reading
+  ./calibrate.py fit                             # Fit every model, save the best
+  ./calibrate.py fit --reference reference.csv --model offset --dry-run
+  ./calibrate.py replay                          # Apply the saved calibration to all samples
+
+Samples are CSV rows of time, raw_temperature, cpu_temperature, humidity
+and reference (a reference thermometer reading, nan when there isn't one).
+Reference readings can also come from a separate CSV of time,temperature
+(e.g. exported from another sensor), matched to the nearest sample.
+
+`fit` solves each model in compensation.MODELS by least squares on the
+older part of the data, scores it on the newest part (--holdout), refits
+the best on everything and saves it where the publisher, display and
+read_sensors.py pick it up (see compensation.py). `replay` runs the whole
+recording through a calibration to show what it would have published.
+"""
+
+import os
+import sys
+import csv
+import time
+import argparse
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from compensation import MODELS, Compensation, features, load_compensation, default_calibration_file
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=Path(__file__).parent.absolute() / '.env')
+except ImportError:
+    pass
+
+STATE_DIR = Path(os.getenv('STATE_DIR', str(Path(__file__).parent.absolute())))
+DEFAULT_SAMPLES = STATE_DIR / 'calibration_samples.csv'
+TEMP_COMPENSATION_FACTOR = float(os.getenv('TEMP_COMPENSATION_FACTOR', '0'))
+
+COLUMNS = ('time', 'raw_temperature', 'cpu_temperature', 'humidity', 'reference')
+
+
+def load_samples(path):
+    """{column: array} from a samples CSV (plain or .gz)"""
+    opener = open
+    if str(path).endswith('.gz'):
+        import gzip
+        opener = gzip.open
+    with opener(path, 'rt') as f:
+        header = f.readline().strip().split(',')
+        missing = [column for column in COLUMNS[:4] if column not in header]
+        if missing:
+            raise ValueError(f"{path} is missing column(s) {', '.join(missing)}")
+        with warnings.catch_warnings():
+            # Just the header is normal right after recording is switched on
+            warnings.filterwarnings('ignore', message='.*input contained no data')
+            table = np.loadtxt(f, delimiter=',', ndmin=2)
+    if not table.size:
+        table = np.empty((0, len(header)))
+    samples = {column: table[:, header.index(column)] for column in header if column in COLUMNS}
+    samples.setdefault('reference', np.full(len(table), np.nan))
+    return samples
+
+
+def match_reference(samples, path, max_gap):
+    """Fill `reference` from a time,temperature CSV: the nearest reading
+    within `max_gap` seconds of each sample"""
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='.*input contained no data')
+        table = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(0, 1), ndmin=2)
+    if len(table) < 2:
+        raise ValueError(f"{path} needs at least 2 reference readings")
+    table = table[np.argsort(table[:, 0])]
+    times, temperatures = table[:, 0], table[:, 1]
+
+    sample_times = samples['time']
+    right = np.clip(np.searchsorted(times, sample_times), 1, len(times) - 1)
+    left = right - 1
+    nearest = np.where(np.abs(times[left] - sample_times) <= np.abs(times[right] - sample_times), left, right)
+    close = np.abs(times[nearest] - sample_times) <= max_gap
+    samples['reference'] = np.where(close, temperatures[nearest], samples['reference'])
+    return int(close.sum())
+
+
+def design_matrix(model, samples):
+    values = features(samples['raw_temperature'], samples['cpu_temperature'], samples['humidity'])
+    ones = np.ones_like(samples['raw_temperature'])
+    return np.column_stack([values[name] * ones for name in MODELS[model]])
+
+
+def fit_model(model, samples):
+    """Least-squares coefficients for `model` (raw - reference = X @ coefficients)"""
+    target = samples['raw_temperature'] - samples['reference']
+    coefficients, *_ = np.linalg.lstsq(design_matrix(model, samples), target, rcond=None)
+    return Compensation(model, dict(zip(MODELS[model], coefficients)))
+
+
+def errors(compensation, samples):
+    """rmse, mean absolute and max absolute error against the reference"""
+    residual = compensation.correct(samples['raw_temperature'], samples['cpu_temperature'],
+                                    samples['humidity']) - samples['reference']
+    if not len(residual):
+        return {'rmse': float('nan'), 'mae': float('nan'), 'max': float('nan')}
+    return {
+        'rmse': float(np.sqrt(np.mean(residual ** 2))),
+        'mae': float(np.mean(np.abs(residual))),
+        'max': float(np.max(np.abs(residual))),
+    }
+
+
+def subset(samples, mask):
+    return {column: values[mask] for column, values in samples.items()}
+
+
+def cmd_record(args):
+    from sensor_broker import open_sensors
+
+    sensors = open_sensors()
+    new_file = not os.path.exists(args.samples)
+    taken = 0
+    with open(args.samples, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(COLUMNS)
+        while True:
+            readings = sensors.read()
+            if readings.get('cpu_temperature') is None or 'raw_temperature' not in readings:
+                print("No BME280/CPU temperature this time - skipping")
+            else:
+                writer.writerow([round(time.time(), 1), readings['raw_temperature'], readings['cpu_temperature'],
+                                 readings['humidity'], args.reference if args.reference is not None else 'nan'])
+                f.flush()
+                taken += 1
+                print(f"Sample {taken}: raw {readings['raw_temperature']:.2f} °C, "
+                      f"CPU {readings['cpu_temperature']:.2f} °C, humidity {readings['humidity']:.1f} %")
+            if args.count and taken >= args.count:
+                break
+            time.sleep(args.interval)
+
+
+def require_samples(samples, path):
+    if not len(samples['time']):
+        print(f"No samples in {path} yet - record some first (./calibrate.py record)")
+        sys.exit(1)
+
+
+def cmd_fit(args):
+    started = time.perf_counter()
+    samples = load_samples(args.samples)
+    require_samples(samples, args.samples)
+    if args.reference:
+        matched = match_reference(samples, args.reference, args.max_gap)
+        print(f"Matched {matched} reference reading(s) from {args.reference}")
+
+    usable = np.isfinite(samples['reference']) & np.isfinite(samples['raw_temperature']) \
+        & np.isfinite(samples['cpu_temperature']) & np.isfinite(samples['humidity'])
+    samples = subset(samples, usable)
+    count = len(samples['time'])
+    if count < 10:
+        print(f"Only {count} sample(s) with a reference reading - record at least 10 (see --reference)")
+        sys.exit(1)
+
+    # Score on the newest samples, so a model has to hold up over time
+    order = np.argsort(samples['time'])
+    samples = subset(samples, order)
+    split = int(count * (1 - args.holdout)) if count * args.holdout >= 1 else count
+    training = subset(samples, slice(0, split))
+    validation = subset(samples, slice(split, None)) if split < count else training
+
+    print(f"{count} samples, fitting on {split} and scoring on {len(validation['time'])}\n")
+    print(f"{'model':<10} {'rmse':>7} {'mae':>7} {'max':>7}  coefficients")
+
+    current = load_compensation(args.calibration, TEMP_COMPENSATION_FACTOR)
+    score = errors(current, validation)
+    print(f"{'current':<10} {score['rmse']:7.3f} {score['mae']:7.3f} {score['max']:7.3f}  {current.describe()}")
+
+    scores = {}
+    for model in MODELS:
+        if args.model and model != args.model:
+            continue
+        fitted = fit_model(model, training)
+        scores[model] = errors(fitted, validation)
+        print(f"{model:<10} {scores[model]['rmse']:7.3f} {scores[model]['mae']:7.3f} "
+              f"{scores[model]['max']:7.3f}  {fitted.describe()}")
+
+    best = min(scores, key=lambda model: scores[model]['rmse'])
+    chosen = fit_model(best, samples)
+    chosen.details = {
+        'fitted_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'samples': count,
+        'validation': {key: round(value, 4) for key, value in scores[best].items()},
+    }
+    print(f"\nBest: {chosen.describe()} (validation rmse {scores[best]['rmse']:.3f} °C), "
+          f"fitted in {time.perf_counter() - started:.2f}s")
+
+    if args.dry_run:
+        print("Dry run - calibration not saved")
+        return
+    chosen.save(args.calibration)
+    print(f"Saved to {args.calibration}; restart enviro-display/enviro-publisher to pick it up")
+
+
+def cmd_replay(args):
+    started = time.perf_counter()
+    samples = load_samples(args.samples)
+    require_samples(samples, args.samples)
+    compensation = load_compensation(args.calibration, TEMP_COMPENSATION_FACTOR)
+    corrected = compensation.correct(samples['raw_temperature'], samples['cpu_temperature'], samples['humidity'])
+    corrected = np.broadcast_to(corrected, samples['raw_temperature'].shape)
+    elapsed = time.perf_counter() - started
+
+    count = len(corrected)
+    print(f"Replayed {count} samples through {compensation.describe()} in {elapsed:.2f}s")
+    if count:
+        offset = samples['raw_temperature'] - corrected
+        print(f"  Compensated temperature: {np.nanmin(corrected):.2f} to {np.nanmax(corrected):.2f} °C, "
+              f"mean {np.nanmean(corrected):.2f} °C")
+        print(f"  Correction: mean {np.nanmean(offset):.2f} °C, up to {np.nanmax(offset):.2f} °C")
+        with_reference = np.isfinite(samples['reference'])
+        if with_reference.any():
+            score = errors(compensation, subset(samples, with_reference))
+            print(f"  Against {int(with_reference.sum())} reference reading(s): rmse {score['rmse']:.3f}, "
+                  f"mae {score['mae']:.3f}, max {score['max']:.3f} °C")
+
+    if args.output:
+        np.savetxt(args.output, np.column_stack([samples['time'], samples['raw_temperature'], corrected]),
+                   delimiter=',', header='time,raw_temperature,temperature', comments='', fmt='%.3f')
+        print(f"Wrote {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record samples and fit the Enviro+ temperature compensation")
+    parser.add_argument('--samples', default=str(DEFAULT_SAMPLES),
+                        help=f"samples CSV (default: {DEFAULT_SAMPLES.name} in STATE_DIR)")
+    parser.add_argument('--calibration', default=default_calibration_file(),
+                        help="calibration file (default: CALIBRATION_FILE or calibration.json in STATE_DIR)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record = commands.add_parser('record', help="append raw samples from the sensors")
+    record.add_argument('--interval', type=float, default=60, help="seconds between samples (default: 60)")
+    record.add_argument('--count', type=int, default=0, help="stop after this many samples (default: run until Ctrl+C)")
+    record.add_argument('--reference', type=float, help="reference thermometer reading to store with the samples")
+    record.set_defaults(run=cmd_record)
+
+    fit = commands.add_parser('fit', help="fit the compensation models and save the best")
+    fit.add_argument('--reference', help="CSV of time,temperature reference readings to match to the samples")
+    fit.add_argument('--max-gap', type=float, default=300,
+                     help="furthest a reference reading may be from a sample, in seconds (default: 300)")
+    fit.add_argument('--model', choices=list(MODELS), help="only fit this model")
+    fit.add_argument('--holdout', type=float, default=0.2,
+                     help="newest fraction of samples kept back for scoring (default: 0.2)")
+    fit.add_argument('--dry-run', action='store_true', help="show the results without saving")
+    fit.set_defaults(run=cmd_fit)
+
+    replay = commands.add_parser('replay', help="apply a calibration to every recorded sample")
+    replay.add_argument('--output', help="write time,raw_temperature,temperature CSV here")
+    replay.set_defaults(run=cmd_replay)
+
+    args = parser.parse_args()
+    if args.command == 'fit' and not 0 <= args.holdout < 1:
+        parser.error("--holdout must be between 0 and 1")
+    try:
+        args.run(args)
+    except KeyboardInterrupt:
+        print("\nStopped")
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
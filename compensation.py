@@ -0,0 +1,112 @@
+"""
+Temperature compensation for the heat of the Raspberry Pi CPU
+
+The BME280 sits close to the CPU, so its raw temperature reads high. The
+correction is a linear model of the CPU-to-sensor temperature difference
+and, optionally, the raw temperature, humidity and a constant:
+
+    temperature = raw - sum(coefficient * feature)
+
+MODELS lists the features each model uses. The original compensation,
+raw - (cpu - raw) / TEMP_COMPENSATION_FACTOR, is the 'factor' model with a
+cpu_delta coefficient of 1 / factor. calibrate.py fits the coefficients
+from recorded samples and saves them to the calibration file, which takes
+precedence over TEMP_COMPENSATION_FACTOR wherever readings are compensated.
+
+Only arithmetic is used, so correct() works on NumPy arrays as well as on
+single values.
+"""
+
+import os
+import json
+import logging
+from pathlib import Path
+
+MODELS = {
+    # raw - k * (cpu - raw): TEMP_COMPENSATION_FACTOR with k = 1 / factor
+    'factor': ('cpu_delta',),
+    # ... plus a fixed offset
+    'offset': ('cpu_delta', 'one'),
+    # ... plus terms for the raw temperature and the humidity
+    'full': ('cpu_delta', 'raw', 'humidity', 'one'),
+}
+
+CALIBRATION_FILENAME = 'calibration.json'
+
+
+def default_calibration_file():
+    """CALIBRATION_FILE, or calibration.json in STATE_DIR (default: next to the scripts)"""
+    state_dir = os.getenv('STATE_DIR', str(Path(__file__).parent.absolute()))
+    return os.getenv('CALIBRATION_FILE', str(Path(state_dir) / CALIBRATION_FILENAME))
+
+
+def features(raw_temperature, cpu_temperature, humidity=0.0):
+    return {
+        'cpu_delta': cpu_temperature - raw_temperature,
+        'raw': raw_temperature,
+        'humidity': humidity,
+        'one': 1.0,
+    }
+
+
+class Compensation:
+    """A fitted (or configured) temperature correction"""
+
+    def __init__(self, model, coefficients, details=None):
+        if model not in MODELS:
+            raise ValueError(f"Unknown compensation model {model!r} (use one of {', '.join(MODELS)})")
+        self.model = model
+        self.coefficients = {name: float(coefficients.get(name, 0.0)) for name in MODELS[model]}
+        self.details = dict(details or {})
+
+    @classmethod
+    def from_factor(cls, factor):
+        """The original TEMP_COMPENSATION_FACTOR compensation (0 = none)"""
+        return cls('factor', {'cpu_delta': 1.0 / factor if factor > 0 else 0.0})
+
+    @property
+    def enabled(self):
+        return any(self.coefficients.values())
+
+    def correct(self, raw_temperature, cpu_temperature, humidity=None):
+        """Compensated temperature; the raw one if the CPU temperature is unknown"""
+        if cpu_temperature is None or not self.enabled:
+            return raw_temperature
+        values = features(raw_temperature, cpu_temperature, 0.0 if humidity is None else humidity)
+        return raw_temperature - sum(coefficient * values[name] for name, coefficient in self.coefficients.items())
+
+    def describe(self):
+        if not self.enabled:
+            return "none"
+        if self.model == 'factor':
+            return f"factor {1 / self.coefficients['cpu_delta']:.3f}"
+        terms = ", ".join(f"{name}={value:.4g}" for name, value in self.coefficients.items())
+        return f"{self.model} ({terms})"
+
+    def to_dict(self):
+        return dict(self.details, model=self.model, coefficients=self.coefficients)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def load_compensation(path=None, factor=0.0):
+    """The calibration saved by calibrate.py, or the `factor` compensation
+
+    `path` defaults to default_calibration_file(). An unreadable file is
+    logged and ignored.
+    """
+    path = path or default_calibration_file()
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        details = {key: value for key, value in saved.items() if key not in ('model', 'coefficients')}
+        return Compensation(saved['model'], saved['coefficients'], details)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.error(f"Ignoring unreadable calibration {path}: {e}")
+    return Compensation.from_factor(factor)
@@ -0,0 +1,99 @@
+"""
+Deadband and heartbeat filtering of published values
+
+A sensor's value is only sent to a service when it has moved by at least its
+deadband since the value last sent there, or when nothing has been sent for
+the heartbeat interval. Last-sent values are kept per service in a JSON
+state file, so cron runs compare against what the previous run sent.
+"""
+
+import os
+import json
+import logging
+import threading
+
+
+def parse_thresholds(spec):
+    """Parse "temperature=0.1,light=5%" into {sensor: (amount, is_percent)}"""
+    thresholds = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        sensor, sep, amount = item.partition('=')
+        if not sep:
+            raise ValueError(f"Deadband {item!r} should look like sensor=amount or sensor=amount%")
+        amount = amount.strip()
+        percent = amount.endswith('%')
+        thresholds[sensor.strip()] = (float(amount.rstrip('%')), percent)
+    return thresholds
+
+
+class Deadband:
+    """Decides which values are worth sending to each service"""
+
+    def __init__(self, thresholds, heartbeat, state_file=None):
+        self.thresholds = dict(thresholds)
+        self.heartbeat = heartbeat
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        # {service: {sensor: [value, sent_at]}}
+        self._sent = self._load()
+
+    def _load(self):
+        if not self.state_file:
+            return {}
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable deadband state {self.state_file}: {e}")
+            return {}
+
+    def _save(self):
+        if not self.state_file:
+            return
+        tmp_path = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._sent, f)
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logging.error(f"Failed to save deadband state {self.state_file}: {e}")
+
+    def _changed(self, sensor, value, last_value):
+        threshold = self.thresholds.get(sensor)
+        if threshold is None:
+            # No deadband configured: always send
+            return True
+        amount, percent = threshold
+        if percent:
+            # Strictly more than the share of the last value, so a value
+            # sitting at 0 (light at night) doesn't count as a change every time
+            return abs(value - last_value) > abs(last_value) * amount / 100
+        return abs(value - last_value) >= amount
+
+    def filter(self, service, sensors, now):
+        """Return the subset of `sensors` that should be sent to `service`"""
+        with self._lock:
+            sent = self._sent.get(service, {})
+            due = {}
+            for sensor, value in sensors.items():
+                last = sent.get(sensor)
+                if (last is None
+                        or now - last[1] >= self.heartbeat
+                        or self._changed(sensor, value, last[0])):
+                    due[sensor] = value
+        return due
+
+    def commit(self, service, sensors, now):
+        """Record that `sensors` reached `service`"""
+        if not sensors:
+            return
+        with self._lock:
+            sent = self._sent.setdefault(service, {})
+            for sensor, value in sensors.items():
+                sent[sensor] = [value, now]
+            self._save()
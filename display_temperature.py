@@ -1,39 +1,29 @@
 #!/usr/bin/env python3
 
 """
-Display temperature readings on the Enviro+ LCD screen
-Shows both raw and compensated temperature for calibration
+Display sensor readings on the Enviro+ LCD screen
+Cycles through a page per sensor, showing a rolling average of each
 Press Ctrl+C to exit
+
+The background and title of every page and each character of the large
+font are drawn once at startup; a frame is just pastes into a reused
+buffer, and it's only sent over SPI when the text on screen changes.
+
+Readings come from the sensor broker when it's running (sensor_broker.py),
+so the display doesn't compete with the publisher for the I2C bus.
 """
 
+import math
 import time
-from bme280 import BME280
-from smbus2 import SMBus
+import signal
+from collections import deque
 from PIL import Image, ImageDraw, ImageFont
-import st7735
-
-# Initialize display
-disp = st7735.ST7735(
-    port=0,
-    cs=1,
-    dc=9,
-    backlight=12,
-    rotation=270,
-    spi_speed_hz=10000000
-)
-
-# Initialize display
-disp.begin()
-
-# Display dimensions
-WIDTH = disp.width
-HEIGHT = disp.height
-
-# Initialize BME280 sensor
-bus = SMBus(1)
-bme280 = BME280(i2c_dev=bus)
+from hardware import get_backend
+from sensor_broker import open_sensors
+from compensation import load_compensation
 
 # Load environment variables for temperature compensation factor
+# (and ENVIRO_BACKEND, so the hardware below comes from the right place)
 try:
     from dotenv import load_dotenv
     from pathlib import Path
@@ -42,83 +32,181 @@ try:
     env_path = script_dir / '.env'
     load_dotenv(dotenv_path=env_path)
     TEMP_COMPENSATION_FACTOR = float(os.getenv('TEMP_COMPENSATION_FACTOR', '0'))
+    # Seconds between sensor reads, seconds each page is shown, and how many
+    # reads the rolling average covers
+    DISPLAY_READ_INTERVAL = float(os.getenv('DISPLAY_READ_INTERVAL', '10'))
+    DISPLAY_PAGE_SECONDS = float(os.getenv('DISPLAY_PAGE_SECONDS', '5'))
+    DISPLAY_AVERAGE_READINGS = int(os.getenv('DISPLAY_AVERAGE_READINGS', '10'))
+    # Which pages to cycle through (comma-separated keys, empty = all)
+    DISPLAY_PAGES = os.getenv('DISPLAY_PAGES', '')
 except:
     TEMP_COMPENSATION_FACTOR = 0
+    DISPLAY_READ_INTERVAL = 10
+    DISPLAY_PAGE_SECONDS = 5
+    DISPLAY_AVERAGE_READINGS = 10
+    DISPLAY_PAGES = ''
 
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
 
-def get_cpu_temperature():
-    """Get CPU temperature for BME280 compensation"""
-    with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-        temp = f.read()
-        temp = int(temp) / 1000.0
-    return temp
+# (reading key, title, value format, value colour)
+PAGES = [
+    ('temperature', "Temperature °C", "{:.1f}", (100, 255, 100)),
+    ('pressure', "Pressure hPa", "{:.0f}", (100, 200, 255)),
+    ('humidity', "Humidity %", "{:.1f}", (100, 200, 255)),
+    ('light', "Light lux", "{:.0f}", (255, 255, 100)),
+    ('proximity', "Proximity", "{:.0f}", (255, 255, 100)),
+    ('oxidising', "Oxidising kΩ", "{:.1f}", (255, 150, 100)),
+    ('reducing', "Reducing kΩ", "{:.0f}", (255, 150, 100)),
+    ('nh3', "NH3 kΩ", "{:.0f}", (255, 150, 100)),
+]
 
 
-def main():
-    print("Starting temperature display...")
-    print("Press Ctrl+C to exit")
+class RollingMean:
+    """Mean of the last `size` values, updated in O(1)"""
 
-    # Try to load a font
-    try:
-        # Large font for single compensated temperature
-        font_temp = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 40)
-    except:
-        print("Warning: Could not load TrueType font, using default")
-        font_temp = ImageFont.load_default()
+    def __init__(self, size):
+        self.values = deque(maxlen=max(1, size))
+        self.total = 0.0
 
-    # Rolling average - keep last 10 readings (20 seconds)
-    temp_readings = []
-    max_readings = 10
+    def add(self, value):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
 
-    try:
-        while True:
-            # Discard first reading (BME280 returns stale data)
-            _ = bme280.get_temperature()
-            time.sleep(0.1)
+    @property
+    def mean(self):
+        return self.total / len(self.values) if self.values else None
 
-            # Get readings
-            cpu_temp = get_cpu_temperature()
-            raw_temp = bme280.get_temperature()
 
-            # Calculate compensated temperature
-            if TEMP_COMPENSATION_FACTOR > 0:
-                compensation_amount = (cpu_temp - raw_temp) / TEMP_COMPENSATION_FACTOR
-                comp_temp = raw_temp - compensation_amount
-            else:
-                comp_temp = raw_temp
+def load_font(size):
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except:
+        print("Warning: Could not load TrueType font, using default")
+        return ImageFont.load_default()
+
+
+class PageRenderer:
+    """Pre-rendered page backgrounds and value glyphs composed into one frame"""
+
+    def __init__(self, pages, width, height, title_font, value_font):
+        self.pages = pages
+        self.width = width
+        self.height = height
+        self.value_font = value_font
+        self.value_top = height // 4 + 2
+        self.frame = Image.new('RGB', (width, height))
+        self.blank = Image.new('RGB', (width, height), color=(0, 0, 0))
+
+        self.backgrounds = []
+        for _, title, _, _ in pages:
+            background = Image.new('RGB', (width, height), color=(0, 0, 0))
+            ImageDraw.Draw(background).text((10, 2), title, font=title_font, fill=(180, 180, 180))
+            self.backgrounds.append(background)
+
+        # One greyscale mask per character, used to stamp the value in any colour
+        self.glyphs = {}
+        bottom = value_font.getbbox("0123456789")[3]
+        for char in "0123456789.-?":
+            width_px = max(1, math.ceil(value_font.getlength(char)))
+            mask = Image.new('L', (width_px, bottom))
+            ImageDraw.Draw(mask).text((0, 0), char, font=value_font, fill=255)
+            self.glyphs[char] = mask
+
+    def render(self, page, text):
+        colour = self.pages[page][3]
+        self.frame.paste(self.backgrounds[page])
+        x = 10
+        for char in text:
+            glyph = self.glyphs.get(char) or self.glyphs['?']
+            self.frame.paste(colour, (x, self.value_top, x + glyph.width, self.value_top + glyph.height), glyph)
+            x += glyph.width
+        return self.frame
+
+
+def compensated(readings, compensation):
+    """Sensor values in the units shown, with the CPU heat compensation applied"""
+    raw_temp = readings.get('raw_temperature')
+    values = {}
+    if raw_temp is not None:
+        values['temperature'] = compensation.correct(raw_temp, readings['cpu_temperature'], readings['humidity'])
+        values['pressure'] = readings['pressure']
+        values['humidity'] = readings['humidity']
+    if 'lux' in readings:
+        values['light'] = readings['lux']
+    if 'proximity' in readings:
+        values['proximity'] = readings['proximity']
+    for channel in ('oxidising', 'reducing', 'nh3'):
+        if f'gas_{channel}_ohms' in readings:
+            values[channel] = readings[f'gas_{channel}_ohms'] / 1000
+    return values
 
-            # Add to rolling average
-            temp_readings.append(comp_temp)
-            if len(temp_readings) > max_readings:
-                temp_readings.pop(0)  # Remove oldest
 
-            # Calculate average
-            avg_temp = sum(temp_readings) / len(temp_readings)
+def main():
+    print("Starting sensor display...")
+    print("Press Ctrl+C to exit")
 
-            # Create blank image
-            img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
-            draw = ImageDraw.Draw(img)
+    hardware = get_backend()
+    disp = hardware.display()
+    disp.begin()
+    sensors = open_sensors()
+    # calibrate.py's fitted compensation if there is one, else the factor
+    compensation = load_compensation(factor=TEMP_COMPENSATION_FACTOR)
 
-            # Just compensated temperature - large and centered
-            y_pos = 20  # Centered vertically
+    wanted = [key.strip() for key in DISPLAY_PAGES.split(',') if key.strip()]
+    pages = [page for page in PAGES if not wanted or page[0] in wanted] or PAGES
 
-            # Averaged compensated temperature (green) - large
-            draw.text((10, y_pos), f"{avg_temp:.1f}°C", font=font_temp, fill=(100, 255, 100))
+    renderer = PageRenderer(pages, disp.width, disp.height, load_font(14), load_font(40))
+    averages = {key: RollingMean(DISPLAY_AVERAGE_READINGS) for key, _, _, _ in PAGES}
 
-            # Display image
-            disp.display(img)
+    # systemd stops the service with SIGTERM; clear the screen for that too
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
 
-            # Also print to console
-            print(f"\rRaw: {raw_temp:.1f}°C | Comp: {comp_temp:.1f}°C | Avg: {avg_temp:.1f}°C | CPU: {cpu_temp:.1f}°C", end="", flush=True)
+    page = 0
+    shown = None
+    next_read = next_page = time.monotonic()
 
-            # Update every 10 seconds
-            time.sleep(10)
+    try:
+        while True:
+            now = time.monotonic()
+
+            if now >= next_read:
+                try:
+                    values = compensated(sensors.read(), compensation)
+                except Exception as e:
+                    print(f"\nError reading sensors: {e}")
+                    values = {}
+                for key, value in values.items():
+                    averages[key].add(value)
+                if 'temperature' in values:
+                    print(f"\rTemp: {values['temperature']:.1f}°C | Avg: {averages['temperature'].mean:.1f}°C | "
+                          f"Pressure: {values['pressure']:.1f} hPa | Humidity: {values['humidity']:.1f}%",
+                          end="", flush=True)
+                next_read += DISPLAY_READ_INTERVAL
+
+            if now >= next_page:
+                if shown is not None:
+                    page = (page + 1) % len(pages)
+                next_page += DISPLAY_PAGE_SECONDS
+
+            key, _, value_format, _ = pages[page]
+            mean = averages[key].mean
+            text = value_format.format(mean) if mean is not None else "-"
+
+            # Only push a frame over SPI when what's on screen would change
+            if (page, text) != shown:
+                disp.display(renderer.render(page, text))
+                shown = (page, text)
+
+            time.sleep(max(0.0, min(next_read, next_page) - time.monotonic()))
 
     except KeyboardInterrupt:
         print("\nExiting...")
         # Clear display
-        img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
-        disp.display(img)
+        disp.display(renderer.blank)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Export the data in Adafruit IO feeds to a local gzipped NDJSON file
+Usage:
+  ./export_history.py                         # This project's feeds (ALL_FEEDS)
+  ./export_history.py 'enviro-*' garden-soil  # Feed keys or glob patterns
+  ./export_history.py --output ~/enviro.ndjson.gz
+  ./export_history.py --full                  # Start the file over with all history
+
+Each line is one data point:
+  {"feed": "enviro-temperature", "created_at": "2024-05-01T12:00:00Z", "value": 21.4, "id": "..."}
+
+Feeds are exported in parallel, a page of up to 1000 points per request,
+newest first. Every request takes a token from the same rate limiter as the
+publisher. Pages are written to the file as they arrive, so memory use
+doesn't depend on how much history there is.
+
+Progress is saved next to the output file (<output>.state.json) after every
+page. The next run only fetches points newer than the last export, and a run
+that was interrupted picks up where it stopped. Each run appends a new gzip
+member, which gzip, zcat and Python's gzip module read as one file. A point
+at the exact timestamp where an interrupted run stopped may appear twice;
+`id` tells the copies apart.
+"""
+
+import sys
+import os
+import json
+import gzip
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from requests import RequestException
+from Adafruit_IO import RequestError
+from adafruit_client import (CircuitOpenError, credentials, state_dir, open_rate_limiter, worker_client, limited,
+                             select_feeds)
+from fleet import feed_mapping
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=Path(__file__).parent.absolute() / '.env')
+except ImportError:
+    print("Warning: python-dotenv not installed")
+
+ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY = credentials()
+STATE_DIR = state_dir()
+
+# All feed names used by this unit (see fleet.py)
+ALL_FEEDS = list(feed_mapping(os.getenv('DEVICE_ID', ''), os.getenv('ADAFRUIT_IO_FEED_PREFIX', '')).values())
+
+# Largest page the data endpoint returns
+PAGE_SIZE = 1000
+
+DEFAULT_OUTPUT = STATE_DIR / 'adafruit_io_history.ndjson.gz'
+
+# Data point fields worth keeping (the rest are Adafruit IO bookkeeping)
+EXPORT_FIELDS = ('created_at', 'value', 'id', 'lat', 'lon', 'ele')
+
+_print_lock = threading.Lock()
+
+
+def say(*lines):
+    """Print a feed's lines together, so workers don't interleave them"""
+    with _print_lock:
+        for line in lines:
+            print(line)
+
+
+class ExportState:
+    """Per-feed progress, saved atomically after every page
+
+    {feed: {"exported_until": newest created_at already exported,
+            "pending": {"until": newest of this run, "cursor": oldest so far}}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.feeds = json.load(f)
+        except FileNotFoundError:
+            self.feeds = {}
+
+    def get(self, feed):
+        with self._lock:
+            return dict(self.feeds.get(feed, {}))
+
+    def update(self, feed, **values):
+        with self._lock:
+            state = self.feeds.setdefault(feed, {})
+            for key, value in values.items():
+                if value is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = value
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.feeds, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class NdjsonWriter:
+    """Appends lines to one gzip file from several threads"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    def write(self, feed, points):
+        lines = []
+        for point in points:
+            record = {'feed': feed}
+            for field in EXPORT_FIELDS:
+                if point.get(field) is not None:
+                    record[field] = point[field]
+            try:
+                record['value'] = float(record['value'])
+            except (KeyError, TypeError, ValueError):
+                pass
+            lines.append(json.dumps(record) + '\n')
+        with self._lock:
+            self._file.writelines(lines)
+            # Make the page readable before the state file says it's done
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def export_feed(feed, state, writer, limiter):
+    """Page backwards from now (or an interrupted run's cursor) to the last
+    export; returns the number of points written"""
+    aio = worker_client()
+    progress = state.get(feed)
+    since = progress.get('exported_until')
+    pending = progress.get('pending') or {}
+    newest = pending.get('until')
+    cursor = pending.get('cursor')
+    # Points at the cursor's timestamp that are already in the file
+    seen_at_cursor = set()
+    written = 0
+
+    while True:
+        params = {'limit': PAGE_SIZE}
+        if since:
+            params['start_time'] = since
+        if cursor:
+            params['end_time'] = cursor
+        page = limited(limiter, aio._get, f"feeds/{feed}/data", params=params)
+
+        points = [point for point in page
+                  if point['id'] not in seen_at_cursor and (not since or point['created_at'] > since)]
+        if not points:
+            break
+        writer.write(feed, points)
+        written += len(points)
+
+        newest = newest or points[0]['created_at']
+        oldest = points[-1]['created_at']
+        at_oldest = {point['id'] for point in points if point['created_at'] == oldest}
+        seen_at_cursor = seen_at_cursor | at_oldest if oldest == cursor else at_oldest
+        cursor = oldest
+        state.update(feed, pending={'until': newest, 'cursor': cursor})
+        if len(page) < PAGE_SIZE:
+            break
+
+    if newest:
+        state.update(feed, exported_until=newest, pending=None)
+    say(f"  {feed}: {written} new point(s)" + (f", up to {newest}" if newest else ""))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Adafruit IO feed data to a gzipped NDJSON file")
+    parser.add_argument('feeds', nargs='*', help="feed keys or glob patterns (default: this project's feeds)")
+    parser.add_argument('--output', default=str(DEFAULT_OUTPUT),
+                        help=f"file to append to (default: {DEFAULT_OUTPUT.name} in STATE_DIR)")
+    parser.add_argument('--workers', type=int, default=4, help="feeds to export at once (default: 4)")
+    parser.add_argument('--full', action='store_true', help="start the file over with all history, not just what's new")
+    args = parser.parse_args()
+
+    if not ADAFRUIT_IO_USERNAME or not ADAFRUIT_IO_KEY:
+        print("Error: Adafruit IO credentials not configured!")
+        print("Make sure .env file exists with ADAFRUIT_IO_USERNAME and ADAFRUIT_IO_KEY")
+        sys.exit(1)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    # Shared with publish_to_adafruit.py (one token per request)
+    limiter = open_rate_limiter()
+
+    try:
+        existing = [feed.key for feed in limited(limiter, worker_client().feeds)]
+    except (RequestError, CircuitOpenError, RequestException) as e:
+        print(f"Error listing feeds: {e}")
+        sys.exit(1)
+    feeds, unmatched = select_feeds(args.feeds or ALL_FEEDS, existing)
+    for pattern in unmatched:
+        print(f"Feed {pattern} does not exist - skipping")
+    if not feeds:
+        sys.exit(1)
+
+    state_path = f"{args.output}.state.json"
+    if args.full:
+        for path in (args.output, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+    state = ExportState(state_path)
+    writer = NdjsonWriter(args.output)
+
+    print(f"Exporting {len(feeds)} feed(s) to {args.output}")
+
+    def export(feed):
+        try:
+            return export_feed(feed, state, writer, limiter)
+        except (RequestError, CircuitOpenError, RequestException) as e:
+            say(f"  {feed}: export failed ({e}) - the next run resumes from here")
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(export, feeds))
+    finally:
+        writer.close()
+
+    failed = results.count(None)
+    print(f"Complete! Exported {sum(r for r in results if r)} point(s)"
+          + (f", {failed} feed(s) failed" if failed else ""))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
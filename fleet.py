@@ -0,0 +1,101 @@
+"""
+Per-device names for running several Enviro+ units side by side
+
+DEVICE_ID names a unit. Left empty, every name is the single-unit one this
+project has always used, so an existing install keeps its feeds, MQTT client
+and Home Assistant entities. Set (e.g. DEVICE_ID=kitchen), it goes into:
+
+  MQTT client ID           enviroplus-kitchen
+  Home Assistant topics    homeassistant/sensor/enviroplus_kitchen/...
+  Home Assistant IDs       enviroplus_kitchen_sensor, enviroplus_kitchen_<sensor>
+  Adafruit IO feeds        enviro-kitchen-<sensor>, in group enviro-kitchen
+
+Units can also hand their readings to aggregator.py over MQTT instead of each
+talking to Adafruit IO; reading_topic() and encode_reading() are the format.
+"""
+
+import re
+import json
+import math
+
+# Keys returned by the publisher's read_sensors()
+SENSOR_KEYS = ['temperature', 'pressure', 'humidity', 'light', 'proximity', 'oxidising', 'reducing', 'nh3']
+
+# Topic wildcard matching every unit's readings under a base topic
+READING_TOPIC_FILTER = '{base}/+/reading'
+
+
+def device_slug(device_id):
+    """DEVICE_ID cut down to what's safe in feed keys and topics: a-z, 0-9 and -"""
+    return re.sub(r'[^a-z0-9]+', '-', (device_id or '').lower()).strip('-')
+
+
+def feed_prefix(device_id):
+    """Adafruit IO feed key prefix, which is also the feed group's key"""
+    slug = device_slug(device_id)
+    return f"enviro-{slug}" if slug else "enviro"
+
+
+def feed_mapping(device_id, prefix=None):
+    """Adafruit IO feed for each sensor reading"""
+    prefix = prefix or feed_prefix(device_id)
+    return {key: f"{prefix}-{key}" for key in SENSOR_KEYS}
+
+
+def bare_feed_key(key):
+    """A feed key as listed in a group ('enviro-kitchen.enviro-kitchen-temperature')
+    without the group prefix Adafruit IO adds outside the default group"""
+    return key.rsplit('.', 1)[-1]
+
+
+def mqtt_client_id(device_id, role=''):
+    """MQTT client ID; units sharing a broker must not share one"""
+    return '-'.join(part for part in ('enviroplus', device_slug(device_id), role) if part)
+
+
+def homeassistant_node(device_id):
+    """Node ID in Home Assistant discovery topics, and the prefix of unique IDs"""
+    slug = device_slug(device_id).replace('-', '_')
+    return f"enviroplus_{slug}" if slug else "enviroplus"
+
+
+def reading_topic(base, device_id):
+    return f"{base}/{device_slug(device_id)}/reading"
+
+
+def topic_device(base, topic):
+    """The device slug in a reading topic, or None if it isn't one"""
+    prefix = f"{base}/"
+    if not topic.startswith(prefix) or not topic.endswith('/reading'):
+        return None
+    slug = topic[len(prefix):-len('/reading')]
+    return slug if slug and slug == device_slug(slug) else None
+
+
+def encode_reading(sensors, created_at, stats=None):
+    message = {'created_at': created_at, 'sensors': sensors}
+    if stats:
+        message['stats'] = stats
+    return json.dumps(message)
+
+
+def decode_reading(payload):
+    """(sensors, created_at, stats) from a reading message
+
+    Only known sensors with finite numeric values are kept. Raises
+    ValueError for anything that isn't a reading.
+    """
+    try:
+        message = json.loads(payload)
+        created_at = float(message['created_at'])
+        sensors = {
+            key: value for key, value in message['sensors'].items()
+            if key in SENSOR_KEYS and isinstance(value, (int, float)) and not isinstance(value, bool)
+            and math.isfinite(value)
+        }
+    except (TypeError, KeyError, AttributeError, json.JSONDecodeError) as e:
+        raise ValueError(f"not a reading: {e}")
+    if not sensors:
+        raise ValueError("no sensor values")
+    stats = message.get('stats')
+    return sensors, created_at, stats if isinstance(stats, dict) else None
@@ -0,0 +1,246 @@
+"""
+Hardware backends for the Enviro+ sensors and LCD
+
+ENVIRO_BACKEND selects where readings come from:
+  enviroplus - the real BME280, LTR559, MICS6814 and ST7735 (default)
+  fake       - deterministic simulated devices, for running and
+               benchmarking everything on a machine without the HAT
+
+The Pimoroni libraries are only imported when the real backend first needs
+them. The fake devices can be slowed down or made to fail with:
+  FAKE_SENSOR_LATENCY     seconds added to every device call (default 0)
+  FAKE_SENSOR_FAULT_RATE  probability (0-1) that a call raises IOError
+  FAKE_SENSOR_SEED        random seed for the faults (default 0)
+  FAKE_LIGHT_FAILED       true to simulate the failed visible photodiode
+"""
+
+import os
+import math
+import time
+import random
+import logging
+import threading
+from collections import namedtuple
+
+CPU_TEMPERATURE_FILE = "/sys/class/thermal/thermal_zone0/temp"
+
+
+class EnviroPlusBackend:
+    """The real sensors on the Enviro+ HAT"""
+
+    name = "enviroplus"
+
+    def __init__(self):
+        self._bus = None
+
+    def _smbus(self):
+        if self._bus is None:
+            from smbus2 import SMBus
+            self._bus = SMBus(1)
+        return self._bus
+
+    def bme280(self):
+        from bme280 import BME280
+        return BME280(i2c_dev=self._smbus())
+
+    def ltr559(self):
+        try:
+            from ltr559 import LTR559
+            return LTR559()
+        except ImportError:
+            # Older library versions expose a module-level API
+            import ltr559
+            return ltr559
+
+    def gas(self):
+        from enviroplus import gas
+        return gas
+
+    def display(self):
+        import st7735
+        return st7735.ST7735(
+            port=0,
+            cs=1,
+            dc=9,
+            backlight=12,
+            rotation=270,
+            spi_speed_hz=10000000
+        )
+
+    def cpu_temperature(self):
+        with open(CPU_TEMPERATURE_FILE, "r") as f:
+            return int(f.read()) / 1000.0
+
+
+class _FakeDevice:
+    """Shared latency, fault injection and a slowly varying signal"""
+
+    def __init__(self, config):
+        self.config = config
+
+    def _call(self):
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        if self.config.fault_rate and self.config.random() < self.config.fault_rate:
+            raise IOError(f"Simulated I2C error in {type(self).__name__}")
+
+    def _wave(self, mean, amplitude, period):
+        # Depends only on the call count, so runs are reproducible
+        return mean + amplitude * math.sin(2 * math.pi * self.config.tick() / period)
+
+
+class FakeBME280(_FakeDevice):
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.temperature = self.pressure = self.humidity = 0.0
+        self.mode = 'normal'
+        self.oversampling = 16
+
+    def setup(self, mode='normal', temperature_oversampling=16, pressure_oversampling=16,
+              humidity_oversampling=16, temperature_standby=500):
+        self._call()
+        self.mode = mode
+        self.oversampling = max(temperature_oversampling, pressure_oversampling, humidity_oversampling)
+
+    def update_sensor(self):
+        self._call()
+        if self.mode == 'forced':
+            # Maximum conversion time from the datasheet (appendix B)
+            time.sleep((1.25 + 2.3 * self.oversampling * 3 + 0.575 * 2) / 1000)
+        self.temperature = self._wave(24.0, 2.0, 500)
+        self.pressure = self._wave(1013.0, 5.0, 2000)
+        self.humidity = self._wave(45.0, 10.0, 800)
+
+    def get_temperature(self):
+        self.update_sensor()
+        return self.temperature
+
+    def get_pressure(self):
+        self.update_sensor()
+        return self.pressure
+
+    def get_humidity(self):
+        self.update_sensor()
+        return self.humidity
+
+
+class FakeLTR559(_FakeDevice):
+
+    def update_sensor(self):
+        self._call()
+
+    def get_lux(self, passive=False):
+        if not passive:
+            self._call()
+        if self.config.light_failed:
+            return 8.9
+        return max(0.0, self._wave(300.0, 250.0, 1000))
+
+    def get_raw_als(self, passive=True):
+        if not passive:
+            self._call()
+        if self.config.light_failed:
+            return 1500, 1530
+        return int(self._wave(3000, 500, 1000)), int(self._wave(900, 100, 1000))
+
+    def get_proximity(self, passive=False):
+        if not passive:
+            self._call()
+        return max(0.0, self._wave(5.0, 5.0, 300))
+
+
+GasReading = namedtuple('GasReading', ['oxidising', 'reducing', 'nh3', 'adc'])
+
+
+class FakeGas(_FakeDevice):
+
+    def read_all(self):
+        self._call()
+        return GasReading(
+            oxidising=self._wave(30000.0, 5000.0, 700),
+            reducing=self._wave(400000.0, 50000.0, 900),
+            nh3=self._wave(120000.0, 20000.0, 1100),
+            adc=None
+        )
+
+
+class FakeST7735:
+    """Accepts frames and counts them instead of driving SPI"""
+
+    width = 160
+    height = 80
+
+    def __init__(self, config):
+        self.config = config
+        self.frames = 0
+
+    def begin(self):
+        pass
+
+    def display(self, image):
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        self.frames += 1
+
+
+class FakeBackend:
+    """Simulated devices with configurable latency and faults"""
+
+    name = "fake"
+
+    def __init__(self, latency=0.0, fault_rate=0.0, seed=0, light_failed=False):
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.light_failed = light_failed
+        self._random = random.Random(seed)
+        self._ticks = 0
+        self._lock = threading.Lock()
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def tick(self):
+        with self._lock:
+            self._ticks += 1
+            return self._ticks
+
+    def bme280(self):
+        return FakeBME280(self)
+
+    def ltr559(self):
+        return FakeLTR559(self)
+
+    def gas(self):
+        return FakeGas(self)
+
+    def display(self):
+        return FakeST7735(self)
+
+    def cpu_temperature(self):
+        return 45.0 + 5.0 * math.sin(2 * math.pi * self.tick() / 600)
+
+
+_backend = None
+
+
+def get_backend():
+    """Backend selected by ENVIRO_BACKEND, created once per process"""
+    global _backend
+
+    if _backend is None:
+        name = os.getenv('ENVIRO_BACKEND', 'enviroplus').lower()
+        if name == 'fake':
+            _backend = FakeBackend(
+                latency=float(os.getenv('FAKE_SENSOR_LATENCY', '0')),
+                fault_rate=float(os.getenv('FAKE_SENSOR_FAULT_RATE', '0')),
+                seed=int(os.getenv('FAKE_SENSOR_SEED', '0')),
+                light_failed=os.getenv('FAKE_LIGHT_FAILED', 'false').lower() == 'true'
+            )
+            logging.info("Using simulated Enviro+ sensors")
+        elif name == 'enviroplus':
+            _backend = EnviroPlusBackend()
+        else:
+            raise ValueError(f"Unknown ENVIRO_BACKEND {name!r} (use 'enviroplus' or 'fake')")
+    return _backend
@@ -0,0 +1,123 @@
+"""
+Per-stage latency tracking
+
+Every stage of a cycle (sensor init and reads, Adafruit IO requests, MQTT
+connect and publishes, each sink) is timed with the monotonic clock and kept
+in a rolling window of recent durations. The p50/p95/p99 of each window are
+saved to a JSON status file along with only the newest `saved_samples`
+durations, so the file stays small on an SD card, carries over between cron
+runs and can be watched by other tools.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty sequence"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class StageTimings:
+    """Rolling window of recent durations per stage"""
+
+    def __init__(self, window=500, path=None, saved_samples=50):
+        self.window = max(1, int(window))
+        self.path = path
+        self.saved_samples = max(0, int(saved_samples))
+        self.cycles = 0
+        self._samples = {}
+        self._last = {}
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._last[stage] = seconds
+
+    @contextmanager
+    def measure(self, stage):
+        """Time the body of a `with` block, whether or not it raises"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - started)
+
+    def snapshot(self):
+        """{stage: {count, last_ms, p50_ms, p95_ms, p99_ms, max_ms}} over the window"""
+        with self._lock:
+            samples = {stage: list(values) for stage, values in self._samples.items() if values}
+            last = dict(self._last)
+
+        def ms(seconds):
+            return round(seconds * 1000, 2)
+
+        return {
+            stage: {
+                'count': len(values),
+                'last_ms': ms(last.get(stage, values[-1])),
+                'p50_ms': ms(percentile(values, 50)),
+                'p95_ms': ms(percentile(values, 95)),
+                'p99_ms': ms(percentile(values, 99)),
+                'max_ms': ms(max(values)),
+            }
+            for stage, values in sorted(samples.items())
+        }
+
+    def load(self):
+        """Pick up the windows saved by an earlier run"""
+        try:
+            with open(self.path) as f:
+                status = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable timings file {self.path}: {e}")
+            return
+
+        with self._lock:
+            self.cycles = int(status.get('cycles', 0))
+            for stage, values in status.get('samples', {}).items():
+                self._samples[stage] = deque((float(v) for v in values), maxlen=self.window)
+
+    def save(self):
+        """Write the status file atomically so readers never see half of it"""
+        if not self.path:
+            return
+        keep = self.saved_samples
+        with self._lock:
+            samples = {stage: [round(v, 5) for v in list(values)[len(values) - keep:]] if keep else []
+                       for stage, values in self._samples.items()}
+        status = {
+            'updated': time.time(),
+            'cycles': self.cycles,
+            'stages': self.snapshot(),
+            'samples': samples,
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(status, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to write timings file {self.path}: {e}")
+
+    def log_summary(self):
+        for stage, stats in self.snapshot().items():
+            logging.info(f"Timing {stage}: p50 {stats['p50_ms']:g} ms, p95 {stats['p95_ms']:g} ms, "
+                         f"p99 {stats['p99_ms']:g} ms, max {stats['max_ms']:g} ms ({stats['count']} samples)")
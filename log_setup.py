@@ -0,0 +1,123 @@
+"""
+Logging that's gentle on the SD card
+
+Records go through a queue to a listener thread, so logging never blocks a
+cycle on disk I/O. The file handler holds lines in memory and writes them in
+one go when the buffer fills, a warning or error comes in, it's been
+`buffer_seconds` since the last write, or the process exits. The log rotates
+by size (or at a time of day) and rotated files are gzipped, so it can't grow
+without limit.
+
+In summary mode the per-feed and per-step lines are logged at DEBUG (see
+log_detail()) and each reading gets a single line instead.
+"""
+
+import os
+import json
+import time
+import atexit
+import shutil
+import logging
+import logging.handlers
+from queue import SimpleQueue
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Level of log_detail() messages: INFO, or DEBUG in summary mode
+_detail_level = logging.INFO
+
+
+def log_detail(message):
+    """Log a per-feed or per-step message that summary mode leaves out"""
+    logging.log(_detail_level, message)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line, with any `extra={'fields': {...}}` merged in"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class BufferedHandler(logging.handlers.MemoryHandler):
+    """Holds records until `capacity`, a WARNING or `interval` seconds have passed"""
+
+    def __init__(self, capacity, interval, target):
+        super().__init__(capacity, flushLevel=logging.WARNING, target=target, flushOnClose=True)
+        self.interval = interval
+        self._flushed = time.monotonic()
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or time.monotonic() - self._flushed >= self.interval
+
+    def flush(self):
+        super().flush()
+        self._flushed = time.monotonic()
+
+
+def _gzip_name(name):
+    return f"{name}.gz"
+
+
+def _gzip_rotate(source, dest):
+    import gzip
+
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def setup_logging(log_file, json_lines=False, max_bytes=1048576, backups=5, when='', compress=True,
+                  buffer_lines=100, buffer_seconds=60, console=True, summary=False, level=logging.INFO):
+    """Send the root logger through a queue to a rotating file (and the console)
+
+    The file rotates at `max_bytes`, or at `when` (a TimedRotatingFileHandler
+    interval such as 'midnight') if given, keeping `backups` old files.
+    Returns the QueueListener, which is stopped (flushing everything) at exit
+    unless the caller has stopped it already.
+    """
+    global _detail_level
+    _detail_level = logging.DEBUG if summary else logging.INFO
+
+    if when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(log_file, when=when, backupCount=backups)
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups)
+    if compress:
+        file_handler.namer = _gzip_name
+        file_handler.rotator = _gzip_rotate
+    file_handler.setFormatter(JsonLinesFormatter() if json_lines else logging.Formatter(TEXT_FORMAT))
+
+    handlers = [BufferedHandler(max(1, buffer_lines), buffer_seconds, file_handler)]
+    if console:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(stream_handler)
+
+    queue = SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    def stop():
+        # The caller may have stopped it already; stop() isn't safe to repeat
+        if listener._thread is not None:
+            listener.stop()
+        for handler in handlers:
+            handler.close()
+        file_handler.close()
+    atexit.register(stop)
+    return listener
@@ -0,0 +1,149 @@
+"""
+Prometheus /metrics endpoint serving the most recent sensor readings
+
+The sampler pushes every reading into a MetricsCache, which renders the
+Prometheus text format once per update. Scrapes just return those bytes, so
+any number of scrapers can poll without touching the I2C bus.
+"""
+
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# read_sensors() key -> (metric name, help text)
+READING_METRICS = {
+    'temperature': ('enviroplus_temperature_celsius', "Temperature after CPU heat compensation"),
+    'pressure': ('enviroplus_pressure_hectopascals', "Atmospheric pressure"),
+    'humidity': ('enviroplus_relative_humidity_percent', "Relative humidity"),
+    'light': ('enviroplus_light_lux', "Ambient light (absent while the light sensor is unhealthy)"),
+    'proximity': ('enviroplus_proximity', "Raw proximity reading"),
+}
+
+GAS_CHANNELS = ('oxidising', 'reducing', 'nh3')
+
+
+class MetricsCache:
+    """Latest reading and diagnostics, pre-rendered in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reads = 0
+        self._errors = 0
+        self._sensors = {}
+        self._diagnostics = {}
+        self._updated = None
+        self._timings = {}
+        self._body = self._render()
+
+    def update(self, sensors, diagnostics=None, timestamp=None):
+        with self._lock:
+            self._reads += 1
+            self._sensors = dict(sensors)
+            self._diagnostics = dict(diagnostics or {})
+            self._updated = timestamp if timestamp is not None else time.time()
+            self._body = self._render()
+
+    def set_timings(self, snapshot):
+        """Per-stage latency percentiles from instrumentation.StageTimings.snapshot()"""
+        with self._lock:
+            self._timings = dict(snapshot)
+            self._body = self._render()
+
+    def record_error(self):
+        with self._lock:
+            self._errors += 1
+            self._body = self._render()
+
+    def body(self):
+        with self._lock:
+            return self._body
+
+    def _render(self):
+        lines = []
+
+        def metric(name, help_text, kind, samples):
+            """samples: list of (labels dict, value); skips metrics without samples"""
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{val}"' for key, val in labels.items())
+                label_text = f"{{{label_text}}}" if label_text else ''
+                lines.append(f"{name}{label_text} {float(value)!r}")
+
+        sensors = self._sensors
+        diagnostics = self._diagnostics
+
+        for key, (name, help_text) in READING_METRICS.items():
+            metric(name, help_text, 'gauge', [({}, sensors.get(key))])
+
+        metric('enviroplus_gas_resistance_kiloohms', "MICS6814 resistance as published", 'gauge',
+               [({'channel': channel}, sensors.get(channel)) for channel in GAS_CHANNELS])
+        metric('enviroplus_gas_resistance_ohms', "MICS6814 resistance before rounding", 'gauge',
+               [({'channel': channel}, diagnostics.get(f'gas_{channel}_ohms')) for channel in GAS_CHANNELS])
+        metric('enviroplus_gas_adc_volts', "Enviro+ analog input (ADS1015 channel 3), if enabled", 'gauge',
+               [({}, diagnostics.get('gas_adc_volts'))])
+
+        metric('enviroplus_raw_temperature_celsius', "BME280 temperature before compensation", 'gauge',
+               [({}, diagnostics.get('raw_temperature'))])
+        metric('enviroplus_cpu_temperature_celsius', "Raspberry Pi CPU temperature", 'gauge',
+               [({}, diagnostics.get('cpu_temperature'))])
+
+        metric('enviroplus_light_raw_counts', "LTR559 raw ALS channel counts", 'gauge',
+               [({'channel': 'ch0'}, diagnostics.get('light_ch0')),
+                ({'channel': 'ch1'}, diagnostics.get('light_ch1'))])
+        healthy = diagnostics.get('light_sensor_healthy')
+        metric('enviroplus_light_sensor_healthy', "0 when the visible-light photodiode failure signature (CH1 >= CH0) is seen",
+               'gauge', [({}, None if healthy is None else int(healthy))])
+        health = diagnostics.get('sensor_health', {})
+        metric('enviroplus_sensor_healthy', "0 while a sensor is left out for failing (see sensor_health.py)", 'gauge',
+               [({'sensor': name}, int(state['healthy'])) for name, state in health.items()])
+        metric('enviroplus_sensor_error_rate', "Share of a sensor's recent read attempts that failed", 'gauge',
+               [({'sensor': name}, state['error_rate']) for name, state in health.items()])
+
+        metric('enviroplus_last_reading_timestamp_seconds', "Unix time of the cached reading", 'gauge',
+               [({}, self._updated)])
+        metric('enviroplus_sensor_reads_total', "Successful sensor reads", 'counter', [({}, self._reads)])
+        metric('enviroplus_sensor_read_errors_total', "Failed sensor reads", 'counter', [({}, self._errors)])
+
+        metric('enviroplus_stage_duration_seconds', "Recent duration percentiles of each read/publish stage", 'gauge',
+               [({'stage': stage, 'quantile': quantile}, stats[f'p{pct}_ms'] / 1000)
+                for stage, stats in self._timings.items()
+                for pct, quantile in (('50', '0.5'), ('95', '0.95'), ('99', '0.99'))])
+
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.cache.body()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the log file
+        pass
+
+
+def start_metrics_server(cache, port, address='0.0.0.0'):
+    """Serve `cache` on http://address:port/metrics from a background thread"""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'cache': cache})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logging.info(f"Serving Prometheus metrics on http://{address}:{port}/metrics")
+    return server
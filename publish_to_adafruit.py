@@ -2,28 +2,47 @@
 
 """
 Publish Enviro+ sensor readings to Adafruit IO and Home Assistant
-Designed to be run via cron
+Designed to be run via cron, or as a long-running service with --daemon
 """
 
 import sys
 import os
 import time
+
+# Start of the module imports, for the "import" timing
+_import_started = time.monotonic()
+
+import signal
 import logging
+import argparse
+import threading
 import json
+import hashlib
 from pathlib import Path
-from datetime import datetime
-from bme280 import BME280
-from smbus2 import SMBus
+from datetime import datetime, timezone
+from sensor_broker import open_sensors
+from compensation import load_compensation
+from deadband import Deadband, parse_thresholds
+from fleet import (SENSOR_KEYS, feed_prefix, feed_mapping, bare_feed_key, mqtt_client_id, homeassistant_node,
+                   reading_topic, encode_reading)
+from rate_limiter import TokenBucket, retry_after_seconds
+from sinks import Sink, Reading, FanOut, CsvSink, NdjsonSink, InfluxHttpSink, InfluxUdpSink, udp_address
+from instrumentation import StageTimings
+from log_setup import setup_logging, log_detail
+
+_import_seconds = time.monotonic() - _import_started
 
-try:
-    from ltr559 import LTR559
-    ltr559 = LTR559()
-except ImportError:
-    import ltr559
 
-from enviroplus import gas
-from Adafruit_IO import Client, RequestError
-import paho.mqtt.client as mqtt
+class _NotImported(Exception):
+    """Stands in for library exceptions until the library is imported"""
+
+
+# The Adafruit IO and MQTT libraries are slow to import on a Pi Zero, so they
+# are only imported once a cycle actually needs them (see load_adafruit_io()
+# and get_mqtt_client()). Until then the exception names match nothing.
+open_client = Data = Feed = Group = None
+RequestError = ThrottlingError = CircuitOpenError = _NotImported
+mqtt = None
 
 # Load environment variables from .env file
 try:
@@ -39,107 +58,658 @@ except ImportError:
 # Configure logging for cron
 # Log to the same directory as this script
 script_dir = Path(__file__).parent.absolute()
-log_file = script_dir / 'sensor_log.txt'
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
+log_file = Path(os.getenv('LOG_FILE', str(script_dir / 'sensor_log.txt')))
+
+# The log rotates at LOG_MAX_BYTES (or at LOG_ROTATE_WHEN, e.g. "midnight")
+# keeping LOG_BACKUPS gzipped old files, and is written in batches of up to
+# LOG_BUFFER_LINES lines or every LOG_BUFFER_SECONDS (warnings and errors
+# straight away) to spare the SD card. LOG_FORMAT=json writes JSON lines;
+# LOG_SUMMARY=true logs one line per reading instead of one per feed.
+LOG_SUMMARY = os.getenv('LOG_SUMMARY', 'false').lower() == 'true'
+setup_logging(
+    log_file,
+    json_lines=os.getenv('LOG_FORMAT', 'text').lower() == 'json',
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', '1048576')),
+    backups=int(os.getenv('LOG_BACKUPS', '5')),
+    when=os.getenv('LOG_ROTATE_WHEN', ''),
+    compress=os.getenv('LOG_COMPRESS', 'true').lower() == 'true',
+    buffer_lines=int(os.getenv('LOG_BUFFER_LINES', '100')),
+    buffer_seconds=float(os.getenv('LOG_BUFFER_SECONDS', '60')),
+    console=os.getenv('LOG_CONSOLE', 'true').lower() == 'true',
+    summary=LOG_SUMMARY
 )
 
 # ============================================
 # CONFIGURATION - Load from environment variables
 # ============================================
 
+# Where the rate limiter, offline queue, discovery cache and history live
+STATE_DIR = Path(os.getenv('STATE_DIR', str(script_dir)))
+
 # Publishing control flags (default both to true)
 ENABLE_ADAFRUIT_IO = os.getenv('ENABLE_ADAFRUIT_IO', 'true').lower() == 'true'
 ENABLE_HOMEASSISTANT = os.getenv('ENABLE_HOMEASSISTANT', 'true').lower() == 'true'
 
+# Name of this unit when several share a broker or Adafruit IO account (see
+# fleet.py). Empty keeps the single-unit feed, topic and entity names.
+DEVICE_ID = os.getenv('DEVICE_ID', '')
+
 # Adafruit IO Configuration
 ADAFRUIT_IO_USERNAME = os.getenv('ADAFRUIT_IO_USERNAME')
 ADAFRUIT_IO_KEY = os.getenv('ADAFRUIT_IO_KEY')
+# Only needed to point at a different server, e.g. the benchmark's mock
+ADAFRUIT_IO_BASE_URL = os.getenv('ADAFRUIT_IO_BASE_URL', '')
+# Request timeouts and the circuit breaker (ADAFRUIT_IO_CONNECT_TIMEOUT,
+# ADAFRUIT_IO_READ_TIMEOUT, ADAFRUIT_IO_BREAKER_*) are set in adafruit_client.py
+
+# Send all readings in one request through a feed group (set to false for one request per feed)
+ADAFRUIT_IO_BATCH = os.getenv('ADAFRUIT_IO_BATCH', 'true').lower() == 'true'
+# Feeds are named <prefix>-<sensor> (default: enviro, or enviro-<DEVICE_ID>)
+ADAFRUIT_IO_FEED_PREFIX = os.getenv('ADAFRUIT_IO_FEED_PREFIX', '') or feed_prefix(DEVICE_ID)
+ADAFRUIT_IO_GROUP = os.getenv('ADAFRUIT_IO_GROUP', ADAFRUIT_IO_FEED_PREFIX)
+
+# Adafruit IO data rate limit (data points per minute; 30 on the free tier)
+# and how many points may go out back-to-back (default: one full reading)
+ADAFRUIT_IO_RATE_LIMIT = float(os.getenv('ADAFRUIT_IO_RATE_LIMIT', '30'))
+ADAFRUIT_IO_BURST = float(os.getenv('ADAFRUIT_IO_BURST', '8'))
+
+# Adafruit IO feed for each sensor reading (keys as returned by read_sensors())
+FEED_MAPPING = feed_mapping(DEVICE_ID, ADAFRUIT_IO_FEED_PREFIX)
 
 # Home Assistant MQTT Configuration
 MQTT_BROKER = os.getenv('MQTT_BROKER', 'homeassistant.local')
 MQTT_PORT = int(os.getenv('MQTT_PORT', '1883'))
 MQTT_USERNAME = os.getenv('MQTT_USERNAME')
 MQTT_PASSWORD = os.getenv('MQTT_PASSWORD')
+MQTT_CLIENT_ID = mqtt_client_id(DEVICE_ID)
+# Discovery and state topics are homeassistant/sensor/<node>/...
+HOMEASSISTANT_NODE = homeassistant_node(DEVICE_ID)
+
+# Send readings over MQTT to aggregator.py, which forwards every unit's
+# readings to Adafruit IO in batches (usually with ENABLE_ADAFRUIT_IO=false)
+ENABLE_AGGREGATOR = os.getenv('ENABLE_AGGREGATOR', 'false').lower() == 'true'
+AGGREGATOR_TOPIC = os.getenv('AGGREGATOR_TOPIC', 'enviroplus/fleet')
+
+# Send every reading as one JSON message on a shared state topic instead of
+# one message per sensor
+HOMEASSISTANT_JSON_STATE = os.getenv('HOMEASSISTANT_JSON_STATE', 'false').lower() == 'true'
+# Seconds to wait for the broker to accept the connection and acknowledge publishes
+MQTT_TIMEOUT = float(os.getenv('MQTT_TIMEOUT', '10'))
+
+# Home Assistant announces itself here when it (re)starts
+HOMEASSISTANT_STATUS_TOPIC = os.getenv('HOMEASSISTANT_STATUS_TOPIC', 'homeassistant/status')
+# Republish unchanged discovery configs at least this often, in case the broker lost them
+DISCOVERY_REFRESH_HOURS = float(os.getenv('DISCOVERY_REFRESH_HOURS', '24'))
+DISCOVERY_CACHE_FILE = STATE_DIR / '.ha_discovery_cache.json'
 
 # Temperature compensation factor (set to 0 to disable)
 TEMP_COMPENSATION_FACTOR = float(os.getenv('TEMP_COMPENSATION_FACTOR', '0'))
+# Compensation fitted by calibrate.py; when it exists it replaces the factor
+CALIBRATION_FILE = os.getenv('CALIBRATION_FILE', str(STATE_DIR / 'calibration.json'))
+
+# How the sensors are read (BME280_MODE, BME280_OVERSAMPLING, BME280_PERIOD,
+# LTR559_PERIOD, GAS_PERIOD, GAS_WARMUP_SECONDS) is set in sensor_scheduler.py.
+# When the sensor broker is running (see sensor_broker.py) readings come from
+# it over this socket instead, and it owns those settings (empty = never use it)
+SENSOR_SOCKET = os.getenv('SENSOR_SOCKET', str(script_dir / '.sensors.sock'))
+
+# Keep readings that failed to publish on disk and send them later
+ENABLE_READING_QUEUE = os.getenv('ENABLE_READING_QUEUE', 'true').lower() == 'true'
+QUEUE_MAX_READINGS = int(os.getenv('QUEUE_MAX_READINGS', '10000'))
+# Longest a cycle may spend sending queued readings before moving on
+QUEUE_DRAIN_MAX_SECONDS = float(os.getenv('QUEUE_DRAIN_MAX_SECONDS', '30'))
+
+# Keep a fixed-size local history of every reading (see timeseries_store.py)
+ENABLE_LOCAL_HISTORY = os.getenv('ENABLE_LOCAL_HISTORY', 'true').lower() == 'true'
+HISTORY_DIR = Path(os.getenv('HISTORY_DIR', str(STATE_DIR / 'history')))
+
+# Longest each service may take per cycle before it's reported as failed
+# (Adafruit IO includes rate limit waits and draining the queue)
+ADAFRUIT_IO_TIMEOUT = float(os.getenv('ADAFRUIT_IO_TIMEOUT', '90'))
+HOMEASSISTANT_TIMEOUT = float(os.getenv('HOMEASSISTANT_TIMEOUT', '30'))
+SINK_TIMEOUT = float(os.getenv('SINK_TIMEOUT', '30'))
+
+# Readings each sink may have waiting, and what to do when a sink falls that
+# far behind: drop_oldest, drop_newest or coalesce (keep only the newest)
+SINK_QUEUE_SIZE = int(os.getenv('SINK_QUEUE_SIZE', '100'))
+SINK_OVERLOAD_POLICY = os.getenv('SINK_OVERLOAD_POLICY', 'drop_oldest')
+
+# Only send a value to Adafruit IO / Home Assistant when it moved by at least
+# its deadband since it was last sent there, e.g.
+# "temperature=0.1,pressure=0.5,humidity=1,light=5%" (empty = send every value),
+# or when it hasn't been sent for DEADBAND_HEARTBEAT seconds
+DEADBAND = os.getenv('DEADBAND', '')
+DEADBAND_HEARTBEAT = float(os.getenv('DEADBAND_HEARTBEAT', '900'))
+
+# Optional extra sinks (leave empty to disable)
+CSV_FILE = os.getenv('CSV_FILE', '')
+NDJSON_FILE = os.getenv('NDJSON_FILE', '')
+INFLUXDB_URL = os.getenv('INFLUXDB_URL', '')
+INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN', '')
+INFLUXDB_UDP = os.getenv('INFLUXDB_UDP', '')
+INFLUXDB_MEASUREMENT = os.getenv('INFLUXDB_MEASUREMENT', 'enviroplus')
+
+# Serve the latest readings for Prometheus on this port in daemon mode (0 = off)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_BIND = os.getenv('METRICS_BIND', '0.0.0.0')
+
+# Per-stage latency histograms (see instrumentation.py): the JSON status file
+# (empty to not write one), how many recent timings to keep per stage, and
+# how often to log a summary (every N cycles, 0 = never)
+TIMINGS_FILE = os.getenv('TIMINGS_FILE', str(STATE_DIR / 'timings.json'))
+TIMINGS_WINDOW = int(os.getenv('TIMINGS_WINDOW', '500'))
+TIMINGS_SUMMARY_EVERY = int(os.getenv('TIMINGS_SUMMARY_EVERY', '10'))
+TIMINGS_SAVED_SAMPLES = int(os.getenv('TIMINGS_SAVED_SAMPLES', '50'))
+
+# Seconds between readings when running with --daemon
+PUBLISH_INTERVAL = float(os.getenv('PUBLISH_INTERVAL', '60'))
+
+# Samples per second in daemon mode (0 = one sample per publish). Each publish
+# then sends the mean of the window, with min/max/stddev as extra detail.
+SAMPLE_RATE = float(os.getenv('SAMPLE_RATE', '0'))
+
+# Long-lived handles, created on first use and reused for every cycle in daemon mode
+_scheduler = None
+_compensation = None
+_deadband = None
+_aio_client = None
+_aio_group_ready = False
+_aio_rate_limiter = None
+_reading_queue = None
+_history_store = None
+_mqtt_client = None
+_mqtt_connected = threading.Event()
+# The Home Assistant and aggregator sinks' threads share the one MQTT client;
+# two clients with the same ID would keep kicking each other off the broker
+_mqtt_lock = threading.Lock()
+
+# Every enabled sink behind its own worker thread and bounded queue
+_pipeline = None
+
+# Latest reading for the Prometheus exporter (only set when it's running)
+_metrics_cache = None
+
+# Discovery config hashes already on the broker, and the payloads themselves so
+# they can be resent immediately when Home Assistant restarts
+_discovery_cache = None
+_discovery_payloads = {}
+_discovery_lock = threading.Lock()
+
+# Set by SIGTERM/SIGINT to stop the daemon loop between cycles
+_shutdown = threading.Event()
+
+# Rolling per-stage durations, carried over between cron runs via TIMINGS_FILE
+_timings = StageTimings(window=TIMINGS_WINDOW, path=TIMINGS_FILE or None, saved_samples=TIMINGS_SAVED_SAMPLES)
+_timings.record('import', _import_seconds)
+
+
+def get_scheduler():
+    """Connect to the sensor broker, or set up the sensors' read schedule, once"""
+    global _scheduler
+
+    if _scheduler is None:
+        _scheduler = open_sensors(SENSOR_SOCKET, timings=_timings)
+    return _scheduler
+
+
+def get_compensation():
+    """Load the temperature compensation once"""
+    global _compensation
+
+    if _compensation is None:
+        _compensation = load_compensation(CALIBRATION_FILE, TEMP_COMPENSATION_FACTOR)
+        if _compensation.details:
+            log_detail(f"Temperature compensation from {CALIBRATION_FILE}: {_compensation.describe()}")
+    return _compensation
+
+
+# A raw value every read of each sensor includes
+SENSOR_RAW_KEYS = {'bme280': 'raw_temperature', 'ltr559': 'light_ch0', 'gas': 'gas_oxidising_ohms'}
+
+
+def read_sensors(quiet=False, fresh_only=False):
+    """Read all sensor values and return as dict
+
+    `quiet` skips the success log line, for high-rate sampling. Sensors that
+    aren't due yet (see sensor_scheduler.py) repeat their last value, or are
+    left out with `fresh_only` so a sampling window doesn't count them
+    twice. A sensor that failed or is unhealthy (see sensor_health.py) is
+    left out too, and the rest are still returned. The raw values behind
+    the reading are kept for the Prometheus exporter.
+    """
+    sensors = {}
+    diagnostics = {}
+    started = time.monotonic()
 
-
-def get_cpu_temperature():
-    """Get CPU temperature for BME280 compensation"""
     try:
-        with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-            temp = f.read()
-            temp = int(temp) / 1000.0
-        return temp
+        scheduler = get_scheduler()
+        raw = scheduler.read(fresh_only=fresh_only)
+        health = scheduler.health_report()
+        diagnostics['sensor_health'] = health
+
+        if 'raw_temperature' in raw:
+            # Temperature with compensation
+            raw_temp = raw['raw_temperature']
+            cpu_temp = raw['cpu_temperature']
+
+            diagnostics['raw_temperature'] = raw_temp
+            diagnostics['cpu_temperature'] = cpu_temp
+
+            sensors['temperature'] = round(get_compensation().correct(raw_temp, cpu_temp, raw['humidity']), 2)
+
+            # Pressure and Humidity
+            sensors['pressure'] = round(raw['pressure'], 2)
+            sensors['humidity'] = round(raw['humidity'], 2)
+
+        if 'light_ch0' in raw:
+            # Light and Proximity; lux is left out while the visible-light
+            # photodiode failure signature is seen
+            diagnostics['light_ch0'] = raw['light_ch0']
+            diagnostics['light_ch1'] = raw['light_ch1']
+            diagnostics['light_sensor_healthy'] = 'lux' not in health.get('ltr559', {}).get('faulty', {})
+            if 'lux' in raw:
+                sensors['light'] = round(raw['lux'], 2)
+            sensors['proximity'] = round(raw['proximity'], 2)
+
+        if 'gas_oxidising_ohms' in raw:
+            # Gas sensors
+            sensors['oxidising'] = round(raw['gas_oxidising_ohms'] / 1000, 2)
+            sensors['reducing'] = round(raw['gas_reducing_ohms'] / 1000, 2)
+            sensors['nh3'] = round(raw['gas_nh3_ohms'] / 1000, 2)
+            for key in ('gas_oxidising_ohms', 'gas_reducing_ohms', 'gas_nh3_ohms', 'gas_adc_volts'):
+                diagnostics[key] = raw[key]
+
+        if _metrics_cache is not None:
+            if sensors:
+                _metrics_cache.update(sensors, diagnostics)
+            else:
+                _metrics_cache.record_error()
+
+        _timings.record('read_sensors', time.monotonic() - started)
+        if not quiet:
+            failed = [f"{name} ({'unhealthy: ' if not state['healthy'] else ''}{state['reason']})"
+                      for name, state in health.items()
+                      if state['reason'] and SENSOR_RAW_KEYS.get(name) not in raw]
+            if failed:
+                log_detail(f"Partial reading - left out {', '.join(failed)}")
+            else:
+                log_detail(f"Successfully read all sensors")
+        return sensors
+
     except Exception as e:
-        logging.error(f"Failed to read CPU temperature: {e}")
+        logging.error(f"Error reading sensors: {e}")
+        if _metrics_cache is not None:
+            _metrics_cache.record_error()
         return None
 
 
-def read_sensors():
-    """Read all sensor values and return as dict"""
-    sensors = {}
+def load_adafruit_io():
+    """Import the Adafruit IO client library the first time it's needed"""
+    global open_client, Data, Feed, Group, RequestError, ThrottlingError, CircuitOpenError
 
+    if open_client is None:
+        with _timings.measure('import.adafruit_io'):
+            from Adafruit_IO import Data, Feed, Group, RequestError, ThrottlingError
+            from adafruit_client import open_client, CircuitOpenError
+
+
+def get_adafruit_client():
+    """Create the Adafruit IO client once; its keep-alive connection is reused by later cycles"""
+    global _aio_client
+
+    if _aio_client is None:
+        load_adafruit_io()
+        _aio_client = open_client(ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY, ADAFRUIT_IO_BASE_URL, STATE_DIR)
+    return _aio_client
+
+
+def get_mqtt_client():
+    """Connect to the MQTT broker once; paho's network thread reconnects as needed"""
+    global _mqtt_client, mqtt
+
+    if _mqtt_client is not None:
+        return _mqtt_client
+
+    with _mqtt_lock:
+        if _mqtt_client is not None:
+            # Another sink's thread connected while this one waited
+            return _mqtt_client
+
+        if mqtt is None:
+            with _timings.measure('import.paho_mqtt'):
+                import paho.mqtt.client as mqtt
+
+        client = mqtt.Client(client_id=MQTT_CLIENT_ID, protocol=mqtt.MQTTv5)
+        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        client.on_connect = on_mqtt_connect
+        client.on_message = on_homeassistant_status
+
+        client.on_disconnect = on_mqtt_disconnect
+
+        log_detail(f"Connecting to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}")
+        _mqtt_connected.clear()
+        with _timings.measure('mqtt.connect'):
+            client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            client.loop_start()
+
+            # Wait for the broker's CONNACK rather than a fixed delay
+            if not _mqtt_connected.wait(MQTT_TIMEOUT):
+                # Don't leave it reconnecting in the background under our client ID
+                client.disconnect()
+                client.loop_stop()
+                raise TimeoutError(f"No answer from MQTT broker within {MQTT_TIMEOUT:g} seconds")
+        _mqtt_client = client
+        return _mqtt_client
+
+
+def on_mqtt_connect(client, userdata, flags, reason_code, properties=None):
+    """(Re)subscribe to Home Assistant's birth message after every connect"""
+    if reason_code != 0:
+        logging.error(f"MQTT broker refused the connection: {reason_code}")
+        return
+    _mqtt_connected.set()
+    client.subscribe(HOMEASSISTANT_STATUS_TOPIC, qos=1)
+
+
+def on_mqtt_disconnect(client, userdata, *args):
+    # Signature differs between paho versions; only the event matters here
+    _mqtt_connected.clear()
+
+
+def wait_for_publishes(messages, timeout, started=None):
+    """Block until the broker has acknowledged every message, or raise
+
+    With `started` (when the first message was sent), each message's time
+    to acknowledgement is recorded as an "mqtt.publish" timing.
+    """
+    deadline = time.monotonic() + timeout
+    for info in messages:
+        info.wait_for_publish(max(0.0, deadline - time.monotonic()))
+        if not info.is_published():
+            raise TimeoutError(f"MQTT broker didn't acknowledge {len(messages)} message(s) within {timeout:g} seconds")
+        if started is not None:
+            _timings.record('mqtt.publish', time.monotonic() - started)
+
+
+def on_homeassistant_status(client, userdata, message):
+    """Resend every discovery config when Home Assistant comes back online"""
+    # The retained status delivered on subscribe is not a restart
+    if message.retain or message.payload.decode(errors='replace').strip() != 'online':
+        return
+
+    with _discovery_lock:
+        payloads = dict(_discovery_payloads)
+    if not payloads:
+        # Nothing built yet in this process: let the next cycle send them all
+        logging.info("Home Assistant restarted - resending MQTT discovery configs next cycle")
+        forget_discovery()
+        return
+
+    # The cache still matches what's retained, so it stays as it is
+    logging.info("Home Assistant restarted - republishing MQTT discovery configs")
+    for discovery_topic, payload in payloads.items():
+        client.publish(discovery_topic, payload, qos=1, retain=True)
+
+
+def load_discovery_cache():
+    """Hashes of the discovery configs we last published, keyed by topic"""
+    global _discovery_cache
+
+    if _discovery_cache is None:
+        try:
+            with open(DISCOVERY_CACHE_FILE, 'r') as f:
+                _discovery_cache = json.load(f)
+        except (OSError, ValueError):
+            _discovery_cache = {}
+    return _discovery_cache
+
+
+def save_discovery_cache():
     try:
-        # Initialize sensors
-        bus = SMBus(1)
-        bme280 = BME280(i2c_dev=bus)
-
-        # Discard first reading (BME280 returns stale data on first read)
-        _ = bme280.get_temperature()
-        _ = bme280.get_pressure()
-        _ = bme280.get_humidity()
-        time.sleep(0.1)  # Brief delay for sensor stabilization
-
-        # Temperature with compensation
-        cpu_temp = get_cpu_temperature()
-        raw_temp = bme280.get_temperature()
-
-        if cpu_temp and TEMP_COMPENSATION_FACTOR > 0:
-            compensation = (cpu_temp - raw_temp) / TEMP_COMPENSATION_FACTOR
-            sensors['temperature'] = round(raw_temp - compensation, 2)
-        else:
-            sensors['temperature'] = round(raw_temp, 2)
+        with open(DISCOVERY_CACHE_FILE, 'w') as f:
+            json.dump(_discovery_cache, f)
+    except OSError as e:
+        logging.warning(f"Could not save discovery cache: {e}")
+
+
+def forget_discovery():
+    """Drop the cache so the next cycle republishes every discovery config"""
+    global _discovery_cache
+
+    with _discovery_lock:
+        _discovery_cache = {}
+        save_discovery_cache()
+
+
+def discovery_needs_publish(discovery_topic, payload):
+    """True if this config differs from (or is older than the refresh age of) what was sent"""
+    with _discovery_lock:
+        _discovery_payloads[discovery_topic] = payload
+        cache = load_discovery_cache()
+        # Include the broker so pointing at a new broker republishes everything
+        digest = hashlib.sha256(f"{MQTT_BROKER}:{MQTT_PORT}\n{payload}".encode()).hexdigest()
+        entry = cache.get(discovery_topic)
+        if entry and entry.get('hash') == digest:
+            age_hours = (time.time() - entry.get('published_at', 0)) / 3600
+            if age_hours < DISCOVERY_REFRESH_HOURS:
+                return False
+        cache[discovery_topic] = {'hash': digest, 'published_at': time.time()}
+        return True
 
-        # Pressure and Humidity
-        sensors['pressure'] = round(bme280.get_pressure(), 2)
-        sensors['humidity'] = round(bme280.get_humidity(), 2)
 
-        # Light and Proximity
-        lux = round(ltr559.get_lux(), 2)
-        ch0, ch1 = ltr559.get_raw_als()
+def close_mqtt_client():
+    """Stop the MQTT network thread and disconnect cleanly"""
+    global _mqtt_client
 
-        # Check for hardware failure signature (visible light photodiode failure)
-        # When CH1 (IR) >= CH0 (Visible+IR), the visible photodiode is not working
-        is_light_sensor_failed = ch1 > 0 and ch0 <= ch1 and lux < 20
+    with _mqtt_lock:
+        if _mqtt_client is None:
+            return
+        # Disconnect first: the network thread exits as soon as the DISCONNECT
+        # is sent, instead of loop_stop() waiting out its select() timeout
+        _mqtt_client.disconnect()
+        _mqtt_client.loop_stop()
+        _mqtt_client = None
 
-        if is_light_sensor_failed:
-            logging.warning(f"Light sensor hardware failure detected (CH0={ch0}, CH1={ch1}, lux={lux}). Skipping light sensor publish.")
-        else:
-            sensors['light'] = lux
 
-        sensors['proximity'] = round(ltr559.get_proximity(), 2)
+def get_adafruit_rate_limiter():
+    """Token bucket shared (via a state file) by every process using this account"""
+    global _aio_rate_limiter
 
-        # Gas sensors
-        gas_data = gas.read_all()
-        sensors['oxidising'] = round(gas_data.oxidising / 1000, 2)
-        sensors['reducing'] = round(gas_data.reducing / 1000, 2)
-        sensors['nh3'] = round(gas_data.nh3 / 1000, 2)
+    if _aio_rate_limiter is None:
+        _aio_rate_limiter = TokenBucket(
+            ADAFRUIT_IO_RATE_LIMIT,
+            burst=ADAFRUIT_IO_BURST,
+            state_file=STATE_DIR / '.adafruit_rate_limit.json'
+        )
+    return _aio_rate_limiter
 
-        logging.info(f"Successfully read all sensors")
-        return sensors
 
+def ensure_adafruit_group(aio):
+    """Create the feed group and put every feed in it (checked once per process)"""
+    global _aio_group_ready
+
+    if _aio_group_ready:
+        return
+
+    try:
+        group = aio.groups(ADAFRUIT_IO_GROUP)
+    except RequestError as e:
+        if "404" not in str(e) and "not found" not in str(e).lower():
+            raise
+        logging.info(f"Group {ADAFRUIT_IO_GROUP} doesn't exist, creating it...")
+        group = aio.create_group(Group(name=ADAFRUIT_IO_GROUP, key=ADAFRUIT_IO_GROUP))
+        logging.info(f"Created group {ADAFRUIT_IO_GROUP}")
+
+    grouped_feeds = {bare_feed_key(feed.key) for feed in group.feeds or ()}
+    missing = [name for name in FEED_MAPPING.values() if name not in grouped_feeds]
+
+    if missing:
+        existing_feeds = {feed.key for feed in aio.feeds()}
+        for feed_name in missing:
+            if feed_name in existing_feeds:
+                # Keep the existing feed (and its history), just add it to the group.
+                # The client library has no wrapper for this endpoint.
+                aio._post(f"groups/{ADAFRUIT_IO_GROUP}/add", {'feed_key': feed_name})
+                logging.info(f"Added feed {feed_name} to group {ADAFRUIT_IO_GROUP}")
+            else:
+                aio.create_feed(Feed(name=feed_name, key=feed_name), group_key=ADAFRUIT_IO_GROUP)
+                logging.info(f"Created feed {feed_name} in group {ADAFRUIT_IO_GROUP}")
+
+    _aio_group_ready = True
+
+
+def format_created_at(created_at):
+    """Format a Unix timestamp the way Adafruit IO expects for created_at"""
+    return datetime.fromtimestamp(created_at, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def post_group_data(aio, payload):
+    """Send one reading to the feed group's data endpoint"""
+    with _timings.measure('adafruit_io.request'):
+        aio._post(f"groups/{ADAFRUIT_IO_GROUP}/data", payload)
+
+
+def send_feed_value(aio, feed_name, value):
+    """Send one value to one feed"""
+    with _timings.measure('adafruit_io.request'):
+        aio.send_data(feed_name, value)
+
+
+def publish_batch_to_adafruit(aio, sensors, created_at=None, max_wait=None):
+    """Publish every reading in a single request to the feed group's data endpoint
+
+    Returns False without sending if the rate limit budget isn't available
+    within `max_wait` seconds.
+    """
+    global _aio_group_ready
+
+    feeds = [
+        {'key': feed_name, 'value': sensors[sensor]}
+        for sensor, feed_name in FEED_MAPPING.items()
+        if sensor in sensors
+    ]
+    if not feeds:
+        logging.warning("No readings to publish to Adafruit IO")
+        return True
+
+    payload = {'feeds': feeds}
+    if created_at is not None:
+        payload['created_at'] = format_created_at(created_at)
+
+    ensure_adafruit_group(aio)
+    limiter = get_adafruit_rate_limiter()
+
+    if not limiter.acquire(len(feeds), max_wait=max_wait):
+        return False
+    try:
+        post_group_data(aio, payload)
+    except RequestError as e:
+        if "404" not in str(e) and "not found" not in str(e).lower():
+            raise
+        # Group or feeds were deleted since we last checked (e.g. by reset_feed.py)
+        logging.info(f"Group {ADAFRUIT_IO_GROUP} is missing feeds, recreating...")
+        _aio_group_ready = False
+        ensure_adafruit_group(aio)
+        post_group_data(aio, payload)
+    except ThrottlingError:
+        limiter.throttled(retry_after_seconds(aio))
+        limiter.acquire(len(feeds))
+        post_group_data(aio, payload)
+
+    for feed in feeds:
+        log_detail(f"Published {feed['value']} to {feed['key']}")
+    log_detail(f"Successfully published {len(feeds)} readings to Adafruit IO in one request")
+    return True
+
+
+def get_reading_queue():
+    """Open the on-disk backlog of unpublished readings"""
+    global _reading_queue
+
+    if _reading_queue is None:
+        from reading_queue import ReadingQueue
+
+        _reading_queue = ReadingQueue(STATE_DIR / 'reading_queue.db', max_readings=QUEUE_MAX_READINGS)
+    return _reading_queue
+
+
+def queue_reading(sink, sensors, created_at):
+    """Keep a reading that failed to publish so a later cycle can send it"""
+    try:
+        queue = get_reading_queue()
+        evicted = queue.push(sink, sensors, created_at)
+        if evicted:
+            logging.warning(f"{sink} queue full - dropped {evicted} oldest reading(s)")
+        logging.info(f"Queued reading for {sink} ({queue.count(sink)} waiting)")
     except Exception as e:
-        logging.error(f"Error reading sensors: {e}")
-        return None
+        logging.error(f"Failed to queue reading for {sink}: {e}")
+
+
+def send_backlog_chunk(aio, chunk):
+    """Send several queued readings with one batch request per feed"""
+    for sensor, feed_name in FEED_MAPPING.items():
+        data = [
+            Data(value=sensors[sensor], created_at=format_created_at(created_at))
+            for _, created_at, sensors in chunk
+            if sensor in sensors
+        ]
+        if data:
+            # A failure part-way through re-sends the earlier feeds next time;
+            # a duplicate point is better than a lost one
+            with _timings.measure('adafruit_io.request'):
+                aio.send_batch_data(feed_name, data)
+
+
+def drain_adafruit_queue():
+    """Send queued readings with their original timestamps as fast as the rate limit allows"""
+    queue = get_reading_queue()
+    if queue.count('adafruit') == 0:
+        return
+
+    aio = get_adafruit_client()
+    limiter = get_adafruit_rate_limiter()
+    deadline = time.monotonic() + QUEUE_DRAIN_MAX_SECONDS
+    drained = 0
+
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # Take as many readings as the budget has free right now, so a
+            # chunk never waits on the live readings' share of the window.
+            # A single reading goes as one group request (waiting for the
+            # budget at most until the deadline); several as one batch
+            # request per feed.
+            chunk_size = max(1, limiter.available() // len(FEED_MAPPING))
+            chunk = queue.peek('adafruit', chunk_size)
+            if not chunk:
+                break
+
+            if len(chunk) == 1:
+                _, created_at, sensors = chunk[0]
+                chunk = chunk[:1]
+                if not publish_batch_to_adafruit(aio, sensors, created_at, max_wait=remaining):
+                    break
+            else:
+                points = sum(len(sensors) for _, _, sensors in chunk)
+                if not limiter.acquire(points, max_wait=0):
+                    break
+                send_backlog_chunk(aio, chunk)
+
+            queue.ack([row_id for row_id, _, _ in chunk])
+            drained += len(chunk)
+
+    except ThrottlingError:
+        limiter.throttled(retry_after_seconds(aio))
+    except CircuitOpenError as e:
+        log_detail(f"Not sending queued readings: {e}")
+    except Exception as e:
+        logging.error(f"Error sending queued readings to Adafruit IO: {e}")
+
+    if drained:
+        logging.info(f"Sent {drained} queued reading(s) to Adafruit IO ({queue.count('adafruit')} still waiting)")
 
 
 def publish_to_adafruit(sensors):
@@ -153,58 +723,51 @@ def publish_to_adafruit(sensors):
         return False
 
     try:
-        # Create Adafruit IO client
-        aio = Client(ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY)
+        aio = get_adafruit_client()
 
-        # Publish each sensor to its own feed
-        feed_mapping = {
-            'temperature': 'enviro-temperature',
-            'pressure': 'enviro-pressure',
-            'humidity': 'enviro-humidity',
-            'light': 'enviro-light',
-            'proximity': 'enviro-proximity',
-            'oxidising': 'enviro-oxidising',
-            'reducing': 'enviro-reducing',
-            'nh3': 'enviro-nh3'
-        }
+        if ADAFRUIT_IO_BATCH:
+            return publish_batch_to_adafruit(aio, sensors)
 
-        for sensor, feed_name in feed_mapping.items():
+        limiter = get_adafruit_rate_limiter()
+
+        # Publish each sensor to its own feed
+        for sensor, feed_name in FEED_MAPPING.items():
             if sensor in sensors:
                 try:
-                    aio.send_data(feed_name, sensors[sensor])
-                    logging.info(f"Published {sensor}: {sensors[sensor]} to {feed_name}")
-                    # Small delay to avoid rate limiting
-                    time.sleep(0.5)
+                    limiter.acquire()
+                    send_feed_value(aio, feed_name, sensors[sensor])
+                    log_detail(f"Published {sensor}: {sensors[sensor]} to {feed_name}")
+                except ThrottlingError:
+                    limiter.throttled(retry_after_seconds(aio))
+                    try:
+                        limiter.acquire()
+                        send_feed_value(aio, feed_name, sensors[sensor])
+                        log_detail(f"Published {sensor}: {sensors[sensor]} to {feed_name}")
+                    except Exception as retry_error:
+                        logging.error(f"Failed to publish {sensor} after retry: {retry_error}")
                 except RequestError as e:
                     # Check if feed doesn't exist (404)
                     if "404" in str(e) or "not found" in str(e).lower():
                         logging.info(f"Feed {feed_name} doesn't exist, creating it...")
                         try:
                             # Create the feed
-                            from Adafruit_IO import Feed
                             new_feed = Feed(name=feed_name)
                             aio.create_feed(new_feed)
                             logging.info(f"Created feed {feed_name}")
-                            time.sleep(0.5)
-                            # Now send the data
-                            aio.send_data(feed_name, sensors[sensor])
-                            logging.info(f"Published {sensor}: {sensors[sensor]} to {feed_name}")
+                            # Now send the data (the failed send didn't store a point)
+                            send_feed_value(aio, feed_name, sensors[sensor])
+                            log_detail(f"Published {sensor}: {sensors[sensor]} to {feed_name}")
                         except Exception as create_error:
                             logging.error(f"Failed to create/publish {sensor}: {create_error}")
-                    # Check if it's a rate limit error (429)
-                    elif "429" in str(e) or "throttle" in str(e).lower():
-                        logging.warning(f"Rate limited - waiting 30 seconds")
-                        time.sleep(30)
-                        try:
-                            aio.send_data(feed_name, sensors[sensor])
-                        except Exception as retry_error:
-                            logging.error(f"Failed to publish {sensor} after retry: {retry_error}")
                     else:
                         logging.error(f"Failed to publish {sensor}: {e}")
+                except CircuitOpenError:
+                    # The rest would fail the same way; queue the whole reading
+                    raise
                 except Exception as e:
                     logging.error(f"Unexpected error publishing {sensor}: {e}")
 
-        logging.info("Successfully published all data to Adafruit IO")
+        log_detail("Successfully published all data to Adafruit IO")
         return True
 
     except Exception as e:
@@ -212,8 +775,12 @@ def publish_to_adafruit(sensors):
         return False
 
 
-def publish_to_homeassistant(sensors):
-    """Publish sensor data to Home Assistant via MQTT with auto-discovery"""
+def publish_to_homeassistant(sensors, stats=None):
+    """Publish sensor data to Home Assistant via MQTT with auto-discovery
+
+    When `stats` is given (sampling mode), each sensor's window min/max/stddev
+    is published as entity attributes alongside the mean.
+    """
 
     # Check if MQTT is configured
     if not MQTT_USERNAME or not MQTT_PASSWORD:
@@ -221,17 +788,7 @@ def publish_to_homeassistant(sensors):
         return True
 
     try:
-        # Create MQTT client
-        client = mqtt.Client(client_id="enviroplus", protocol=mqtt.MQTTv5)
-        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-
-        # Connect to broker
-        logging.info(f"Connecting to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}")
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        client.loop_start()
-
-        # Give connection time to establish
-        time.sleep(1)
+        client = get_mqtt_client()
 
         # Define sensor configurations for MQTT Discovery
         sensor_configs = {
@@ -283,25 +840,32 @@ def publish_to_homeassistant(sensors):
 
         # Device information (groups all sensors together in HA)
         device_info = {
-            'identifiers': ['enviroplus_sensor'],
-            'name': 'Enviro+ Sensor',
+            'identifiers': [f'{HOMEASSISTANT_NODE}_sensor'],
+            'name': f'Enviro+ Sensor ({DEVICE_ID})' if DEVICE_ID else 'Enviro+ Sensor',
             'model': 'Pimoroni Enviro+',
             'manufacturer': 'Pimoroni'
         }
 
         # Publish discovery configs and sensor values
+        json_state_topic = f"homeassistant/sensor/{HOMEASSISTANT_NODE}/state"
+        discovery_changed = False
+        pending = []
+        publish_started = time.monotonic()
         for sensor_key, sensor_value in sensors.items():
             if sensor_key in sensor_configs:
                 config = sensor_configs[sensor_key]
 
                 # MQTT Discovery configuration
-                discovery_topic = f"homeassistant/sensor/enviroplus/{sensor_key}/config"
-                state_topic = f"homeassistant/sensor/enviroplus/{sensor_key}/state"
+                discovery_topic = f"homeassistant/sensor/{HOMEASSISTANT_NODE}/{sensor_key}/config"
+                if HOMEASSISTANT_JSON_STATE:
+                    state_topic = json_state_topic
+                else:
+                    state_topic = f"homeassistant/sensor/{HOMEASSISTANT_NODE}/{sensor_key}/state"
 
                 discovery_payload = {
                     'name': config['name'],
                     'state_topic': state_topic,
-                    'unique_id': f'enviroplus_{sensor_key}',
+                    'unique_id': f'{HOMEASSISTANT_NODE}_{sensor_key}',
                     'device': device_info,
                     'icon': config['icon']
                 }
@@ -312,74 +876,501 @@ def publish_to_homeassistant(sensors):
                 if config.get('device_class'):
                     discovery_payload['device_class'] = config['device_class']
 
-                # Publish discovery config
-                client.publish(discovery_topic, json.dumps(discovery_payload), qos=1, retain=True)
-                logging.info(f"Published MQTT discovery for {sensor_key}")
+                if HOMEASSISTANT_JSON_STATE:
+                    discovery_payload['value_template'] = f"{{{{ value_json.{sensor_key} }}}}"
+
+                attributes_topic = f"homeassistant/sensor/{HOMEASSISTANT_NODE}/{sensor_key}/attributes"
+                if stats and sensor_key in stats:
+                    if HOMEASSISTANT_JSON_STATE:
+                        discovery_payload['json_attributes_topic'] = json_state_topic
+                        discovery_payload['json_attributes_template'] = f"{{{{ value_json.stats.{sensor_key} | tojson }}}}"
+                    else:
+                        discovery_payload['json_attributes_topic'] = attributes_topic
+
+                # Publish discovery config only when it changed
+                discovery_json = json.dumps(discovery_payload, sort_keys=True)
+                if discovery_needs_publish(discovery_topic, discovery_json):
+                    pending.append(client.publish(discovery_topic, discovery_json, qos=1, retain=True))
+                    discovery_changed = True
+                    log_detail(f"Published MQTT discovery for {sensor_key}")
+
+                if HOMEASSISTANT_JSON_STATE:
+                    continue
 
                 # Publish sensor value
-                client.publish(state_topic, str(sensor_value), qos=1, retain=True)
-                logging.info(f"Published {sensor_key}: {sensor_value} to Home Assistant")
+                pending.append(client.publish(state_topic, str(sensor_value), qos=1, retain=True))
+                log_detail(f"Published {sensor_key}: {sensor_value} to Home Assistant")
 
-                # Small delay to avoid overwhelming the broker
-                time.sleep(0.2)
+                if stats and sensor_key in stats:
+                    pending.append(client.publish(attributes_topic, json.dumps(stats[sensor_key]), qos=1, retain=True))
 
-        # Clean disconnect
-        time.sleep(1)
-        client.loop_stop()
-        client.disconnect()
+        if HOMEASSISTANT_JSON_STATE:
+            state = {key: value for key, value in sensors.items() if key in sensor_configs}
+            if stats:
+                state['stats'] = stats
+            pending.append(client.publish(json_state_topic, json.dumps(state), qos=1, retain=True))
+            log_detail(f"Published {len(sensors)} readings to Home Assistant in one message")
 
-        logging.info("Successfully published all data to Home Assistant")
+        # Confirm delivery with the broker's acknowledgements
+        wait_for_publishes(pending, MQTT_TIMEOUT, publish_started)
+
+        if discovery_changed:
+            with _discovery_lock:
+                save_discovery_cache()
+
+        log_detail("Successfully published all data to Home Assistant")
         return True
 
     except Exception as e:
         logging.error(f"Error publishing to Home Assistant: {e}")
+        # Drop the connection so the next cycle starts from a fresh one, and
+        # don't trust that this cycle's discovery configs reached the broker
+        close_mqtt_client()
+        forget_discovery()
         return False
 
 
-def main():
-    logging.info("=" * 60)
-    logging.info("Starting Enviro+ sensor read and publish")
+def publish_to_aggregator(sensors, created_at, stats=None):
+    """Hand a reading to aggregator.py over MQTT, confirmed by the broker's acknowledgement"""
+    try:
+        client = get_mqtt_client()
+        topic = reading_topic(AGGREGATOR_TOPIC, DEVICE_ID)
+        info = client.publish(topic, encode_reading(sensors, created_at, stats), qos=1)
+        wait_for_publishes([info], MQTT_TIMEOUT)
+        log_detail(f"Sent {len(sensors)} readings to the aggregator on {topic}")
+        return True
+
+    except Exception as e:
+        logging.error(f"Error sending reading to the aggregator: {e}")
+        return False
+
+
+def drain_aggregator_queue():
+    """Resend readings the broker didn't take earlier, with their original timestamps"""
+    queue = get_reading_queue()
+    deadline = time.monotonic() + QUEUE_DRAIN_MAX_SECONDS
+    topic = reading_topic(AGGREGATOR_TOPIC, DEVICE_ID)
+    drained = 0
+
+    try:
+        while time.monotonic() < deadline:
+            chunk = queue.peek('aggregator', 100)
+            if not chunk:
+                break
+            client = get_mqtt_client()
+            pending = [client.publish(topic, encode_reading(sensors, created_at), qos=1)
+                       for _, created_at, sensors in chunk]
+            wait_for_publishes(pending, MQTT_TIMEOUT)
+            queue.ack([row_id for row_id, _, _ in chunk])
+            drained += len(chunk)
+    except Exception as e:
+        logging.error(f"Error sending queued readings to the aggregator: {e}")
+
+    if drained:
+        logging.info(f"Sent {drained} queued reading(s) to the aggregator ({queue.count('aggregator')} still waiting)")
+
+
+def record_history(sensors, created_at, stats=None):
+    """Append a reading to the local round-robin history"""
+    global _history_store
+
+    try:
+        if _history_store is None:
+            from timeseries_store import TimeSeriesStore
+
+            _history_store = TimeSeriesStore(HISTORY_DIR)
+        # No explicit flush: the kernel writes dirty pages back on its own
+        # schedule, which batches SD card writes in daemon mode
+        _history_store.append_reading(sensors, created_at, stats)
+    except Exception as e:
+        logging.error(f"Failed to record local history: {e}")
+
+
+def close_history():
+    global _history_store
+
+    if _history_store is not None:
+        _history_store.close()
+        _history_store = None
+
+
+def publish_adafruit_with_queue(sensors, created_at):
+    """Publish to Adafruit IO, queueing the reading on failure and draining the backlog on success"""
+    success = publish_to_adafruit(sensors)
+    if ENABLE_READING_QUEUE and ADAFRUIT_IO_USERNAME and ADAFRUIT_IO_KEY:
+        if success:
+            drain_adafruit_queue()
+        else:
+            queue_reading('adafruit', sensors, created_at)
+    return success
+
+
+def get_deadband():
+    """Deadband filter from DEADBAND, or None when it's not configured"""
+    global _deadband
+
+    if _deadband is None and DEADBAND:
+        _deadband = Deadband(parse_thresholds(DEADBAND), DEADBAND_HEARTBEAT,
+                             state_file=STATE_DIR / '.deadband_state.json')
+    return _deadband
+
+
+def values_to_send(service, reading):
+    """The part of a reading that passes the deadband for `service`"""
+    deadband = get_deadband()
+    if deadband is None:
+        return reading.sensors
+    sensors = deadband.filter(service, reading.sensors, reading.created_at)
+    skipped = len(reading.sensors) - len(sensors)
+    if skipped:
+        log_detail(f"{service}: {skipped} value(s) within their deadband, not sending them")
+    return sensors
+
+
+def mark_sent(service, sensors, reading):
+    deadband = get_deadband()
+    if deadband is not None:
+        deadband.commit(service, sensors, reading.created_at)
+
+
+class AdafruitSink(Sink):
+    """Adafruit IO, with failed and overflowing readings kept in the offline queue"""
+
+    name = "Adafruit IO"
+
+    def publish(self, reading):
+        sensors = values_to_send('adafruit', reading)
+        if not sensors:
+            # Nothing new to say, but the backlog can still go out
+            if ENABLE_READING_QUEUE and ADAFRUIT_IO_USERNAME and ADAFRUIT_IO_KEY:
+                drain_adafruit_queue()
+            return True
+        success = publish_adafruit_with_queue(sensors, reading.created_at)
+        if success:
+            mark_sent('adafruit', sensors, reading)
+        return success
+
+    def on_drop(self, reading):
+        if ENABLE_READING_QUEUE and ADAFRUIT_IO_USERNAME and ADAFRUIT_IO_KEY:
+            queue_reading('adafruit', reading.sensors, reading.created_at)
+        else:
+            super().on_drop(reading)
+
+
+class HomeAssistantSink(Sink):
+    """Home Assistant via MQTT discovery"""
+
+    name = "Home Assistant"
+    # Only the latest state matters to Home Assistant
+    overload_policy = 'coalesce'
+
+    def publish(self, reading):
+        sensors = values_to_send('homeassistant', reading)
+        if not sensors:
+            return True
+        if HOMEASSISTANT_JSON_STATE:
+            # Every entity reads the shared state message, so it needs every value
+            sensors = reading.sensors
+        success = publish_to_homeassistant(sensors, reading.stats)
+        if success:
+            mark_sent('homeassistant', sensors, reading)
+        return success
+
+
+class AggregatorSink(Sink):
+    """aggregator.py via MQTT, with failed and overflowing readings kept in the offline queue"""
+
+    name = "Aggregator"
+
+    def publish(self, reading):
+        sensors = values_to_send('aggregator', reading)
+        if not sensors:
+            return True
+        success = publish_to_aggregator(sensors, reading.created_at, reading.stats)
+        if ENABLE_READING_QUEUE:
+            if success:
+                drain_aggregator_queue()
+            else:
+                queue_reading('aggregator', sensors, reading.created_at)
+        if success:
+            mark_sent('aggregator', sensors, reading)
+        return success
+
+    def on_drop(self, reading):
+        if ENABLE_READING_QUEUE:
+            queue_reading('aggregator', reading.sensors, reading.created_at)
+        else:
+            super().on_drop(reading)
+
+
+def build_pipeline():
+    """Create a worker for every sink enabled in the configuration"""
+    pipeline = FanOut(timings=_timings)
+    # Check DEADBAND now so a typo is reported at startup
+    get_deadband()
+
+    def add(sink, timeout=SINK_TIMEOUT):
+        policy = getattr(sink, 'overload_policy', None) or SINK_OVERLOAD_POLICY
+        pipeline.add(sink, queue_size=SINK_QUEUE_SIZE, policy=policy, timeout=timeout)
 
-    # Log which services are enabled
-    services_enabled = []
     if ENABLE_ADAFRUIT_IO:
-        services_enabled.append("Adafruit IO")
+        add(AdafruitSink(), ADAFRUIT_IO_TIMEOUT)
     if ENABLE_HOMEASSISTANT:
-        services_enabled.append("Home Assistant")
+        add(HomeAssistantSink(), HOMEASSISTANT_TIMEOUT)
+    if ENABLE_AGGREGATOR:
+        if not DEVICE_ID:
+            raise ValueError("ENABLE_AGGREGATOR needs a DEVICE_ID to tell this unit's readings apart")
+        add(AggregatorSink(), HOMEASSISTANT_TIMEOUT)
+    if CSV_FILE:
+        add(CsvSink(CSV_FILE, SENSOR_KEYS))
+    if NDJSON_FILE:
+        add(NdjsonSink(NDJSON_FILE))
+    if INFLUXDB_URL:
+        add(InfluxHttpSink(INFLUXDB_URL, token=INFLUXDB_TOKEN, measurement=INFLUXDB_MEASUREMENT))
+    if INFLUXDB_UDP:
+        host, port = udp_address(INFLUXDB_UDP)
+        add(InfluxUdpSink(host, port, measurement=INFLUXDB_MEASUREMENT))
+    return pipeline
+
+
+def get_pipeline():
+    global _pipeline
+
+    if _pipeline is None:
+        _pipeline = build_pipeline()
+    return _pipeline
+
+
+def close_pipeline():
+    """Stop the sink workers; anything still queued for Adafruit IO goes to disk"""
+    global _pipeline
+
+    if _pipeline is not None:
+        _pipeline.close()
+        _pipeline = None
+
+
+def log_reading_summary(sensors, results=None):
+    """The single line per reading logged with LOG_SUMMARY"""
+    line = "Reading: " + ", ".join(f"{key}={value:g}" for key, value in sensors.items())
+    if results:
+        line += " | " + ", ".join(f"{name} {'ok' if ok else 'FAILED'}" for name, ok in results.items())
+    logging.info(line, extra={'fields': {'sensors': sensors, 'sinks': results}})
+
+
+def publish_reading(sensors, created_at, stats=None, wait=True):
+    """Record a reading and hand it to every enabled sink
+
+    `stats` holds per-sensor min/max/stddev when the reading is a window mean.
+    Sinks publish concurrently from their own workers. With `wait`, blocks
+    until each sink finishes or misses its own deadline and returns True if
+    every sink succeeded; without it (daemon mode) returns straight away so
+    a slow sink can't hold up sampling.
+    """
+    if ENABLE_LOCAL_HISTORY:
+        record_history(sensors, created_at, stats)
+
+    pipeline = get_pipeline()
+    if not pipeline:
+        return True
 
-    if not services_enabled:
-        logging.error("No publishing services enabled! Check ENABLE_ADAFRUIT_IO and ENABLE_HOMEASSISTANT in .env")
-        sys.exit(1)
+    tickets = pipeline.submit(Reading(sensors, created_at, stats, DEVICE_ID or None))
+    if not wait:
+        if LOG_SUMMARY:
+            log_reading_summary(sensors)
+        return True
 
-    logging.info(f"Publishing enabled for: {', '.join(services_enabled)}")
+    results = pipeline.wait(tickets)
+    if LOG_SUMMARY:
+        log_reading_summary(sensors, results)
 
-    # Read sensors
-    sensors = read_sensors()
-    if not sensors:
-        logging.error("Failed to read sensors - aborting")
-        sys.exit(1)
+    # Consider it a success if all enabled services worked
+    if all(results.values()):
+        log_detail("Sensor reading and publishing completed successfully")
+        return True
 
-    # Publish to enabled services
-    adafruit_success = True  # Default to success if disabled
-    homeassistant_success = True  # Default to success if disabled
+    failed = [name for name, success in results.items() if not success]
+    logging.error(f"Failed to publish data to: {', '.join(failed)}")
+    return False
 
-    if ENABLE_ADAFRUIT_IO:
-        adafruit_success = publish_to_adafruit(sensors)
+
+def run_cycle(wait=True):
+    """Read the sensors once and publish to every enabled service"""
+    with _timings.measure('cycle'):
+        # Read sensors
+        created_at = time.time()
+        sensors = read_sensors()
+        if not sensors:
+            logging.error("Failed to read sensors - aborting")
+            return False
+
+        return publish_reading(sensors, created_at, wait=wait)
+
+
+def finish_timings(save=True):
+    """Count a finished cycle, save the timings status file and log a summary now and then
+
+    The daemon passes save=False and the file is then only written with
+    each summary (and on shutdown), to spare the SD card.
+    """
+    _timings.cycles += 1
+    summary = TIMINGS_SUMMARY_EVERY and _timings.cycles % TIMINGS_SUMMARY_EVERY == 0
+    if summary:
+        _timings.log_summary()
+    if save or summary:
+        _timings.save()
+    if _metrics_cache is not None:
+        _metrics_cache.set_timings(_timings.snapshot())
+
+
+def publish_window(aggregator):
+    """Publish the mean of the samples collected since the last publish"""
+    if len(aggregator) == 0:
+        logging.error("No sensor samples collected this interval - skipping publish")
+        return False
+
+    sensors, stats = aggregator.summarize()
+    log_detail(f"Aggregated {len(aggregator)} samples: " + ", ".join(
+        f"{key}={sensors[key]}±{stats[key]['stddev']}" for key in sensors))
+    if aggregator.dropped:
+        logging.warning(f"Sample buffer full - dropped {aggregator.dropped} sample(s)")
+    aggregator.reset()
+
+    with _timings.measure('cycle'):
+        return publish_reading(sensors, time.time(), stats, wait=False)
+
+
+def run_daemon(interval, sample_rate=0):
+    """Publish every `interval` seconds until SIGTERM/SIGINT
+
+    With `sample_rate`, sensors are read that many times per second in
+    between and each publish sends the aggregate of the window.
+    """
+
+    def request_shutdown(signum, frame):
+        logging.info(f"Received signal {signum}, shutting down after this cycle")
+        _shutdown.set()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    global _metrics_cache
+    metrics_server = None
+    if METRICS_PORT:
+        from metrics_exporter import MetricsCache, start_metrics_server
+
+        _metrics_cache = MetricsCache()
+        try:
+            metrics_server = start_metrics_server(_metrics_cache, METRICS_PORT, METRICS_BIND)
+        except OSError as e:
+            logging.error(f"Could not start metrics server on port {METRICS_PORT}: {e}")
+            _metrics_cache = None
+
+    aggregator = None
+    if sample_rate > 0:
+        # Only needed in sampling mode, so plain runs don't pay for importing NumPy
+        from sampler import WindowAggregator
+
+        sample_period = 1.0 / sample_rate
+        # Headroom for a window that runs long because a publish overran
+        aggregator = WindowAggregator(SENSOR_KEYS, capacity=interval * sample_rate * 2 + 1)
+        logging.info(f"Running as a daemon, sampling at {sample_rate:g} Hz and publishing every {interval:g} seconds")
     else:
-        logging.info("Adafruit IO publishing disabled - skipping")
+        logging.info(f"Running as a daemon, publishing every {interval:g} seconds")
+
+    now = time.monotonic()
+    # When sampling, the first publish waits for a full window
+    next_run = now + interval if aggregator is not None else now
+    next_sample = now
+
+    while not _shutdown.is_set():
+        if aggregator is not None and time.monotonic() >= next_sample:
+            try:
+                sample = read_sensors(quiet=True, fresh_only=True)
+                if sample:
+                    aggregator.add(sample)
+            except Exception as e:
+                logging.error(f"Unexpected error while sampling: {e}")
+            next_sample += sample_period
+            if next_sample < time.monotonic():
+                next_sample = time.monotonic() + sample_period
+
+        if time.monotonic() >= next_run:
+            log_detail("-" * 60)
+            try:
+                if aggregator is not None:
+                    publish_window(aggregator)
+                else:
+                    run_cycle(wait=False)
+            except Exception as e:
+                # Never let one bad cycle kill the service
+                logging.error(f"Unexpected error during cycle: {e}")
+            finish_timings(save=False)
+
+            # Keep a fixed cadence; if a cycle overran, skip the missed slots
+            next_run += interval
+            now = time.monotonic()
+            if next_run < now:
+                skipped = int((now - next_run) // interval) + 1
+                logging.warning(f"Cycle overran the {interval:g}s interval, skipping {skipped} slot(s)")
+                next_run += skipped * interval
+
+        wake = min(next_run, next_sample) if aggregator is not None else next_run
+        _shutdown.wait(max(0.0, wake - time.monotonic()))
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    close_pipeline()
+    close_mqtt_client()
+    close_history()
+    _timings.save()
+    logging.info("Daemon stopped")
 
-    if ENABLE_HOMEASSISTANT:
-        homeassistant_success = publish_to_homeassistant(sensors)
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish Enviro+ sensor readings to Adafruit IO and Home Assistant")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and publish on a fixed interval instead of once")
+    parser.add_argument('--interval', type=float, default=PUBLISH_INTERVAL,
+                        help=f"seconds between readings in daemon mode (default: {PUBLISH_INTERVAL:g})")
+    parser.add_argument('--sample-rate', type=float, default=SAMPLE_RATE,
+                        help="samples per second to average over each interval in daemon mode (default: off)")
+    args = parser.parse_args()
+
+    if args.interval <= 0:
+        parser.error("--interval must be greater than 0")
+    if args.sample_rate < 0:
+        parser.error("--sample-rate can't be negative")
+
+    log_detail("=" * 60)
+    log_detail("Starting Enviro+ sensor read and publish")
+
+    # Log which services are enabled
+    try:
+        services_enabled = get_pipeline().names()
+    except Exception as e:
+        logging.error(f"Invalid sink configuration: {e}")
+        sys.exit(1)
+
+    if not services_enabled and not ENABLE_LOCAL_HISTORY:
+        logging.error("No publishing services enabled! Check ENABLE_ADAFRUIT_IO and ENABLE_HOMEASSISTANT in .env")
+        sys.exit(1)
+
+    if services_enabled:
+        log_detail(f"Publishing enabled for: {', '.join(services_enabled)}")
     else:
-        logging.info("Home Assistant publishing disabled - skipping")
+        log_detail("Publishing disabled - recording local history only")
 
-    # Consider it a success if all enabled services worked
-    if adafruit_success and homeassistant_success:
-        logging.info("Sensor reading and publishing completed successfully")
+    if args.daemon:
+        run_daemon(args.interval, args.sample_rate)
         sys.exit(0)
-    else:
-        logging.error("Failed to publish data to one or more enabled services")
-        sys.exit(1)
+
+    success = run_cycle()
+    close_pipeline()
+    close_mqtt_client()
+    close_history()
+    finish_timings()
+    sys.exit(0 if success else 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""
+Token bucket rate limiter for the Adafruit IO data rate limit
+
+Adafruit IO counts every data point against a per-minute budget (30 on the
+free tier). The bucket holds `burst` tokens and refills at limit / 60
+tokens per second, so sends are paced and the whole budget can be used.
+A log of the points sent in the last 60 seconds is kept alongside it, and
+a send waits until it fits, so no rolling minute ever contains more than
+`limit` points even right after a burst. State is kept in a small JSON
+file so cron runs, the daemon, reset_feed.py and export_history.py all
+share one budget.
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+
+# Adafruit IO's rate limit window
+WINDOW_SECONDS = 60.0
+
+
+class TokenBucket:
+    """Block callers until sending `n` data points stays inside the rate limit"""
+
+    def __init__(self, limit_per_minute, burst=None, state_file=None):
+        if limit_per_minute <= 0:
+            raise ValueError("limit_per_minute must be greater than 0")
+
+        self.limit = float(limit_per_minute)
+        # Default burst: a quarter of the budget, but always at least one token
+        self.burst = float(burst) if burst else max(1.0, self.limit / 4)
+        self.burst = min(self.burst, self.limit)
+        self.refill_per_second = self.limit / WINDOW_SECONDS
+        self.state_file = state_file
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._blocked_until = 0.0
+        # [time, points] of every send in the last WINDOW_SECONDS
+        self._sent = []
+
+    def _load(self):
+        """Pick up state written by other processes"""
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self._tokens = min(float(state['tokens']), self.burst)
+            self._updated = float(state['updated'])
+            self._blocked_until = float(state.get('blocked_until', 0))
+            self._sent = [[float(at), float(points)] for at, points in state.get('sent', [])]
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or corrupt state just means a full bucket
+            pass
+
+    def _save(self):
+        if not self.state_file:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                'tokens': self._tokens,
+                'updated': self._updated,
+                'blocked_until': self._blocked_until,
+                'sent': self._sent
+            }, f)
+        os.replace(tmp_file, self.state_file)
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.refill_per_second)
+        self._updated = now
+        self._sent = [entry for entry in self._sent if entry[0] > now - WINDOW_SECONDS]
+
+    def _window_wait(self, now, points):
+        """Seconds until `points` (at most `limit`) more fit in the rolling window"""
+        excess = sum(sent for _, sent in self._sent) + points - self.limit
+        if excess <= 0:
+            return 0.0
+        # Wait for the oldest sends to leave the window until there's room
+        for at, sent in self._sent:
+            excess -= sent
+            if excess <= 0:
+                return max(0.0, at + WINDOW_SECONDS - now)
+        return WINDOW_SECONDS
+
+    def _locked(self):
+        """Serialize access across threads and, with a state file, across processes"""
+        return _StateLock(self._lock, self.state_file)
+
+    def acquire(self, tokens=1, max_wait=None):
+        """Wait until `tokens` data points can be sent, then consume them
+
+        Returns False without consuming anything if that would take longer
+        than `max_wait` seconds.
+        """
+        # A request larger than the bucket can never fit; let it drain the
+        # bucket completely and go into debt instead of waiting forever.
+        # Likewise it only has to wait for an empty window.
+        needed = min(float(tokens), self.burst)
+        window_needed = min(float(tokens), self.limit)
+        waited = 0.0
+
+        while True:
+            with self._locked():
+                self._load()
+                now = time.time()
+                self._refill(now)
+                window_wait = self._window_wait(now, window_needed)
+
+                if now >= self._blocked_until and self._tokens >= needed and window_wait <= 0:
+                    self._tokens -= tokens
+                    self._sent.append([now, float(tokens)])
+                    self._save()
+                    return True
+
+                wait = max(self._blocked_until - now, window_wait,
+                           (needed - self._tokens) / self.refill_per_second)
+
+            if max_wait is not None and waited + wait > max_wait:
+                return False
+
+            logging.debug(f"Rate limiter waiting {wait:.1f}s for {tokens} data point(s)")
+            time.sleep(wait)
+            waited += wait
+
+    def available(self):
+        """Data points that could be sent right now without waiting"""
+        with self._locked():
+            self._load()
+            now = time.time()
+            self._refill(now)
+            if now < self._blocked_until:
+                return 0
+            in_window = sum(entry[1] for entry in self._sent)
+            return max(0, int(min(self._tokens, self.limit - in_window)))
+
+    def throttled(self, retry_after=None):
+        """Record a 429 from the server: empty the bucket and pause sends
+
+        Without a Retry-After hint, pause for one full rate limit window.
+        """
+        pause = retry_after if retry_after is not None else 60.0
+        with self._locked():
+            self._load()
+            now = time.time()
+            self._refill(now)
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, now + pause)
+            self._save()
+        logging.warning(f"Adafruit IO throttled us - pausing sends for {pause:g} seconds")
+
+
+class _StateLock:
+    """Thread lock plus an advisory file lock next to the state file"""
+
+    def __init__(self, thread_lock, state_file):
+        self.thread_lock = thread_lock
+        self.lock_file = f"{state_file}.lock" if state_file else None
+        self._fd = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.lock_file:
+            try:
+                self._fd = open(self.lock_file, 'a')
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except OSError:
+                self._fd = None
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+        self.thread_lock.release()
+
+
+def retry_after_seconds(aio):
+    """Read the Retry-After header from the client's last response, if any"""
+    response = getattr(aio, '_last_response', None)
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def limited_request(limiter, aio, request, *args, retries=5, **kwargs):
+    """Make one Adafruit IO request within the rate limit, waiting out any 429s
+
+    `request` is a method of the client `aio`; its Retry-After decides how
+    long every user of the limiter pauses.
+    """
+    from Adafruit_IO import ThrottlingError
+
+    for attempt in range(retries + 1):
+        limiter.acquire(1)
+        try:
+            return request(*args, **kwargs)
+        except ThrottlingError:
+            if attempt == retries:
+                raise
+            limiter.throttled(retry_after_seconds(aio))
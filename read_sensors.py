@@ -4,41 +4,41 @@
 Read and display all Enviro+ sensor readings
 """
 
-import time
-from bme280 import BME280
-from smbus2 import SMBus
+import os
+from pathlib import Path
+from sensor_broker import open_sensors
+from compensation import load_compensation
 
+# Load .env for the compensation settings (and ENVIRO_BACKEND, SENSOR_SOCKET)
 try:
-    from ltr559 import LTR559
-    ltr559 = LTR559()
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=Path(__file__).parent.absolute() / '.env')
 except ImportError:
-    import ltr559
+    pass
 
-from enviroplus import gas
 
-
-def get_cpu_temperature():
-    """Get CPU temperature for BME280 compensation"""
-    with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-        temp = f.read()
-        temp = int(temp) / 1000.0
-    return temp
+def unavailable(health, name):
+    """Why a sensor's values are missing, from its health report"""
+    state = health.get(name) or {}
+    if state.get('healthy') is False:
+        return f"  Unavailable - unhealthy: {state['reason']}"
+    if state.get('reason'):
+        return f"  Unavailable - read failed: {state['reason']}"
+    return "  Unavailable"
 
 
 def main():
-    # Initialize sensors
-    bus = SMBus(1)
-    bme280 = BME280(i2c_dev=bus)
-
-    # Discard first reading (BME280 returns stale data on first read)
-    _ = bme280.get_temperature()
-    _ = bme280.get_pressure()
-    _ = bme280.get_humidity()
-    time.sleep(0.1)  # Brief delay for sensor stabilization
-
-    # CPU temperature compensation factor
-    # Higher factor = less compensation. Set to 0 to disable compensation.
-    factor = 1.71
+    # Latest values from the sensor broker if it's running, otherwise read
+    # every sensor once (ENVIRO_BACKEND=fake to try this without the HAT).
+    # Forced mode gives a fresh BME280 conversion, so nothing needs discarding.
+    # A sensor that fails is left out and the others are still shown.
+    sensors = open_sensors()
+    readings = sensors.read()
+    health = sensors.health_report()
+
+    # The same compensation the publisher uses: calibrate.py's fitted model,
+    # or TEMP_COMPENSATION_FACTOR (higher factor = less compensation, 0 = none)
+    compensation = load_compensation(factor=float(os.getenv('TEMP_COMPENSATION_FACTOR', '0')))
 
     print("\n" + "="*60)
     print("ENVIRO+ SENSOR READINGS")
@@ -48,52 +48,57 @@ def main():
     print("BME280 (Temperature/Pressure/Humidity)")
     print("-" * 40)
 
-    # Get compensated temperature
-    cpu_temp = get_cpu_temperature()
-    raw_temp = bme280.get_temperature()
-
-    # Calculate compensation
-    if factor > 0:
-        compensation_amount = (cpu_temp - raw_temp) / factor
-        comp_temp = raw_temp - compensation_amount
+    if 'raw_temperature' in readings:
+        # Get compensated temperature
+        cpu_temp = readings['cpu_temperature']
+        raw_temp = readings['raw_temperature']
+
+        # Calculate compensation
+        comp_temp = compensation.correct(raw_temp, cpu_temp, readings['humidity'])
+        compensation_amount = raw_temp - comp_temp
+
+        print(f"  Raw Temperature:   {raw_temp:.2f} °C")
+        if cpu_temp is not None:
+            print(f"  CPU Temperature:   {cpu_temp:.2f} °C")
+        print(f"  Compensation:      -{compensation_amount:.2f} °C ({compensation.describe()})")
+        print(f"  Compensated Temp:  {comp_temp:.2f} °C")
+        print(f"  Pressure:          {readings['pressure']:.2f} hPa")
+        print(f"  Humidity:          {readings['humidity']:.2f} %")
     else:
-        compensation_amount = 0
-        comp_temp = raw_temp
-
-    print(f"  Raw Temperature:   {raw_temp:.2f} °C")
-    print(f"  CPU Temperature:   {cpu_temp:.2f} °C")
-    print(f"  Compensation:      -{compensation_amount:.2f} °C")
-    print(f"  Compensated Temp:  {comp_temp:.2f} °C")
-    print(f"  Pressure:          {bme280.get_pressure():.2f} hPa")
-    print(f"  Humidity:          {bme280.get_humidity():.2f} %")
+        print(unavailable(health, 'bme280'))
     print()
 
     # === LTR559: Light and Proximity ===
     print("LTR559 (Light/Proximity)")
     print("-" * 40)
-    lux = ltr559.get_lux()
-    proximity = ltr559.get_proximity()
-    ch0, ch1 = ltr559.get_raw_als()
-
-    # Check for hardware failure
-    is_light_sensor_failed = ch1 > 0 and ch0 <= ch1 and lux < 20
-
-    print(f"  Light:             {lux:.2f} Lux")
-    if is_light_sensor_failed:
-        print(f"  ⚠️  WARNING: Light sensor hardware failure detected!")
-        print(f"      CH0 (Visible+IR): {ch0}")
-        print(f"      CH1 (IR only):    {ch1}")
-        print(f"      (CH1 >= CH0 indicates visible photodiode failure)")
-    print(f"  Proximity:         {proximity:.2f}")
+    if 'light_ch0' in readings:
+        ch0, ch1 = readings['light_ch0'], readings['light_ch1']
+        light_fault = (health.get('ltr559') or {}).get('faulty', {}).get('lux')
+
+        if 'lux' in readings:
+            print(f"  Light:             {readings['lux']:.2f} Lux")
+        if light_fault:
+            print(f"  ⚠️  WARNING: Light sensor hardware failure detected!")
+            print(f"      CH0 (Visible+IR): {ch0}")
+            print(f"      CH1 (IR only):    {ch1}")
+            print(f"      (CH1 >= CH0 indicates visible photodiode failure)")
+        print(f"  Proximity:         {readings['proximity']:.2f}")
+    else:
+        print(unavailable(health, 'ltr559'))
     print()
 
     # === MICS6814: Gas Sensor ===
     print("MICS6814 (Gas Sensor)")
     print("-" * 40)
-    gas_readings = gas.read_all()
-    print(f"  Oxidising:         {gas_readings.oxidising / 1000:.2f} kΩ")
-    print(f"  Reducing:          {gas_readings.reducing / 1000:.2f} kΩ")
-    print(f"  NH3:               {gas_readings.nh3 / 1000:.2f} kΩ")
+    if 'gas_oxidising_ohms' in readings:
+        print(f"  Oxidising:         {readings['gas_oxidising_ohms'] / 1000:.2f} kΩ")
+        print(f"  Reducing:          {readings['gas_reducing_ohms'] / 1000:.2f} kΩ")
+        print(f"  NH3:               {readings['gas_nh3_ohms'] / 1000:.2f} kΩ")
+    elif (health.get('gas') or {}).get('reason'):
+        print(unavailable(health, 'gas'))
+    else:
+        # The broker leaves the gas readings out while the heater warms up
+        print(f"  (warming up)")
     print()
 
     print("="*60 + "\n")
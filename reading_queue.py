@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Durable store-and-forward queue for sensor readings that failed to publish
+
+Readings are kept in a small SQLite database (WAL mode, so a crash or power
+cut mid-write can't corrupt it) together with the time they were captured.
+Each sink has its own backlog, capped at `max_readings` with the oldest
+readings evicted first.
+"""
+
+import json
+import sqlite3
+import threading
+
+
+class ReadingQueue:
+    """SQLite-backed FIFO of (created_at, sensors) per sink"""
+
+    def __init__(self, path, max_readings=10000):
+        self.path = str(path)
+        self.max_readings = max_readings
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is durable in WAL mode apart from the last commit before a power cut
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS readings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sink TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                payload TEXT NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS readings_sink_id ON readings (sink, id)")
+        self._db.commit()
+
+    def push(self, sink, sensors, created_at):
+        """Queue a reading for `sink`, evicting the oldest ones beyond the cap
+
+        Returns the number of readings evicted.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO readings (sink, created_at, payload) VALUES (?, ?, ?)",
+                (sink, created_at, json.dumps(sensors))
+            )
+            cursor = self._db.execute("""
+                DELETE FROM readings WHERE sink = ? AND id <= (
+                    SELECT id FROM readings WHERE sink = ?
+                    ORDER BY id DESC LIMIT 1 OFFSET ?
+                )
+            """, (sink, sink, self.max_readings))
+            return cursor.rowcount
+
+    def peek(self, sink, limit):
+        """Return up to `limit` of the oldest readings as (id, created_at, sensors)"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, created_at, payload FROM readings WHERE sink = ? ORDER BY id LIMIT ?",
+                (sink, limit)
+            ).fetchall()
+        return [(row_id, created_at, json.loads(payload)) for row_id, created_at, payload in rows]
+
+    def ack(self, ids):
+        """Remove readings that were published"""
+        if not ids:
+            return
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM readings WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def count(self, sink):
+        """Number of readings waiting for `sink`"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM readings WHERE sink = ?", (sink,)
+            ).fetchone()[0]
+
+    def sinks(self):
+        """Sinks with readings waiting"""
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT DISTINCT sink FROM readings ORDER BY sink")]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
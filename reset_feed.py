@@ -6,15 +6,34 @@ Usage:
   ./reset_feed.py enviro-temperature          # Reset one feed
   ./reset_feed.py enviro-temperature enviro-pressure  # Reset multiple feeds
   ./reset_feed.py all                         # Reset all feeds
+  ./reset_feed.py 'enviro-*'                  # Reset every feed matching a pattern
+  ./reset_feed.py --group enviro              # Reset every feed in a group
+  ./reset_feed.py --dry-run 'enviro-*'        # Show what would be reset
 
 Note: This deletes the entire feed and recreates it (faster than deleting
 individual data points which can trigger rate limiting).
+
+Feeds and groups are listed once up front, then the deletes and recreates
+run on a small pool of workers. Every request takes a token from the same
+rate limiter as publish_to_adafruit.py, so a reset never pushes the account
+over its limit, and a 429 pauses every worker for the Retry-After time.
+While Adafruit IO is down the shared circuit breaker (see adafruit_client.py)
+makes the remaining feeds fail fast instead of each waiting for a timeout.
+A recreated feed keeps its name, description and settings and goes back
+into the groups it was in.
 """
 
 import sys
 import os
+import argparse
+import threading
 from pathlib import Path
-from Adafruit_IO import Client, RequestError
+from concurrent.futures import ThreadPoolExecutor
+from requests import RequestException
+from Adafruit_IO import Feed, RequestError
+from adafruit_client import (CircuitOpenError, credentials, open_rate_limiter, worker_client, limited,
+                             select_feeds)
+from fleet import feed_mapping, bare_feed_key
 
 try:
     from dotenv import load_dotenv
@@ -25,59 +44,73 @@ except ImportError:
     print("Warning: python-dotenv not installed")
 
 # Load credentials
-ADAFRUIT_IO_USERNAME = os.getenv('ADAFRUIT_IO_USERNAME')
-ADAFRUIT_IO_KEY = os.getenv('ADAFRUIT_IO_KEY')
-
-# All feed names used by this project
-ALL_FEEDS = [
-    'enviro-temperature',
-    'enviro-pressure',
-    'enviro-humidity',
-    'enviro-light',
-    'enviro-proximity',
-    'enviro-oxidising',
-    'enviro-reducing',
-    'enviro-nh3'
-]
-
-
-def reset_feed(aio, feed_name):
-    """Reset a feed by deleting and recreating it"""
-    try:
-        print(f"Resetting feed: {feed_name}")
-
-        # Check if feed exists
-        try:
-            feed = aio.feeds(feed_name)
-            print(f"  Feed exists, deleting...")
-        except RequestError as e:
-            if "404" in str(e):
-                print(f"  Feed {feed_name} does not exist - nothing to reset")
-                return False
-            else:
-                raise
+ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY = credentials()
 
-        # Delete the feed (this deletes all data too)
-        aio.delete_feed(feed_name)
-        print(f"  Deleted feed {feed_name}")
+# All feed names used by this unit (see fleet.py)
+ALL_FEEDS = list(feed_mapping(os.getenv('DEVICE_ID', ''), os.getenv('ADAFRUIT_IO_FEED_PREFIX', '')).values())
+
+_print_lock = threading.Lock()
+
+
+def say(*lines):
+    """Print a feed's lines together, so workers don't interleave them"""
+    with _print_lock:
+        for line in lines:
+            print(line)
 
-        # Recreate the feed
-        from Adafruit_IO import Feed
-        new_feed = Feed(name=feed_name)
-        aio.create_feed(new_feed)
-        print(f"  Recreated feed {feed_name} (empty)")
 
+def feed_groups(groups):
+    """{feed key: [group keys]} from the group listing (keys without the group. prefix)"""
+    membership = {}
+    for group in groups:
+        for feed in group.feeds or ():
+            membership.setdefault(bare_feed_key(feed.key), []).append(group.key)
+    return membership
+
+
+def reset_feed(feed, groups, limiter):
+    """Reset a feed by deleting and recreating it (in the same groups)"""
+    aio = worker_client()
+    lines = [f"Resetting feed: {feed.key}"]
+    try:
+        # Delete the feed (this deletes all data too)
+        limited(limiter, aio.delete_feed, feed.key)
+        lines.append(f"  Deleted feed {feed.key}")
+
+        # Recreate the feed with the same settings
+        new_feed = Feed(name=feed.name, key=bare_feed_key(feed.key), description=feed.description,
+                        unit_type=feed.unit_type, unit_symbol=feed.unit_symbol,
+                        history=feed.history, visibility=feed.visibility, license=feed.license)
+        if groups:
+            limited(limiter, aio.create_feed, new_feed, group_key=groups[0])
+            for group in groups[1:]:
+                # The client library has no wrapper for this endpoint
+                limited(limiter, aio._post, f"groups/{group}/add", {'feed_key': new_feed.key})
+            lines.append(f"  Recreated feed {feed.key} (empty) in {', '.join(groups)}")
+        else:
+            limited(limiter, aio.create_feed, new_feed)
+            lines.append(f"  Recreated feed {feed.key} (empty)")
+        say(*lines)
         return True
 
     except RequestError as e:
-        print(f"  Error resetting {feed_name}: {e}")
-        return False
+        lines.append(f"  Error resetting {feed.key}: {e}")
     except Exception as e:
-        print(f"  Unexpected error: {e}")
-        return False
+        lines.append(f"  Unexpected error: {e}")
+    say(*lines)
+    return False
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Clear Adafruit IO feeds by deleting and recreating them")
+    parser.add_argument('feeds', nargs='*',
+                        help="feed keys or glob patterns ('enviro-*'), or 'all' for this project's feeds")
+    parser.add_argument('--group', help="reset the feeds in this group (only those matching FEEDS, if given)")
+    parser.add_argument('--dry-run', action='store_true', help="list the feeds that would be reset and stop")
+    parser.add_argument('--workers', type=int, default=4, help="feeds to reset at once (default: 4)")
+    parser.add_argument('--yes', action='store_true', help="don't ask for confirmation")
+    args = parser.parse_args()
+
     # Check credentials
     if not ADAFRUIT_IO_USERNAME or not ADAFRUIT_IO_KEY:
         print("Error: Adafruit IO credentials not configured!")
@@ -85,44 +118,71 @@ def main():
         sys.exit(1)
 
     # Check arguments
-    if len(sys.argv) < 2:
-        print("Usage: ./reset_feed.py <feed-name> [feed-name2 ...]")
-        print("       ./reset_feed.py all")
+    if not args.feeds and not args.group:
+        parser.print_usage()
         print("")
         print("Available feeds:")
         for feed in ALL_FEEDS:
             print(f"  - {feed}")
         sys.exit(1)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
-    # Create Adafruit IO client
-    aio = Client(ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY)
+    # Shared with publish_to_adafruit.py (one token per request)
+    limiter = open_rate_limiter()
 
-    # Determine which feeds to reset
-    if sys.argv[1] == "all":
-        feeds_to_reset = ALL_FEEDS
-        print(f"Resetting ALL feeds ({len(ALL_FEEDS)} total)\n")
-    else:
-        feeds_to_reset = sys.argv[1:]
-        print(f"Resetting {len(feeds_to_reset)} feed(s)\n")
+    # List everything once instead of checking each feed
+    aio = worker_client()
+    try:
+        feeds = {bare_feed_key(feed.key): feed for feed in limited(limiter, aio.feeds)}
+        membership = feed_groups(limited(limiter, aio.groups))
+    except (RequestError, CircuitOpenError, RequestException) as e:
+        print(f"Error listing feeds: {e}")
+        sys.exit(1)
 
-    # Confirm with user
-    print("WARNING: This will DELETE and RECREATE the feeds, removing all data.")
-    print("The feeds will be empty after this operation.")
-    response = input("Are you sure you want to proceed? (yes/no): ")
-    if response.lower() not in ['yes', 'y']:
-        print("Cancelled")
-        sys.exit(0)
+    # Determine which feeds to reset
+    candidates = feeds
+    if args.group:
+        candidates = {key: feed for key, feed in feeds.items() if args.group in membership.get(key, ())}
+        if not candidates:
+            print(f"Group {args.group} does not exist or has no feeds - nothing to reset")
+            sys.exit(1)
+    patterns = ALL_FEEDS if args.feeds == ['all'] else args.feeds or ['*']
+    feeds_to_reset, unmatched = select_feeds(patterns, candidates)
+
+    for pattern in unmatched:
+        print(f"Feed {pattern} does not exist - nothing to reset")
+    if not feeds_to_reset:
+        sys.exit(1)
 
+    print(f"Resetting {len(feeds_to_reset)} feed(s)\n")
+    for key in feeds_to_reset:
+        groups = membership.get(key)
+        print(f"  - {key}" + (f" (in {', '.join(groups)})" if groups else ""))
     print("")
 
-    # Reset each feed
-    success_count = 0
-    for feed_name in feeds_to_reset:
-        if reset_feed(aio, feed_name):
-            success_count += 1
+    if args.dry_run:
+        print("Dry run - nothing was changed")
+        sys.exit(0)
+
+    # Confirm with user
+    if not args.yes:
+        print("WARNING: This will DELETE and RECREATE the feeds, removing all data.")
+        print("The feeds will be empty after this operation.")
+        response = input("Are you sure you want to proceed? (yes/no): ")
+        if response.lower() not in ['yes', 'y']:
+            print("Cancelled")
+            sys.exit(0)
         print("")
 
-    print(f"Complete! Successfully reset {success_count} of {len(feeds_to_reset)} feeds")
+    # Reset the feeds a few at a time; the rate limiter paces the requests
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(lambda key: reset_feed(feeds[key], membership.get(key, []), limiter),
+                                feeds_to_reset))
+
+    success_count = sum(results)
+    print(f"\nComplete! Successfully reset {success_count} of {len(feeds_to_reset)} feeds")
+    sys.exit(0 if success_count == len(feeds_to_reset) else 1)
 
 
 if __name__ == "__main__":
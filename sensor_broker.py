@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+"""
+Shared sensor sampler for the Enviro+
+
+The display and the publisher used to open the I2C bus and drive the sensors
+separately, so their transactions could interleave. The broker is the one
+process that touches the sensors: it reads them on a fixed interval (each
+still on its own schedule, see sensor_scheduler.py) and hands the latest raw
+readings to anything that connects to its Unix socket.
+
+A client connects, reads one line of JSON and disconnects:
+  {"sensors": {"bme280": {"values": {...}, "read_at": 1234.5, "age": 0.4}, ...},
+   "health": {"bme280": {"healthy": true, "reason": null, ...}, ...}}
+`read_at` is time.monotonic() in the broker, the same clock for every process
+on the Pi. A sensor that hasn't been read successfully for a while, or that's
+unhealthy, is left out, so clients treat it like a failed read; "health" is
+SensorScheduler.health_report() saying why.
+
+open_sensors() is what the other scripts use: a client for the broker when
+it's running, or a SensorScheduler reading the bus directly when it isn't,
+switching between the two if the broker stops or starts later.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import logging
+import argparse
+import threading
+import socketserver
+from pathlib import Path
+from hardware import get_backend
+from sensor_scheduler import SensorScheduler, scheduler_options
+
+DEFAULT_SOCKET = str(Path(__file__).parent.absolute() / '.sensors.sock')
+
+
+class BrokerClient:
+    """Reads the latest values from a running broker, like SensorScheduler.read()"""
+
+    def __init__(self, socket_path, timeout=2.0, timings=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.timings = timings
+        # read_at of the values already returned, for fresh_only
+        self._seen = {}
+        self._health = {}
+
+    def request(self):
+        """The broker's current snapshot; raises OSError when it isn't running"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return json.loads(b''.join(chunks))
+
+    def available(self):
+        try:
+            self.request()
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def read(self, fresh_only=False):
+        """Raw values of every sensor the broker has, or only the ones it has
+        read since the last call with `fresh_only`"""
+        started = time.monotonic()
+        try:
+            snapshot = self.request()
+        finally:
+            if self.timings is not None:
+                self.timings.record('read.broker', time.monotonic() - started)
+
+        self._health = snapshot.get('health', {})
+        values = {}
+        for name, sensor in snapshot['sensors'].items():
+            if fresh_only and self._seen.get(name) == sensor['read_at']:
+                continue
+            self._seen[name] = sensor['read_at']
+            values.update(sensor['values'])
+        return values
+
+    def health_report(self):
+        """The broker's sensor health as of the last read()"""
+        return dict(self._health)
+
+
+class SensorSource:
+    """Reads through the broker while it's running and directly while it isn't
+
+    A failed broker read is retried with short backoffs for up to
+    `retry_seconds`, long enough for the broker to restart, before falling
+    back to the sensors. While reading directly, the socket is tried again
+    every `recheck_seconds` so a broker started later takes over the bus.
+    """
+
+    def __init__(self, socket_path, timings=None, recheck_seconds=10.0, retry_seconds=5.0):
+        self.timings = timings
+        self.recheck_seconds = recheck_seconds
+        self.retry_seconds = retry_seconds
+        self._client = BrokerClient(socket_path, timings=timings)
+        self._direct = None
+        self._using_broker = self._client.available()
+        self._next_check = time.monotonic() + recheck_seconds
+        if self._using_broker:
+            logging.info(f"Reading sensors through the broker at {socket_path}")
+
+    def _scheduler(self):
+        if self._direct is None:
+            self._direct = SensorScheduler(get_backend(), timings=self.timings, **scheduler_options())
+        return self._direct
+
+    def _read_broker(self, fresh_only):
+        """Read through the broker, retrying while it might be restarting"""
+        deadline = time.monotonic() + self.retry_seconds
+        delay = 0.1
+        while True:
+            try:
+                return self._client.read(fresh_only=fresh_only)
+            except (OSError, ValueError):
+                if time.monotonic() + delay > deadline:
+                    raise
+            time.sleep(delay)
+            delay *= 2
+
+    def read(self, fresh_only=False):
+        now = time.monotonic()
+        if not self._using_broker and now >= self._next_check:
+            self._next_check = now + self.recheck_seconds
+            if self._client.available():
+                logging.info(f"Sensor broker at {self._client.socket_path} is running - reading through it")
+                self._using_broker = True
+
+        if self._using_broker:
+            try:
+                return self._read_broker(fresh_only)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Sensor broker at {self._client.socket_path} stopped answering ({e}) - "
+                                f"reading the sensors directly")
+                self._using_broker = False
+                self._next_check = time.monotonic() + self.recheck_seconds
+        return self._scheduler().read(fresh_only=fresh_only)
+
+    def health_report(self):
+        if self._using_broker:
+            return self._client.health_report()
+        return self._scheduler().health_report()
+
+
+def open_sensors(socket_path=None, timings=None):
+    """A SensorSource using the broker when it's running, or a SensorScheduler
+
+    `socket_path` defaults to SENSOR_SOCKET or .sensors.sock next to this
+    file; an empty path always reads the sensors directly.
+    SENSOR_BROKER_RETRY sets how long a failed broker read is retried
+    before reading directly, and SENSOR_BROKER_RECHECK how often a source
+    reading directly looks for the broker again.
+    """
+    if socket_path is None:
+        socket_path = os.getenv('SENSOR_SOCKET', DEFAULT_SOCKET)
+    if socket_path:
+        return SensorSource(socket_path, timings=timings,
+                            recheck_seconds=float(os.getenv('SENSOR_BROKER_RECHECK', '10')),
+                            retry_seconds=float(os.getenv('SENSOR_BROKER_RETRY', '5')))
+
+    return SensorScheduler(get_backend(), timings=timings, **scheduler_options())
+
+
+class _SnapshotHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.sendall(self.server.broker.snapshot() + b'\n')
+
+
+class SensorBroker:
+    """Samples the sensors every `interval` seconds and serves the latest values
+
+    A sensor is dropped from the snapshot once its values are more than
+    `max_age` seconds older than its own read period allows.
+    """
+
+    def __init__(self, scheduler, socket_path, interval=1.0, max_age=30.0):
+        self.scheduler = scheduler
+        self.socket_path = socket_path
+        self.interval = interval
+        self.max_age = max_age
+        self._latest = {}
+        self._health = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            latest = dict(self._latest)
+            health = self._health
+        sensors = {}
+        for name, (values, read_at) in latest.items():
+            age = now - read_at
+            if age > self.scheduler.periods.get(name, 0) + self.interval + self.max_age:
+                continue
+            sensors[name] = {'values': values, 'read_at': read_at, 'age': round(age, 3)}
+        return json.dumps({'sensors': sensors, 'health': health}).encode()
+
+    def sample(self):
+        try:
+            self.scheduler.read(fresh_only=True)
+        except Exception as e:
+            logging.error(f"Error reading sensors: {e}")
+        with self._lock:
+            self._latest = self.scheduler.latest()
+            self._health = self.scheduler.health_report()
+
+    def start(self):
+        """Take over the socket and start answering clients"""
+        if os.path.exists(self.socket_path):
+            if BrokerClient(self.socket_path).available():
+                raise RuntimeError(f"Another sensor broker is already serving {self.socket_path}")
+            # Left behind by a broker that didn't shut down cleanly
+            os.unlink(self.socket_path)
+
+        self._server = socketserver.UnixStreamServer(self.socket_path, _SnapshotHandler)
+        self._server.broker = self
+        os.chmod(self.socket_path, 0o660)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='sensor-broker', daemon=True)
+        self._thread.start()
+
+    def run(self, stop):
+        """Sample on schedule until the `stop` event is set"""
+        next_sample = time.monotonic()
+        while not stop.is_set():
+            self.sample()
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay < 0:
+                # Fell behind (slow bus): carry on from now rather than catching up
+                next_sample = time.monotonic()
+                delay = 0
+            stop.wait(delay)
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+
+def main():
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_path=Path(__file__).parent.absolute() / '.env')
+    except ImportError:
+        pass
+
+    parser = argparse.ArgumentParser(description="Own the Enviro+ sensors and serve the latest readings over a Unix socket")
+    parser.add_argument('--socket', default=os.getenv('SENSOR_SOCKET', DEFAULT_SOCKET),
+                        help="socket path (default: SENSOR_SOCKET or .sensors.sock next to this script)")
+    parser.add_argument('--interval', type=float, default=float(os.getenv('SENSOR_BROKER_INTERVAL', '1')),
+                        help="seconds between samples (default: SENSOR_BROKER_INTERVAL or 1)")
+    parser.add_argument('--max-age', type=float, default=float(os.getenv('SENSOR_BROKER_MAX_AGE', '30')),
+                        help="seconds past its period before a sensor that keeps failing is left out (default: 30)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    broker = SensorBroker(SensorScheduler(get_backend(), **scheduler_options()), args.socket,
+                          interval=args.interval, max_age=args.max_age)
+    try:
+        broker.start()
+    except RuntimeError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        stop.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logging.info(f"Sensor broker serving {args.socket}, sampling every {args.interval:g} seconds")
+    try:
+        broker.run(stop)
+    finally:
+        broker.close()
+        logging.info("Sensor broker stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Health tracking for the Enviro+ sensors
+
+SensorScheduler keeps a SensorHealth for each device and checks every read
+against it. A read counts as failed when the device raises (an I2C error or
+a timeout) or when its values can't be trusted:
+  out of range  - a value outside what the part can measure (VALID_RANGES),
+                  usually a corrupted transfer
+  stuck         - the BME280 or MICS6814 returning exactly the same values
+                  for `stuck_seconds`, which a live sensor never does
+A device is marked unhealthy after `max_failures` failed reads in a row, or
+when more than `max_error_rate` of its recent read attempts failed. It is
+then left out of readings and only re-probed now and then: after
+`probe_seconds`, doubling after each failed probe up to
+`max_probe_seconds`. The first good probe marks it healthy again.
+
+Some faults only make one value unusable. The LTR559 whose visible-light
+photodiode has failed reads CH1 (IR) >= CH0 (visible + IR) and a few lux
+whatever the light; its lux is dropped while proximity still works.
+"""
+
+import math
+import logging
+from collections import deque
+
+# Measurable range of each raw value: BME280, LTR559 and MICS6814 datasheets
+VALID_RANGES = {
+    'raw_temperature': (-40.0, 85.0),
+    'pressure': (300.0, 1100.0),
+    'humidity': (0.0, 100.0),
+    'lux': (0.0, 64000.0),
+    'proximity': (0.0, 2047.0),
+    'gas_oxidising_ohms': (1.0, math.inf),
+    'gas_reducing_ohms': (1.0, math.inf),
+    'gas_nh3_ohms': (1.0, math.inf),
+}
+
+# Values that are never all unchanged on a working sensor. Not the LTR559:
+# it reads 0 lux and 0 proximity for as long as it's dark and nothing is near.
+STUCK_KEYS = {
+    'bme280': ('raw_temperature', 'pressure', 'humidity'),
+    'gas': ('gas_oxidising_ohms', 'gas_reducing_ohms', 'gas_nh3_ohms'),
+}
+
+# Outcomes needed before the error rate is trusted
+MIN_RATE_SAMPLES = 10
+
+
+class SensorFault(Exception):
+    """A sensor answered, but with values that can't be used"""
+
+
+def light_fault(values):
+    """Why the LTR559's lux can't be used, or None"""
+    ch0, ch1, lux = values.get('light_ch0'), values.get('light_ch1'), values.get('lux')
+    if None in (ch0, ch1, lux):
+        return None
+    if ch1 > 0 and ch0 <= ch1 and lux < 20:
+        return f"visible photodiode failure (CH0={ch0}, CH1={ch1}, lux={lux:.2f})"
+    return None
+
+
+class SensorHealth:
+    """Recent read outcomes of one device, and whether to keep reading it"""
+
+    def __init__(self, name, max_failures=3, max_error_rate=0.5, window=20, probe_seconds=30,
+                 max_probe_seconds=600, stuck_seconds=600):
+        self.name = name
+        self.max_failures = max(1, int(max_failures))
+        self.max_error_rate = float(max_error_rate)
+        self.probe_seconds = float(probe_seconds)
+        self.max_probe_seconds = max(float(max_probe_seconds), self.probe_seconds)
+        self.stuck_seconds = float(stuck_seconds)
+
+        self.healthy = True
+        self.reason = None
+        self.faulty = {}
+        self._outcomes = deque(maxlen=max(int(window), 1))
+        self._failures = 0
+        self._backoff = self.probe_seconds
+        self._retry_at = 0.0
+        self._unchanged = None
+        self._unchanged_since = None
+
+    @property
+    def error_rate(self):
+        """Share of the recent read attempts that failed"""
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for ok in self._outcomes if not ok) / len(self._outcomes)
+
+    def ready(self, now):
+        """Whether to read the device now: always while healthy, when a probe is due otherwise"""
+        return self.healthy or now >= self._retry_at
+
+    def check(self, values, now):
+        """The usable part of a read; raises SensorFault if none of it can be trusted"""
+        for key, value in values.items():
+            limits = VALID_RANGES.get(key)
+            if limits is None or value is None:
+                continue
+            if not math.isfinite(value) or not limits[0] <= value <= limits[1]:
+                raise SensorFault(f"{key} out of range ({value})")
+
+        keys = STUCK_KEYS.get(self.name)
+        if keys and self.stuck_seconds > 0:
+            current = tuple(values.get(key) for key in keys)
+            if current != self._unchanged:
+                self._unchanged, self._unchanged_since = current, now
+            elif now - self._unchanged_since >= self.stuck_seconds:
+                raise SensorFault(f"values unchanged for {now - self._unchanged_since:.0f}s")
+
+        faulty = {}
+        if self.name == 'ltr559':
+            reason = light_fault(values)
+            if reason:
+                faulty['lux'] = reason
+        for key in faulty.keys() - self.faulty.keys():
+            logging.warning(f"{self.name}: leaving out {key} - {faulty[key]}")
+        for key in self.faulty.keys() - faulty.keys():
+            logging.info(f"{self.name}: {key} looks right again")
+        self.faulty = faulty
+        return {key: value for key, value in values.items() if key not in faulty}
+
+    def record_success(self, now, errors=0):
+        """A good read, after `errors` failed attempts at it"""
+        self._outcomes.extend([False] * errors + [True])
+        self._failures = 0
+        self.reason = None
+        if not self.healthy:
+            logging.info(f"{self.name} is answering again - back in the readings")
+            self.healthy = True
+            self._backoff = self.probe_seconds
+            # Failures from before the outage shouldn't count against it
+            self._outcomes.clear()
+            self._outcomes.append(True)
+
+    def record_failure(self, reason, now, attempts=1):
+        """A read that failed `attempts` times in a row; returns True if that made the device unhealthy"""
+        self._outcomes.extend([False] * max(attempts, 1))
+        self._failures += 1
+        self.reason = str(reason)
+
+        if not self.healthy:
+            # A failed probe: wait longer before the next one
+            self._backoff = min(self._backoff * 2, self.max_probe_seconds)
+            self._retry_at = now + self._backoff
+            logging.info(f"{self.name} is still failing ({reason}) - next probe in {self._backoff:g}s")
+            return False
+
+        rate = self.error_rate
+        if self._failures < self.max_failures and (len(self._outcomes) < MIN_RATE_SAMPLES
+                                                   or rate <= self.max_error_rate):
+            logging.warning(f"Failed to read {self.name}: {reason}")
+            return False
+
+        self.healthy = False
+        self._retry_at = now + self._backoff
+        logging.warning(f"{self.name} marked unhealthy ({reason}; {self._failures} failed read(s) in a row, "
+                        f"{rate:.0%} of recent attempts failed) - leaving it out and probing again "
+                        f"in {self._backoff:g}s")
+        return True
+
+    def report(self):
+        return {
+            'healthy': self.healthy,
+            'reason': self.reason,
+            'error_rate': round(self.error_rate, 3),
+            'faulty': dict(self.faulty),
+        }
+
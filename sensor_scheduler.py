@@ -0,0 +1,315 @@
+"""
+Per-sensor read scheduling for the Enviro+
+
+Each sensor is only touched when its own period has elapsed, and with as
+little I2C traffic as it allows:
+  BME280   - forced mode runs one conversion per read at the configured
+             oversampling and returns when it's done, so there is no stale
+             first value to discard and no fixed sleep. Normal mode keeps
+             converting in the background and a read just fetches the latest.
+  LTR559   - one update per read; lux, raw counts and proximity all come
+             from that update.
+  MICS6814 - readings are held back until the heater has been on for the
+             warm-up window.
+
+Each sensor is also read on its own: a read that raises is retried after a
+short backoff, a read that hangs is given up after a timeout, and either way
+the other sensors' values are still returned. Every sensor's health is
+tracked (see sensor_health.py), so one that keeps failing is left out and
+only re-probed now and then.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from sensor_health import SensorHealth, SensorFault
+
+BME280_MODES = ('forced', 'normal')
+
+# Oversampling settings the BME280 supports
+BME280_OVERSAMPLING = (1, 2, 4, 8, 16)
+
+# Standby time between conversions in normal mode (the library's default)
+BME280_STANDBY_MS = 500
+
+# First delay before retrying a failed read, doubling with each retry
+RETRY_DELAY = 0.05
+
+
+def scheduler_options():
+    """SensorScheduler settings from the environment (.env already loaded)
+
+    BME280_MODE / BME280_OVERSAMPLING pick forced or normal mode and the
+    oversampling of all three measurements; BME280_PERIOD, LTR559_PERIOD and
+    GAS_PERIOD are the minimum seconds between reads of each sensor (0 = every
+    read); GAS_WARMUP_SECONDS leaves the gas readings out until the heater
+    has been on that long. SENSOR_RETRIES and SENSOR_READ_TIMEOUT (seconds,
+    0 = none) apply to each sensor's read, and the SENSOR_MAX_FAILURES,
+    SENSOR_MAX_ERROR_RATE, SENSOR_STUCK_SECONDS, SENSOR_PROBE_SECONDS and
+    SENSOR_PROBE_MAX_SECONDS are its SensorHealth settings.
+    """
+    return {
+        'bme280_mode': os.getenv('BME280_MODE', 'forced').lower(),
+        'oversampling': int(os.getenv('BME280_OVERSAMPLING', '1')),
+        'periods': {
+            'bme280': float(os.getenv('BME280_PERIOD', '0')),
+            'ltr559': float(os.getenv('LTR559_PERIOD', '0')),
+            'gas': float(os.getenv('GAS_PERIOD', '0')),
+        },
+        'gas_warmup': float(os.getenv('GAS_WARMUP_SECONDS', '0')),
+        'retries': int(os.getenv('SENSOR_RETRIES', '1')),
+        'read_timeout': float(os.getenv('SENSOR_READ_TIMEOUT', '2')),
+        'health': {
+            'max_failures': int(os.getenv('SENSOR_MAX_FAILURES', '3')),
+            'max_error_rate': float(os.getenv('SENSOR_MAX_ERROR_RATE', '0.5')),
+            'stuck_seconds': float(os.getenv('SENSOR_STUCK_SECONDS', '600')),
+            'probe_seconds': float(os.getenv('SENSOR_PROBE_SECONDS', '30')),
+            'max_probe_seconds': float(os.getenv('SENSOR_PROBE_MAX_SECONDS', '600')),
+        },
+    }
+
+
+class _DeviceWorker:
+    """Runs one sensor's reads on its own thread, so a hung I2C call can be given up on
+
+    The thread is a daemon: a call that never returns doesn't keep the
+    process alive, and until it does return that sensor's reads fail fast.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = queue.Queue()
+        self._pending = None
+        threading.Thread(target=self._run, name=f'sensor-{name}', daemon=True).start()
+
+    def _run(self):
+        while True:
+            function, call = self._calls.get()
+            try:
+                call['value'] = function()
+            except Exception as e:
+                call['error'] = e
+            call['done'].set()
+
+    def call(self, function, timeout):
+        if self._pending is not None and not self._pending['done'].is_set():
+            raise TimeoutError(f"still waiting for an earlier {self.name} read")
+        call = self._pending = {'done': threading.Event()}
+        self._calls.put((function, call))
+        if not call['done'].wait(timeout):
+            raise TimeoutError(f"no answer from {self.name} in {timeout:g}s")
+        if 'error' in call:
+            raise call['error']
+        return call.get('value')
+
+
+class SensorScheduler:
+    """Reads each sensor when it's due and remembers the latest values
+
+    `periods` maps 'bme280', 'ltr559' and 'gas' to the minimum seconds
+    between reads (0 = every call). A failed read is retried `retries`
+    times and one taking longer than `read_timeout` seconds (0 = no limit)
+    fails. `health` is keyword arguments for each sensor's SensorHealth.
+    `timings` (an instrumentation.StageTimings) records init.<sensor> and
+    read.<sensor>.
+    """
+
+    def __init__(self, backend, bme280_mode='forced', oversampling=1, periods=None,
+                 gas_warmup=0, retries=1, read_timeout=2.0, health=None, timings=None):
+        if bme280_mode not in BME280_MODES:
+            raise ValueError(f"Unknown BME280 mode {bme280_mode!r} (use one of {', '.join(BME280_MODES)})")
+        if oversampling not in BME280_OVERSAMPLING:
+            raise ValueError(f"BME280 oversampling must be one of {', '.join(map(str, BME280_OVERSAMPLING))}")
+
+        self.backend = backend
+        self.bme280_mode = bme280_mode
+        self.oversampling = oversampling
+        self.periods = dict(periods or {})
+        self.gas_warmup = gas_warmup
+        self.retries = max(0, int(retries))
+        self.read_timeout = read_timeout
+        self.timings = timings
+
+        self.health = {name: SensorHealth(name, **(health or {})) for name in ('bme280', 'ltr559', 'gas')}
+        self._workers = {}
+        self._devices = {}
+        self._latest = {}
+        self._last_read = {}
+        self._gas_started = None
+        self._gas_warm = gas_warmup <= 0
+
+    def _timed(self, stage, function):
+        started = time.monotonic()
+        try:
+            return function()
+        finally:
+            if self.timings is not None:
+                self.timings.record(stage, time.monotonic() - started)
+
+    def _device(self, name):
+        device = self._devices.get(name)
+        if device is None:
+            device = self._timed(f'init.{name}', lambda: self._open(name))
+            self._devices[name] = device
+        return device
+
+    def _open(self, name):
+        if name == 'bme280':
+            bme280 = self.backend.bme280()
+            bme280.setup(
+                mode=self.bme280_mode,
+                temperature_oversampling=self.oversampling,
+                pressure_oversampling=self.oversampling,
+                humidity_oversampling=self.oversampling,
+                temperature_standby=BME280_STANDBY_MS
+            )
+            if self.bme280_mode == 'normal':
+                # The first conversion finishes one standby period after setup
+                time.sleep(BME280_STANDBY_MS / 1000 + 0.05)
+            return bme280
+        if name == 'ltr559':
+            return self.backend.ltr559()
+        if name == 'gas':
+            gas = self.backend.gas()
+            # Switch the heater on now rather than at the first read, so the
+            # warm-up window starts here
+            if hasattr(gas, 'setup'):
+                gas.setup()
+            self._gas_started = time.monotonic()
+            return gas
+        raise KeyError(name)
+
+    def _read_bme280(self):
+        bme280 = self._device('bme280')
+
+        def read():
+            # One conversion (forced) or one register fetch (normal) for all three
+            bme280.update_sensor()
+            return {
+                'raw_temperature': bme280.temperature,
+                'pressure': bme280.pressure,
+                'humidity': bme280.humidity,
+            }
+
+        values = self._timed('read.bme280', read)
+        try:
+            values['cpu_temperature'] = self._timed('read.cpu_temperature', self.backend.cpu_temperature)
+        except Exception as e:
+            logging.error(f"Failed to read CPU temperature: {e}")
+            values['cpu_temperature'] = None
+        return values
+
+    def _read_ltr559(self):
+        ltr559 = self._device('ltr559')
+
+        def read():
+            update = getattr(ltr559, 'update_sensor', None)
+            if update is None:
+                # Old module-level API: each call updates on its own
+                lux = ltr559.get_lux()
+                ch0, ch1 = ltr559.get_raw_als()
+                return {'lux': lux, 'light_ch0': ch0, 'light_ch1': ch1, 'proximity': ltr559.get_proximity()}
+            update()
+            ch0, ch1 = ltr559.get_raw_als(passive=True)
+            return {
+                'lux': ltr559.get_lux(passive=True),
+                'light_ch0': ch0,
+                'light_ch1': ch1,
+                'proximity': ltr559.get_proximity(passive=True),
+            }
+
+        return self._timed('read.ltr559', read)
+
+    def _read_gas(self):
+        if self._gas_started is None and not self._gas_warm:
+            logging.info(f"Gas sensor warming up - leaving it out for {self.gas_warmup:g} seconds")
+        gas = self._device('gas')
+        if not self._gas_warm:
+            if time.monotonic() - self._gas_started < self.gas_warmup:
+                return None
+            self._gas_warm = True
+            logging.info("Gas sensor warm-up finished")
+
+        data = self._timed('read.gas', gas.read_all)
+        return {
+            'gas_oxidising_ohms': data.oxidising,
+            'gas_reducing_ohms': data.reducing,
+            'gas_nh3_ohms': data.nh3,
+            'gas_adc_volts': getattr(data, 'adc', None),
+        }
+
+    def _call(self, name, reader):
+        if not self.read_timeout:
+            return reader()
+        worker = self._workers.get(name)
+        if worker is None:
+            worker = self._workers[name] = _DeviceWorker(name)
+        return worker.call(reader, self.read_timeout)
+
+    def _read_checked(self, name, reader):
+        """One sensor's values, retried and checked; None if it failed or is warming up"""
+        health = self.health[name]
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                reading = self._call(name, reader)
+                if reading is None:
+                    return None
+                reading = health.check(reading, time.monotonic())
+                health.record_success(time.monotonic(), errors=attempt)
+                return reading
+            except (SensorFault, TimeoutError) as e:
+                # Reading it again straight away gives the same answer, or
+                # waits behind the read that's hung
+                error = e
+                break
+            except Exception as e:
+                error = e
+
+        if health.record_failure(error, time.monotonic(), attempts=attempt + 1):
+            # Stop serving its old values, and set it up from scratch when it's probed
+            self._latest.pop(name, None)
+            self._devices.pop(name, None)
+        return None
+
+    def read(self, fresh_only=False):
+        """Read every sensor that's due and return the raw values
+
+        Sensors that aren't due keep their previous values unless
+        `fresh_only`, in which case only what was read just now is returned.
+        A sensor still warming up, whose read failed or that's unhealthy is
+        left out entirely.
+        """
+        readers = (('bme280', self._read_bme280), ('ltr559', self._read_ltr559), ('gas', self._read_gas))
+        now = time.monotonic()
+        values = {}
+
+        for name, reader in readers:
+            last = self._last_read.get(name)
+            if last is not None and now - last < self.periods.get(name, 0):
+                if not fresh_only:
+                    values.update(self._latest.get(name, {}))
+                continue
+            if not self.health[name].ready(now):
+                continue
+
+            reading = self._read_checked(name, reader)
+            if reading is None:
+                continue
+            self._latest[name] = reading
+            self._last_read[name] = now
+            values.update(reading)
+
+        return values
+
+    def health_report(self):
+        """{sensor: SensorHealth.report()} for every sensor"""
+        return {name: health.report() for name, health in self.health.items()}
+
+    def latest(self):
+        """{sensor: (values, time.monotonic() of the read)} for every sensor read so far"""
+        return {name: (dict(values), self._last_read[name]) for name, values in self._latest.items()}
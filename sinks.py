@@ -0,0 +1,334 @@
+"""
+Pluggable publishing sinks with a bounded, non-blocking fan-out
+
+Every sink gets its own worker thread and bounded queue. Submitting a
+reading never blocks: when a sink falls behind, its overload policy decides
+what to give up (drop the oldest queued reading, drop the new one, or
+coalesce the backlog down to the newest reading), so one slow or dead sink
+can't stall sampling or the other sinks.
+"""
+
+import os
+import csv
+import json
+import time
+import queue
+import socket
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from log_setup import log_detail
+
+# One reading as handed to sinks. `stats` is the per-sensor window
+# min/max/stddev in sampling mode, otherwise None. `device` is the unit's
+# DEVICE_ID (see fleet.py), None for a single unit.
+Reading = namedtuple('Reading', ['sensors', 'created_at', 'stats', 'device'], defaults=(None,))
+
+OVERLOAD_POLICIES = ('drop_oldest', 'drop_newest', 'coalesce')
+
+
+class Sink:
+    """Base class: subclasses implement publish() and optionally close()"""
+
+    name = "sink"
+
+    def publish(self, reading):
+        """Send one reading; return True on success"""
+        raise NotImplementedError
+
+    def on_drop(self, reading):
+        """Called when the overload policy throws a reading away"""
+        logging.warning(f"{self.name} overloaded - dropped reading from {format_timestamp(reading.created_at)}")
+
+    def close(self):
+        pass
+
+
+class Ticket:
+    """Outcome of one reading on one sink, for callers that want to wait"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.success = False
+        self.elapsed = 0.0
+
+    def finish(self, success, elapsed=0.0):
+        self.success = success
+        self.elapsed = elapsed
+        self.done.set()
+
+
+class SinkWorker:
+    """Thread and bounded queue feeding one sink
+
+    `timings` (an instrumentation.StageTimings) gets the duration of every
+    publish as stage "sink.<name>".
+    """
+
+    def __init__(self, sink, queue_size=100, policy='drop_oldest', timeout=None, timings=None):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy {policy!r} (use one of {', '.join(OVERLOAD_POLICIES)})")
+        self.sink = sink
+        self.policy = policy
+        self.timeout = timeout
+        self.timings = timings
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._stop = threading.Event()
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=f"sink-{sink.name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, reading):
+        """Queue a reading without blocking; returns its Ticket"""
+        ticket = Ticket()
+        item = (reading, ticket)
+
+        if self.policy == 'coalesce':
+            # Only the newest reading matters: discard anything still waiting
+            self._discard_queued()
+
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return ticket
+            except queue.Full:
+                if self.policy == 'drop_newest':
+                    self._drop(item)
+                    return ticket
+                # drop_oldest (and coalesce racing the worker): make room
+                try:
+                    self._drop(self._queue.get_nowait())
+                except queue.Empty:
+                    pass
+
+    def _discard_queued(self):
+        while True:
+            try:
+                self._drop(self._queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _drop(self, item):
+        if item is None:
+            # Stop sentinel
+            return
+        reading, ticket = item
+        self.dropped += 1
+        try:
+            self.sink.on_drop(reading)
+        except Exception as e:
+            logging.error(f"{self.sink.name}: error handling dropped reading: {e}")
+        ticket.finish(False)
+
+    def _run(self):
+        while not self._stop.is_set():
+            item = self._queue.get()
+            if item is None:
+                break
+            reading, ticket = item
+            started = time.monotonic()
+            try:
+                success = bool(self.sink.publish(reading))
+            except Exception as e:
+                logging.error(f"Unexpected error publishing to {self.sink.name}: {e}")
+                success = False
+            elapsed = time.monotonic() - started
+            if self.timings is not None:
+                self.timings.record(f"sink.{self.sink.name}", elapsed)
+            if success:
+                self.published += 1
+            else:
+                self.failed += 1
+            ticket.finish(success, elapsed)
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    def stop(self, timeout=5):
+        """Stop after the reading in progress; queued readings go to on_drop"""
+        self._stop.set()
+        try:
+            # Wake the worker if it's waiting for a reading
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # It's busy, and checks the stop flag before taking the next one
+            pass
+        self._thread.join(timeout)
+        self._discard_queued()
+        try:
+            self.sink.close()
+        except Exception as e:
+            logging.error(f"Error closing {self.sink.name}: {e}")
+
+
+class FanOut:
+    """Hands every reading to every sink's worker"""
+
+    def __init__(self, timings=None):
+        self.workers = []
+        self.timings = timings
+
+    def add(self, sink, queue_size=100, policy='drop_oldest', timeout=None):
+        self.workers.append(SinkWorker(sink, queue_size, policy, timeout, self.timings))
+
+    def __bool__(self):
+        return bool(self.workers)
+
+    def names(self):
+        return [worker.sink.name for worker in self.workers]
+
+    def submit(self, reading):
+        """Queue a reading for every sink; returns {sink name: Ticket}"""
+        return {worker.sink.name: worker.submit(reading) for worker in self.workers}
+
+    def wait(self, tickets):
+        """Wait for each sink up to its own timeout (measured from now)
+
+        Returns {sink name: success}; a sink that misses its deadline counts
+        as failed but keeps working in the background.
+        """
+        started = time.monotonic()
+        results = {}
+        for worker in self.workers:
+            ticket = tickets.get(worker.sink.name)
+            if ticket is None:
+                continue
+            remaining = None
+            if worker.timeout is not None:
+                remaining = max(0.0, started + worker.timeout - time.monotonic())
+            if not ticket.done.wait(remaining):
+                logging.error(f"{worker.sink.name} didn't finish within {worker.timeout:g} seconds - continuing without it")
+                results[worker.sink.name] = False
+            else:
+                results[worker.sink.name] = ticket.success
+                log_detail(f"{worker.sink.name}: {'ok' if ticket.success else 'FAILED'} after {ticket.elapsed:.1f}s")
+        return results
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+
+def format_timestamp(created_at):
+    return datetime.fromtimestamp(created_at, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class CsvSink(Sink):
+    """Append readings to a CSV file, one column per sensor (and 'device' if listed)"""
+
+    name = "CSV file"
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = list(fields)
+
+    def publish(self, reading):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(['created_at'] + self.fields)
+            values = dict(reading.sensors, device=reading.device or '')
+            writer.writerow([format_timestamp(reading.created_at)] +
+                            [values.get(field, '') for field in self.fields])
+        return True
+
+
+class NdjsonSink(Sink):
+    """Append readings to a newline-delimited JSON file"""
+
+    name = "NDJSON file"
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, reading):
+        record = {'created_at': format_timestamp(reading.created_at)}
+        if reading.device:
+            record['device'] = reading.device
+        record.update(reading.sensors)
+        if reading.stats:
+            record['stats'] = reading.stats
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        return True
+
+
+def line_protocol(measurement, tags, reading):
+    """Format a reading as one InfluxDB line protocol line (second precision)"""
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+    fields = ','.join(
+        f"{escape(key)}={float(value)}"
+        for key, value in reading.sensors.items()
+        if isinstance(value, (int, float))
+    )
+    if reading.device:
+        tags = dict(tags, device=reading.device)
+    tag_set = ''.join(f",{escape(key)}={escape(value)}" for key, value in sorted(tags.items()))
+    return f"{escape(measurement)}{tag_set} {fields} {int(reading.created_at)}"
+
+
+class InfluxHttpSink(Sink):
+    """Write readings to InfluxDB over HTTP with a keep-alive session
+
+    `url` is the full write endpoint including the database/bucket and
+    precision=s, e.g. http://host:8086/api/v2/write?org=home&bucket=enviro&precision=s
+    or http://host:8086/write?db=enviro&precision=s for InfluxDB 1.x.
+    """
+
+    name = "InfluxDB (HTTP)"
+
+    def __init__(self, url, token=None, measurement='enviroplus', tags=None, timeout=10):
+        import requests
+
+        self.url = url
+        self.measurement = measurement
+        self.tags = tags or {}
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f"Token {token}"
+
+    def publish(self, reading):
+        body = line_protocol(self.measurement, self.tags, reading)
+        response = self.session.post(self.url, data=body.encode(), timeout=self.timeout)
+        if response.status_code >= 300:
+            logging.error(f"InfluxDB write failed: {response.status_code} {response.text.strip()}")
+            return False
+        return True
+
+    def close(self):
+        self.session.close()
+
+
+def udp_address(value, default_port=8089):
+    """(host, port) from INFLUXDB_UDP's 'host:port' or just 'host'"""
+    host, _, port = value.partition(':')
+    return host, int(port) if port else default_port
+
+
+class InfluxUdpSink(Sink):
+    """Fire-and-forget InfluxDB line protocol over UDP"""
+
+    name = "InfluxDB (UDP)"
+
+    def __init__(self, host, port, measurement='enviroplus', tags=None):
+        self.address = (host, int(port))
+        self.measurement = measurement
+        self.tags = tags or {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def publish(self, reading):
+        self.sock.sendto(line_protocol(self.measurement, self.tags, reading).encode(), self.address)
+        return True
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""
+Compact, fixed-size local history of sensor readings
+
+Each metric gets one memory-mapped file holding a round-robin ring per tier:
+  raw     - every reading, kept for 24 hours
+  minute  - 1-minute min/mean/max, kept for 30 days
+  hour    - 1-hour min/mean/max, kept for 10 years
+Files are allocated at full size when created and never grow, appends are
+O(1) and range reads binary-search the ring.
+
+Usage:
+  ./timeseries_store.py                          # List stored metrics
+  ./timeseries_store.py temperature              # Last 24 hours of temperature
+  ./timeseries_store.py pressure --hours 720     # Last 30 days (picks the minute tier)
+"""
+
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+import argparse
+from pathlib import Path
+from datetime import datetime
+
+# (name, bucket seconds (0 = raw), retention seconds)
+DEFAULT_TIERS = (
+    ('raw', 0, 24 * 3600),
+    ('minute', 60, 30 * 24 * 3600),
+    ('hour', 3600, 10 * 365 * 24 * 3600),
+)
+
+# Shortest expected gap between raw readings; sizes the raw ring
+DEFAULT_MIN_INTERVAL = 10
+
+MAGIC = b'ENVTS001'
+# Per-tier header: step, capacity, head, count, then the bucket being filled
+# (start, sum, min, max, n) so partial buckets survive between cron runs
+TIER_HEADER = struct.Struct('<dIIIdddd I4x')
+# One row: timestamp, min, mean, max
+ROW = struct.Struct('<dddd')
+FILE_HEADER = struct.Struct('<8sI4x')
+
+
+class _Tier:
+    """One ring buffer inside a metric file"""
+
+    def __init__(self, mm, header_offset, data_offset, step, capacity):
+        self.mm = mm
+        self.header_offset = header_offset
+        self.data_offset = data_offset
+        self.step = step
+        self.capacity = capacity
+
+    def _header(self):
+        return TIER_HEADER.unpack_from(self.mm, self.header_offset)
+
+    def _write_header(self, head, count, bucket_start, total, low, high, n):
+        TIER_HEADER.pack_into(self.mm, self.header_offset, self.step, self.capacity,
+                              head, count, bucket_start, total, low, high, n)
+
+    def _row(self, index):
+        return ROW.unpack_from(self.mm, self.data_offset + index * ROW.size)
+
+    def _last_timestamp(self, head, count):
+        if count == 0:
+            return None
+        return self._row((head - 1) % self.capacity)[0]
+
+    def _push_row(self, head, count, row):
+        ROW.pack_into(self.mm, self.data_offset + head * ROW.size, *row)
+        return (head + 1) % self.capacity, min(count + 1, self.capacity)
+
+    def add(self, timestamp, value, value_min=None, value_max=None):
+        _, _, head, count, bucket_start, total, low, high, n = self._header()
+        value_min = value if value_min is None else value_min
+        value_max = value if value_max is None else value_max
+
+        if self.step == 0:
+            last = self._last_timestamp(head, count)
+            if last is not None and timestamp <= last:
+                # Clock went backwards; keep the ring sorted for binary search
+                return
+            head, count = self._push_row(head, count, (timestamp, value_min, value, value_max))
+            self._write_header(head, count, 0.0, 0.0, 0.0, 0.0, 0)
+            return
+
+        start = timestamp - (timestamp % self.step)
+        if n and start != bucket_start:
+            if start < bucket_start:
+                return
+            # Bucket finished: store its aggregate and start a new one
+            head, count = self._push_row(head, count, (bucket_start, low, total / n, high))
+            n = 0
+
+        if n == 0:
+            bucket_start, total, low, high = start, 0.0, value_min, value_max
+        total += value
+        low = min(low, value_min)
+        high = max(high, value_max)
+        self._write_header(head, count, bucket_start, total, low, high, n + 1)
+
+    def rows(self, start, end):
+        """Rows with start <= timestamp < end, oldest first (includes the open bucket)"""
+        _, _, head, count, bucket_start, total, low, high, n = self._header()
+        first = (head - count) % self.capacity
+
+        def timestamp_at(i):
+            return self._row((first + i) % self.capacity)[0]
+
+        # Binary search for the first row at or after `start`
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if timestamp_at(mid) < start:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        result = []
+        for i in range(lo, count):
+            row = self._row((first + i) % self.capacity)
+            if row[0] >= end:
+                break
+            result.append(row)
+
+        if n and start <= bucket_start < end:
+            result.append((bucket_start, low, total / n, high))
+        return result
+
+    def oldest(self):
+        _, _, head, count, *_ = self._header()
+        if count == 0:
+            return None
+        return self._row((head - count) % self.capacity)[0]
+
+
+class _MetricFile:
+    """Memory-mapped file holding every tier for one metric"""
+
+    def __init__(self, path, tiers):
+        self.path = Path(path)
+        layout = []
+        offset = FILE_HEADER.size + TIER_HEADER.size * len(tiers)
+        for _, step, capacity in tiers:
+            layout.append((step, capacity, offset))
+            offset += capacity * ROW.size
+        size = offset
+
+        fresh = not self.path.exists() or self.path.stat().st_size != size
+        if fresh and self.path.exists():
+            logging.warning(f"History file {self.path} has a different layout, starting it again")
+            self.path.rename(self.path.with_suffix('.old'))
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fresh:
+            os.ftruncate(self._fd, size)
+        self.mm = mmap.mmap(self._fd, size)
+
+        if fresh or self.mm[:len(MAGIC)] != MAGIC:
+            FILE_HEADER.pack_into(self.mm, 0, MAGIC, len(tiers))
+            for i, (step, capacity, _) in enumerate(layout):
+                TIER_HEADER.pack_into(self.mm, FILE_HEADER.size + i * TIER_HEADER.size,
+                                      step, capacity, 0, 0, 0.0, 0.0, 0.0, 0.0, 0)
+
+        self.tiers = [
+            _Tier(self.mm, FILE_HEADER.size + i * TIER_HEADER.size, data_offset, step, capacity)
+            for i, (step, capacity, data_offset) in enumerate(layout)
+        ]
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        os.close(self._fd)
+
+
+class TimeSeriesStore:
+    """Directory of per-metric round-robin files with automatic downsampling"""
+
+    def __init__(self, directory, tiers=DEFAULT_TIERS, min_interval=DEFAULT_MIN_INTERVAL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.tier_names = [name for name, _, _ in tiers]
+        # (name, step, capacity) with the raw ring sized for the fastest expected rate
+        self.tiers = [
+            (name, step, int(retention // (step or min_interval)))
+            for name, step, retention in tiers
+        ]
+        self._files = {}
+
+    def _file(self, metric, create=True):
+        """The open file for `metric`; None if it has none and `create` is False"""
+        if metric not in self._files:
+            if not create and not (self.directory / f"{metric}.ts").exists():
+                return None
+            self._files[metric] = _MetricFile(self.directory / f"{metric}.ts",
+                                              [(name, step, capacity) for name, step, capacity in self.tiers])
+        return self._files[metric]
+
+    def append(self, metric, timestamp, value, value_min=None, value_max=None):
+        """Add one reading to every tier of `metric`
+
+        `value_min`/`value_max` record the spread when `value` is itself an
+        average of several samples.
+        """
+        for tier in self._file(metric).tiers:
+            tier.add(timestamp, float(value), value_min, value_max)
+
+    def append_reading(self, sensors, timestamp, stats=None):
+        """Add every value from a read_sensors() dict
+
+        `stats` (from sampler.WindowAggregator) carries the min/max of each
+        value when it is the mean of a sampling window.
+        """
+        stats = stats or {}
+        for metric, value in sensors.items():
+            if isinstance(value, (int, float)):
+                window = stats.get(metric, {})
+                self.append(metric, timestamp, value, window.get('min'), window.get('max'))
+
+    def read(self, metric, start, end=None, tier=None):
+        """Return (timestamp, min, mean, max) rows for start <= timestamp < end
+
+        Without `tier`, uses the finest tier that still reaches back to `start`.
+        A metric with no history yet has no rows (and no file is created for it).
+        """
+        if end is None:
+            end = time.time() + 1
+        metric_file = self._file(metric, create=False)
+        if metric_file is None:
+            return []
+
+        if tier is not None:
+            return metric_file.tiers[self.tier_names.index(tier)].rows(start, end)
+
+        for candidate in metric_file.tiers:
+            oldest = candidate.oldest()
+            if oldest is not None and oldest <= start:
+                return candidate.rows(start, end)
+        # Nothing reaches back that far; the coarsest tier has the most history
+        return metric_file.tiers[-1].rows(start, end)
+
+    def metrics(self):
+        return sorted(path.stem for path in self.directory.glob('*.ts'))
+
+    def flush(self):
+        for metric_file in self._files.values():
+            metric_file.mm.flush()
+
+    def close(self):
+        for metric_file in self._files.values():
+            metric_file.close()
+        self._files = {}
+
+
+def main():
+    # Same .env and HISTORY_DIR as publish_to_adafruit.py
+    script_dir = Path(__file__).parent.absolute()
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_path=script_dir / '.env')
+    except ImportError:
+        pass
+    state_dir = Path(os.getenv('STATE_DIR', str(script_dir)))
+    history_dir = Path(os.getenv('HISTORY_DIR', str(state_dir / 'history')))
+
+    parser = argparse.ArgumentParser(description="Show locally stored Enviro+ history")
+    parser.add_argument('metric', nargs='?', help="metric to show (omit to list metrics)")
+    parser.add_argument('--hours', type=float, default=24, help="how far back to go (default: 24)")
+    parser.add_argument('--tier', choices=[name for name, _, _ in DEFAULT_TIERS],
+                        help="force a tier instead of picking one automatically")
+    parser.add_argument('--dir', default=history_dir,
+                        help=f"history directory (default: HISTORY_DIR, or STATE_DIR/history: {history_dir})")
+    args = parser.parse_args()
+
+    if not Path(args.dir).is_dir():
+        print(f"No history found in {args.dir}")
+        sys.exit(1)
+    store = TimeSeriesStore(args.dir)
+
+    metrics = store.metrics()
+    if not args.metric:
+        for metric in metrics:
+            print(metric)
+        return
+    if args.metric not in metrics:
+        print(f"No history for {args.metric} - stored metrics: {', '.join(metrics) or 'none'}")
+        sys.exit(1)
+
+    start = time.time() - args.hours * 3600
+    for timestamp, low, mean, high in store.read(args.metric, start, tier=args.tier):
+        when = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        if low == high:
+            print(f"{when}  {mean:.2f}")
+        else:
+            print(f"{when}  {mean:.2f}  (min {low:.2f}, max {high:.2f})")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()